@@ -0,0 +1,160 @@
+"""
+asgi_app.py 使用的异步数据库访问
+
+    PostgreSQL - psycopg 的 AsyncConnectionPool
+    MongoDB    - pymongo 的 AsyncMongoClient
+
+run_steps 在事件循环里执行 analysis.py 的步骤生成器（见 backends.py）：
+一个步骤列表里的查询用 asyncio.gather 并发执行，等待数据库时不占用线程，
+所以一个事件循环可以同时处理很多个仪表板请求。
+"""
+import asyncio
+
+from psycopg_pool import AsyncConnectionPool
+from pymongo import AsyncMongoClient
+
+import metrics
+from backends import MongoStep, TableStep, get_backend, to_frame
+from columnar import Table
+from db import configure_connection, explain_analyze, explain_pipeline
+from config import PG_CONFIG, PG_POOL_CONFIG, MONGO_URI, MONGO_DB, MONGO_COLLECTION, MONGO_POOL_CONFIG, QUERY_BACKEND
+
+_pg_pool = None
+_mongo_client = None
+
+
+async def open_pools():
+    """在事件循环启动后调用（连接池绑定到当前事件循环）"""
+    global _pg_pool, _mongo_client
+    if QUERY_BACKEND == "postgres" and _pg_pool is None:
+        pool_config = dict(PG_POOL_CONFIG)
+        pool_config.pop("check_interval")
+        _pg_pool = AsyncConnectionPool(
+            kwargs=PG_CONFIG,
+            check=AsyncConnectionPool.check_connection,
+            configure=_configure,
+            name="taxi-async",
+            open=False,
+            **pool_config
+        )
+        await _pg_pool.open()
+    if _mongo_client is None:
+        _mongo_client = AsyncMongoClient(MONGO_URI, **MONGO_POOL_CONFIG)
+
+
+async def _configure(conn):
+    configure_connection(conn)
+
+
+async def close_pools():
+    global _pg_pool, _mongo_client
+    if _pg_pool is not None:
+        await _pg_pool.close()
+        _pg_pool = None
+    if _mongo_client is not None:
+        await _mongo_client.close()
+        _mongo_client = None
+
+
+def get_mongo_collection(name=MONGO_COLLECTION):
+    return _mongo_client[MONGO_DB][name]
+
+
+async def fetch(query, params=None):
+    """执行查询，返回 (列名, 行列表)；非 PostgreSQL 后端（DuckDB 在进程内计算）放到线程里执行"""
+    if _pg_pool is None:
+        return await asyncio.to_thread(get_backend().fetch, query, params)
+    timer = metrics.QueryTimer("postgres", query, params, explain=lambda: explain_analyze(query, params))
+    async with _pg_pool.connection() as conn:
+        timer.lap("connect")
+        async with conn.cursor() as cur:
+            await cur.execute(query, params)
+            timer.lap("execute")
+            rows = await cur.fetchall()
+            timer.lap("fetch")
+            columns = [d.name for d in cur.description]
+    timer.done(len(rows))
+    return columns, rows
+
+
+async def read_sql(query, params=None):
+    """与 QueryBackend.read_sql 相同的结果"""
+    columns, rows = await fetch(query, params)
+    with metrics.phase("convert", QUERY_BACKEND):
+        return to_frame(columns, rows)
+
+
+async def fetch_table(query, params=None):
+    """与 QueryBackend.fetch_table 相同的结果"""
+    if _pg_pool is None:
+        return await asyncio.to_thread(get_backend().fetch_table, query, params)
+    columns, rows = await fetch(query, params)
+    with metrics.phase("convert", QUERY_BACKEND):
+        return Table.from_rows(columns, rows)
+
+
+async def aggregate(pipeline):
+    timer = metrics.QueryTimer("mongo", pipeline, explain=lambda: explain_pipeline(pipeline))
+    cursor = await get_mongo_collection().aggregate(pipeline, allowDiskUse=True)
+    timer.lap("execute")
+    docs = await cursor.to_list()
+    timer.lap("fetch")
+    timer.done(len(docs))
+    return docs
+
+
+async def _execute(step):
+    if isinstance(step, list):
+        return list(await asyncio.gather(*(_execute(s) for s in step)))
+    if isinstance(step, MongoStep):
+        return await aggregate(step.pipeline)
+    if isinstance(step, TableStep):
+        return await fetch_table(step.query, step.params)
+    return await read_sql(step.query, step.params)
+
+
+async def run_steps(steps):
+    """backends.run_steps 的异步版本"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await _execute(step), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def run(func, *args, **kwargs):
+    """异步执行 analysis.py 中用 @stepwise 定义的函数"""
+    with metrics.function_timer(func.__name__):
+        return await run_steps(func.steps(*args, **kwargs))
+
+
+async def check_health():
+    status = {}
+    if _pg_pool is not None:
+        try:
+            async with _pg_pool.connection() as conn:
+                await conn.execute("SELECT 1")
+            status["postgres"] = "ok"
+        except Exception as e:
+            status["postgres"] = f"error: {e}"
+    else:
+        status[QUERY_BACKEND] = await asyncio.to_thread(get_backend().health)
+    try:
+        await _mongo_client.admin.command("ping")
+        status["mongo"] = "ok"
+    except Exception as e:
+        status["mongo"] = f"error: {e}"
+    return status
+
+
+def pool_stats():
+    return {
+        "postgres": _pg_pool.get_stats() if _pg_pool is not None else {},
+        "mongo": {k: v for k, v in MONGO_POOL_CONFIG.items() if k.endswith("PoolSize")},
+        "event_loop_tasks": len(asyncio.all_tasks())
+    }
@@ -1,152 +1,109 @@
-import psycopg
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from pymongo import MongoClient
+from datetime import datetime
 import folium
 from folium.plugins import HeatMap
 
-# 数据库配置
-PG_CONFIG = {
-    "host": "localhost",
-    "port": 5432,
-    "dbname": "taxi",
-    "user": "postgres",
-    "password": "123"
-}
+from arrival_rates import N_ZONES, get_arrival_rates, query_arrival_rates, time_slot
+from backends import SqlStep, TableStep, gather, stepwise
+from complaints import CATEGORIES, complaint_stats, descriptor_summary, load_points
+from heatgrid import get_heat_grid
+from metrics import timed
+from fare_matrix import get_fare_matrix, query_fare_stats
+from partitions import normalize_window, window_condition
+from quantiles import get_quantile_sketches, label_bands, od_key, query_od_bands
+from rollup import rollup_source
+from sample import estimator
+from timeseries import timeline
+from topk import top_routes
+from zones import get_zone_directory
 
-# MongoDB 配置
-MONGO_URI = "mongodb://localhost:27017/"
-MONGO_DB = "nyc311"
-MONGO_COLLECTION = "requests"
+# 仪表板的汇总查询读取预聚合立方体 trip_rollup（由 rollup.py 在导入数据后构建），
+# 而不是每次扫描 yellow_taxi_clean 全表；区域 / 时段面板的 p50 / p90 来自常驻内存的分位数摘要（quantiles.py）
 
-def get_connection():
-    """获取数据库连接"""
-    return psycopg.connect(**PG_CONFIG)
+PAYMENT_METHODS = {1: 'Credit Card', 2: 'Cash', 3: 'No Charge', 4: 'Dispute'}
+DAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
 
 # ============== Business Dashboard 1: Taxi Company Dashboard ==============
 
-def get_revenue_summary():
+@stepwise
+def get_revenue_summary(start=None, end=None):
     """获取收入总览"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
-        COUNT(*) as total_trips,
-        SUM(fare_amount) as total_fare,
-        SUM(tip_amount) as total_tips,
-        SUM(tolls_amount) as total_tolls,
-        SUM(total_amount) as total_revenue,
-        AVG(trip_distance) as avg_distance,
-        AVG(fare_amount) as avg_fare,
-        SUM(CASE WHEN payment_type = 1 THEN total_amount ELSE 0 END) as credit_card_revenue,
-        SUM(CASE WHEN payment_type = 2 THEN total_amount ELSE 0 END) as cash_revenue
-    FROM yellow_taxi_clean
-    WHERE total_amount > 0 AND fare_amount > 0;
+        SUM(trip_count)::bigint as total_trips,
+        SUM(fare_sum) as total_fare,
+        SUM(tip_sum) as total_tips,
+        SUM(tolls_sum) as total_tolls,
+        SUM(total_sum) as total_revenue,
+        SUM(distance_sum) / NULLIF(SUM(distance_trips), 0) as avg_distance,
+        SUM(fare_sum) / NULLIF(SUM(trip_count), 0) as avg_fare,
+        SUM(CASE WHEN payment_type = 1 THEN total_sum ELSE 0 END) as credit_card_revenue,
+        SUM(CASE WHEN payment_type = 2 THEN total_sum ELSE 0 END) as cash_revenue
+    FROM {source}
+    WHERE {window} AND amount_flag = 2;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')[0]
+    return (yield TableStep(query, params))[0]
 
 def get_revenue_by_distance():
     """收入与距离关系 - 已移除，改为费用计算器"""
     # 此函数已被 get_fare_estimate 替代
     pass
 
+@timed
 def get_all_zones():
     """获取所有区域列表（用于下拉选择）"""
-    query = """
-    SELECT 
-        "LocationID" as locationid,
-        "Zone" as zone,
-        "Borough" as borough
-    FROM taxi_zone_lookup
-    ORDER BY "Zone";
+    return get_zone_directory().records()
+
+@stepwise
+def get_fare_estimate(pickup_zone_id, dropoff_zone_id, start=None, end=None, approx=False):
     """
-    try:
-        with get_connection() as conn:
-            df = pd.read_sql(query, conn)
-            return df.to_dict('records')
-    except Exception as e:
-        print(f"Error in get_all_zones: {e}")
-        # 尝试小写列名
-        try:
-            query_lower = """
-            SELECT 
-                locationid,
-                zone,
-                borough
-            FROM taxi_zone_lookup
-            ORDER BY zone;
-            """
-            with get_connection() as conn:
-                df = pd.read_sql(query_lower, conn)
-                return df.to_dict('records')
-        except Exception as e2:
-            print(f"Error with lowercase columns: {e2}")
-            raise
-
-def get_fare_estimate(pickup_zone_id, dropoff_zone_id):
-    """根据起点和终点估算费用"""
-    query = """
-    SELECT 
-        COUNT(*) as trip_count,
-        AVG(fare_amount) as avg_fare,
-        MIN(fare_amount) as min_fare,
-        MAX(fare_amount) as max_fare,
-        AVG(trip_distance) as avg_distance,
-        AVG(EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60) as avg_duration_min,
-        AVG(total_amount) as avg_total,
-        AVG(tip_amount) as avg_tip
-    FROM yellow_taxi_clean
-    WHERE pulocationid = %s 
-        AND dolocationid = %s
-        AND fare_amount > 0
-        AND total_amount > 0;
+    根据起点和终点估算费用（读取内存中的 OD 费用矩阵和分位数摘要，指定时间窗口时查询明细表）
+
+    p50_* / p90_* 是费用、总价、小费、时长的分位数（相对误差见 QUANTILE_CONFIG）；
+    approx=True 只影响带时间窗口的查询：改为在分层样本上估计，并返回置信区间
     """
     try:
-        with get_connection() as conn:
-            result = pd.read_sql(query, conn, params=(pickup_zone_id, dropoff_zone_id))
-            
-            if len(result) > 0 and result['trip_count'].iloc[0] > 0:
-                data = result.to_dict('records')[0]
-                
-                # 获取区域名称 - 尝试大写列名
-                try:
-                    zone_query = """
-                    SELECT "LocationID" as locationid, "Zone" as zone, "Borough" as borough 
-                    FROM taxi_zone_lookup 
-                    WHERE "LocationID" IN (%s, %s);
-                    """
-                    zones = pd.read_sql(zone_query, conn, params=(pickup_zone_id, dropoff_zone_id))
-                except:
-                    # 如果失败，尝试小写
-                    zone_query = """
-                    SELECT locationid, zone, borough 
-                    FROM taxi_zone_lookup 
-                    WHERE locationid IN (%s, %s);
-                    """
-                    zones = pd.read_sql(zone_query, conn, params=(pickup_zone_id, dropoff_zone_id))
-                
-                pickup_info = zones[zones['locationid'] == pickup_zone_id].iloc[0] if len(zones[zones['locationid'] == pickup_zone_id]) > 0 else None
-                dropoff_info = zones[zones['locationid'] == dropoff_zone_id].iloc[0] if len(zones[zones['locationid'] == dropoff_zone_id]) > 0 else None
-                
-                return {
-                    'success': True,
-                    'pickup_zone': pickup_info['zone'] if pickup_info is not None else f'Zone {pickup_zone_id}',
-                    'pickup_borough': pickup_info['borough'] if pickup_info is not None else 'Unknown',
-                    'dropoff_zone': dropoff_info['zone'] if dropoff_info is not None else f'Zone {dropoff_zone_id}',
-                    'dropoff_borough': dropoff_info['borough'] if dropoff_info is not None else 'Unknown',
-                    'trip_count': int(data['trip_count']),
-                    'avg_fare': float(data['avg_fare']),
-                    'min_fare': float(data['min_fare']),
-                    'max_fare': float(data['max_fare']),
-                    'avg_distance': float(data['avg_distance']),
-                    'avg_duration_min': float(data['avg_duration_min']) if data['avg_duration_min'] else 0,
-                    'avg_total': float(data['avg_total']),
-                    'avg_tip': float(data['avg_tip'])
-                }
-            else:
-                return {
-                    'success': False,
-                    'message': 'No historical data found for this route'
-                }
+        if start is None and end is None:
+            data = get_fare_matrix().lookup(pickup_zone_id, dropoff_zone_id)
+            bands = get_quantile_sketches().bands("od", od_key(pickup_zone_id, dropoff_zone_id)) if data else None
+        else:
+            data, bands = yield from gather(
+                query_fare_stats.steps(pickup_zone_id, dropoff_zone_id, start, end, approx),
+                query_od_bands.steps(pickup_zone_id, dropoff_zone_id, start, end, approx)
+            )
+            if approx and data is not None and not data.get('approximate'):
+                # 样本里没有这个 OD 对，费用已改为精确查询，分位数也一样
+                bands = yield from query_od_bands.steps(pickup_zone_id, dropoff_zone_id, start, end)
+        if data is None:
+            return {
+                'success': False,
+                'message': 'No historical data found for this route'
+            }
+        
+        zones = get_zone_directory()
+        
+        result = {
+            'success': True,
+            'pickup_zone': zones.name(pickup_zone_id),
+            'pickup_borough': zones.borough(pickup_zone_id),
+            'dropoff_zone': zones.name(dropoff_zone_id),
+            'dropoff_borough': zones.borough(dropoff_zone_id),
+            'trip_count': data['trip_count'],
+            'avg_fare': data['avg_fare'],
+            'min_fare': data['min_fare'],
+            'max_fare': data['max_fare'],
+            'avg_distance': data['avg_distance'],
+            'avg_duration_min': data['avg_duration_min'] if pd.notna(data['avg_duration_min']) else 0,
+            'avg_total': data['avg_total'],
+            'avg_tip': data['avg_tip']
+        }
+        result.update(bands)
+        if data.get('approximate'):
+            # 置信区间和样本行数
+            result.update({k: v for k, v in data.items() if k not in result})
+        return result
     except Exception as e:
         print(f"Error in get_fare_estimate: {e}")
         return {
@@ -154,9 +111,11 @@ def get_fare_estimate(pickup_zone_id, dropoff_zone_id):
             'message': f'Error: {str(e)}'
         }
 
-def get_payment_breakdown():
+@stepwise
+def get_payment_breakdown(start=None, end=None):
     """支付方式分布"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
         CASE payment_type
             WHEN 1 THEN 'Credit Card'
@@ -165,130 +124,258 @@ def get_payment_breakdown():
             WHEN 4 THEN 'Dispute'
             ELSE 'Other'
         END as payment_method,
-        COUNT(*) as trip_count,
-        SUM(total_amount) as revenue,
-        AVG(tip_amount) as avg_tip
-    FROM yellow_taxi_clean
-    WHERE total_amount > 0
+        SUM(trip_count)::bigint as trip_count,
+        SUM(total_sum) as revenue,
+        SUM(tip_sum) / SUM(trip_count) as avg_tip
+    FROM {source}
+    WHERE {window} AND amount_flag >= 1
     GROUP BY payment_type
     ORDER BY revenue DESC;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    return (yield TableStep(query, params))
 
-def get_top_pickup_zones():
+@stepwise
+def get_top_pickup_zones(start=None, end=None):
     """最高收入上车区域 Top 10"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
         pulocationid as zone_id,
-        COUNT(*) as trip_count,
-        SUM(total_amount) as total_revenue,
-        AVG(fare_amount) as avg_fare,
-        AVG(trip_distance) as avg_distance
-    FROM yellow_taxi_clean
-    WHERE pulocationid IS NOT NULL AND total_amount > 0
+        SUM(trip_count)::bigint as trip_count,
+        SUM(total_sum) as total_revenue,
+        SUM(fare_sum) / SUM(trip_count) as avg_fare,
+        SUM(distance_sum) / NULLIF(SUM(distance_trips), 0) as avg_distance
+    FROM {source}
+    WHERE {window} AND pulocationid IS NOT NULL AND amount_flag >= 1
     GROUP BY pulocationid
-    ORDER BY total_revenue DESC
+    ORDER BY total_revenue DESC, zone_id
     LIMIT 10;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    records = label_bands((yield TableStep(query, params)), 'zone', 'zone_id', start, end)
+    return get_zone_directory().label(records, 'zone_id', 'zone_name', 'borough')
 
-def get_surcharge_analysis():
+@stepwise
+def get_surcharge_analysis(start=None, end=None):
     """附加费用分析"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
-        COUNT(*) as total_trips,
-        SUM(CASE WHEN congestion_surcharge > 0 THEN 1 ELSE 0 END) as congestion_trips,
-        SUM(congestion_surcharge) as total_congestion,
-        SUM(extra) as total_extra,
-        SUM(mta_tax) as total_mta_tax,
-        SUM(improvement_surcharge) as total_improvement,
-        AVG(CASE WHEN congestion_surcharge > 0 THEN congestion_surcharge END) as avg_congestion
-    FROM yellow_taxi_clean
-    WHERE total_amount > 0;
+        SUM(trip_count)::bigint as total_trips,
+        SUM(congestion_trips)::bigint as congestion_trips,
+        SUM(congestion_sum) as total_congestion,
+        SUM(extra_sum) as total_extra,
+        SUM(mta_tax_sum) as total_mta_tax,
+        SUM(improvement_sum) as total_improvement,
+        SUM(congestion_pos_sum) / NULLIF(SUM(congestion_trips), 0) as avg_congestion
+    FROM {source}
+    WHERE {window} AND amount_flag >= 1;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')[0]
+    return (yield TableStep(query, params))[0]
 
-def get_hourly_demand():
+@stepwise
+def get_hourly_demand(start=None, end=None):
     """按小时的需求分析"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
-        EXTRACT(HOUR FROM tpep_pickup_datetime) as hour,
-        COUNT(*) as trip_count,
-        SUM(total_amount) as revenue,
-        AVG(fare_amount) as avg_fare
-    FROM yellow_taxi_clean
-    WHERE tpep_pickup_datetime IS NOT NULL AND total_amount > 0
+        pickup_hour as hour,
+        SUM(trip_count)::bigint as trip_count,
+        SUM(total_sum) as revenue,
+        SUM(fare_sum) / SUM(trip_count) as avg_fare
+    FROM {source}
+    WHERE {window} AND pickup_hour IS NOT NULL AND amount_flag >= 1
     GROUP BY hour
     ORDER BY hour;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    return label_bands((yield TableStep(query, params)), 'hour', 'hour', start, end)
+
+@stepwise
+def get_company_dashboard_bundle(start=None, end=None):
+    """公司仪表板所有面板：一次扫描 trip_rollup，用 GROUPING SETS 同时算出各面板"""
+    source, window, params = rollup_source(start, end)
+    query = f"""
+    SELECT 
+        GROUPING(payment_type, pulocationid, pickup_hour) as grouping_id,
+        payment_type,
+        pulocationid,
+        pickup_hour,
+        SUM(trip_count)::bigint as trip_count,
+        SUM(total_sum) as total_sum,
+        SUM(fare_sum) as fare_sum,
+        SUM(tip_sum) as tip_sum,
+        SUM(distance_sum) as distance_sum,
+        SUM(distance_trips)::bigint as distance_trips,
+        SUM(trip_count) FILTER (WHERE amount_flag = 2)::bigint as paid_trips,
+        SUM(fare_sum) FILTER (WHERE amount_flag = 2) as paid_fare,
+        SUM(tip_sum) FILTER (WHERE amount_flag = 2) as paid_tips,
+        SUM(tolls_sum) FILTER (WHERE amount_flag = 2) as paid_tolls,
+        SUM(total_sum) FILTER (WHERE amount_flag = 2) as paid_total,
+        SUM(distance_sum) FILTER (WHERE amount_flag = 2) as paid_distance,
+        SUM(distance_trips) FILTER (WHERE amount_flag = 2)::bigint as paid_distance_trips,
+        SUM(total_sum) FILTER (WHERE amount_flag = 2 AND payment_type = 1) as paid_credit_card,
+        SUM(total_sum) FILTER (WHERE amount_flag = 2 AND payment_type = 2) as paid_cash,
+        SUM(congestion_trips)::bigint as congestion_trips,
+        SUM(congestion_sum) as congestion_sum,
+        SUM(congestion_pos_sum) as congestion_pos_sum,
+        SUM(extra_sum) as extra_sum,
+        SUM(mta_tax_sum) as mta_tax_sum,
+        SUM(improvement_sum) as improvement_sum
+    FROM {source}
+    WHERE {window} AND amount_flag >= 1
+    GROUP BY GROUPING SETS ((), (payment_type), (pulocationid), (pickup_hour));
+    """
+    df = yield SqlStep(query, params)
+    
+    # GROUPING() 位掩码：未参与分组的列对应位为 1
+    total = df[df['grouping_id'] == 7]
+    by_payment = df[df['grouping_id'] == 3]
+    by_zone = df[(df['grouping_id'] == 5) & df['pulocationid'].notna()]
+    by_hour = df[(df['grouping_id'] == 6) & df['pickup_hour'].notna()]
+    
+    t = total.iloc[0] if len(total) > 0 else pd.Series(dtype=float)
+    paid_trips = t.get('paid_trips', 0) if pd.notna(t.get('paid_trips')) else 0
+    congestion_trips = t.get('congestion_trips', 0) if pd.notna(t.get('congestion_trips')) else 0
+    paid_distance_trips = t.get('paid_distance_trips', 0) if pd.notna(t.get('paid_distance_trips')) else 0
+    revenue_summary = {
+        'total_trips': int(paid_trips),
+        'total_fare': _num(t.get('paid_fare')),
+        'total_tips': _num(t.get('paid_tips')),
+        'total_tolls': _num(t.get('paid_tolls')),
+        'total_revenue': _num(t.get('paid_total')),
+        'avg_distance': _num(t['paid_distance'] / paid_distance_trips) if paid_distance_trips else None,
+        'avg_fare': _num(t['paid_fare'] / paid_trips) if paid_trips else None,
+        'credit_card_revenue': _num(t.get('paid_credit_card')) or 0,
+        'cash_revenue': _num(t.get('paid_cash')) or 0
+    }
+    surcharges = {
+        'total_trips': int(t.get('trip_count', 0)),
+        'congestion_trips': int(congestion_trips),
+        'total_congestion': _num(t.get('congestion_sum')),
+        'total_extra': _num(t.get('extra_sum')),
+        'total_mta_tax': _num(t.get('mta_tax_sum')),
+        'total_improvement': _num(t.get('improvement_sum')),
+        'avg_congestion': _num(t['congestion_pos_sum'] / congestion_trips) if congestion_trips else None
+    }
+    payment_breakdown = [
+        {
+            'payment_method': PAYMENT_METHODS.get(r.payment_type, 'Other'),
+            'trip_count': int(r.trip_count),
+            'revenue': r.total_sum,
+            'avg_tip': r.tip_sum / r.trip_count
+        }
+        for r in by_payment.sort_values('total_sum', ascending=False).itertuples()
+    ]
+    top_zones = [
+        {
+            'zone_id': int(r.pulocationid),
+            'trip_count': int(r.trip_count),
+            'total_revenue': r.total_sum,
+            'avg_fare': r.fare_sum / r.trip_count,
+            'avg_distance': r.distance_sum / r.distance_trips if r.distance_trips else None
+        }
+        for r in by_zone.sort_values(['total_sum', 'pulocationid'], ascending=[False, True]).head(10).itertuples()
+    ]
+    hourly_demand = [
+        {
+            'hour': int(r.pickup_hour),
+            'trip_count': int(r.trip_count),
+            'revenue': r.total_sum,
+            'avg_fare': r.fare_sum / r.trip_count
+        }
+        for r in by_hour.sort_values('pickup_hour').itertuples()
+    ]
+    return {
+        'revenue_summary': revenue_summary,
+        'payment_breakdown': payment_breakdown,
+        'top_zones': get_zone_directory().label(label_bands(top_zones, 'zone', 'zone_id', start, end),
+                                                'zone_id', 'zone_name', 'borough'),
+        'hourly_demand': label_bands(hourly_demand, 'hour', 'hour', start, end),
+        'surcharges': surcharges
+    }
 
 # ============== Business Dashboard 2: Public Riders Dashboard ==============
 
-def get_busiest_pickup_zones():
+@stepwise
+def get_busiest_pickup_zones(start=None, end=None):
     """最繁忙的上车区域"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
         pulocationid as zone_id,
-        COUNT(*) as trip_count,
-        AVG(fare_amount) as avg_fare,
-        AVG(trip_distance) as avg_distance
-    FROM yellow_taxi_clean
-    WHERE pulocationid IS NOT NULL
+        SUM(trip_count)::bigint as trip_count,
+        SUM(fare_sum) / SUM(trip_count) as avg_fare,
+        SUM(distance_sum) / NULLIF(SUM(distance_trips), 0) as avg_distance
+    FROM {source}
+    WHERE {window} AND pulocationid IS NOT NULL
     GROUP BY pulocationid
-    ORDER BY trip_count DESC
+    ORDER BY trip_count DESC, zone_id
     LIMIT 15;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    records = label_bands((yield TableStep(query, params)), 'zone', 'zone_id', start, end)
+    return get_zone_directory().label(records, 'zone_id', 'zone_name', 'borough')
+
+@stepwise
+def get_popular_routes(start=None, end=None, approx=False):
+    """
+    最热门路线 Top 10 (起点-终点对)
 
-def get_popular_routes():
-    """最热门路线 Top 10 (起点-终点对)"""
-    query = """
+    默认合并每月的 top-K 摘要（topk.py），trip_count 是上界，trip_count_error 是最大高估量；
+    approx=True 时在分层样本上估计并给出置信区间
+    """
+    if not approx:
+        records = yield from top_routes.steps(start, end, limit=10)
+        zones = get_zone_directory()
+        zones.label(records, 'pickup_zone', 'pickup_zone_name', 'pickup_borough')
+        return zones.label(records, 'dropoff_zone', 'dropoff_zone_name', 'dropoff_borough')
+    window, params = window_condition("tpep_pickup_datetime", *normalize_window(start, end))
+    est = estimator(approx)
+    query = f"""
     SELECT 
         pulocationid as pickup_zone,
         dolocationid as dropoff_zone,
-        COUNT(*) as trip_count,
-        AVG(fare_amount) as avg_fare,
-        AVG(trip_distance) as avg_distance,
-        AVG(EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60) as avg_duration_min
-    FROM yellow_taxi_clean
+        {est.count('trip_count')},
+        {est.avg('avg_fare', 'fare_amount')},
+        {est.avg('avg_distance', 'trip_distance')},
+        {est.avg('avg_duration_min', 'EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60')}
+    FROM {est.source}
     WHERE pulocationid IS NOT NULL 
         AND dolocationid IS NOT NULL
         AND tpep_pickup_datetime IS NOT NULL
         AND tpep_dropoff_datetime IS NOT NULL
+        AND {window}
     GROUP BY pulocationid, dolocationid
-    ORDER BY trip_count DESC
+    ORDER BY trip_count DESC, pickup_zone, dropoff_zone
     LIMIT 10;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    records = est.finish((yield TableStep(query, params)))
+    zones = get_zone_directory()
+    zones.label(records, 'pickup_zone', 'pickup_zone_name', 'pickup_borough')
+    return zones.label(records, 'dropoff_zone', 'dropoff_zone_name', 'dropoff_borough')
 
-def get_demand_by_hour():
+@stepwise
+def get_demand_by_hour(start=None, end=None):
     """各时段需求分布"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
-        EXTRACT(HOUR FROM tpep_pickup_datetime) as hour,
-        COUNT(*) as trip_count,
-        AVG(passenger_count) as avg_passengers
-    FROM yellow_taxi_clean
-    WHERE tpep_pickup_datetime IS NOT NULL
+        pickup_hour as hour,
+        SUM(trip_count)::bigint as trip_count,
+        SUM(passenger_sum) / NULLIF(SUM(passenger_trips), 0) as avg_passengers
+    FROM {source}
+    WHERE {window} AND pickup_hour IS NOT NULL
     GROUP BY hour
     ORDER BY hour;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    return label_bands((yield TableStep(query, params)), 'hour', 'hour', start, end)
 
-def get_demand_by_day():
+@stepwise
+def get_demand_by_day(start=None, end=None):
     """各星期几需求分布"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
-        EXTRACT(DOW FROM tpep_pickup_datetime) as day_of_week,
-        CASE EXTRACT(DOW FROM tpep_pickup_datetime)
+        pickup_dow as day_of_week,
+        CASE pickup_dow
             WHEN 0 THEN 'Sunday'
             WHEN 1 THEN 'Monday'
             WHEN 2 THEN 'Tuesday'
@@ -297,140 +384,190 @@ def get_demand_by_day():
             WHEN 5 THEN 'Friday'
             WHEN 6 THEN 'Saturday'
         END as day_name,
-        COUNT(*) as trip_count
-    FROM yellow_taxi_clean
-    WHERE tpep_pickup_datetime IS NOT NULL
+        SUM(trip_count)::bigint as trip_count
+    FROM {source}
+    WHERE {window} AND pickup_dow IS NOT NULL
     GROUP BY day_of_week, day_name
     ORDER BY day_of_week;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    return (yield TableStep(query, params))
 
-def get_zone_activity_heatmap():
+@stepwise
+def get_zone_activity_heatmap(start=None, end=None):
     """区域活跃度热图数据"""
-    query = """
+    source, window, params = rollup_source(start, end)
+    query = f"""
     SELECT 
         pulocationid as zone_id,
-        EXTRACT(HOUR FROM tpep_pickup_datetime) as hour,
-        COUNT(*) as trip_count
-    FROM yellow_taxi_clean
-    WHERE pulocationid IS NOT NULL 
-        AND tpep_pickup_datetime IS NOT NULL
+        pickup_hour as hour,
+        SUM(trip_count)::bigint as trip_count
+    FROM {source}
+    WHERE {window} AND pulocationid IS NOT NULL 
+        AND pickup_hour IS NOT NULL
     GROUP BY pulocationid, hour
-    HAVING COUNT(*) > 10
+    HAVING SUM(trip_count) > 10
     ORDER BY zone_id, hour;
     """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+    return (yield TableStep(query, params))
+
+@stepwise
+def estimate_wait_time_by_zone(zone_id=None, at=None, start=None, end=None):
+    """
+    估算某个时刻的等待时间（区域 × 星期 × 小时 的上车到达率模型，见 arrival_rates.py）
 
-def estimate_wait_time_by_zone(zone_id=None):
-    """估算等待时间（基于区域的出行频率）"""
+    参数:
+        zone_id: 区域编号；不指定时返回该时段上车速率最高的 20 个区域
+        at: 时刻（datetime），默认当前时间，只用到星期几和小时
+        start, end: 只用这段时间的数据估计到达率（读 trip_rollup），默认用内存中的全部数据模型
+    """
+    dow, hour = time_slot(at or datetime.now())
+    if start is None and end is None:
+        model = get_arrival_rates()
+    else:
+        model = yield from query_arrival_rates.steps(start, end)
     if zone_id:
-        query = f"""
-        SELECT 
-            pulocationid as zone_id,
-            COUNT(*) as trips_per_hour,
-            CASE 
-                WHEN COUNT(*) > 100 THEN 'Very Short (< 3 min)'
-                WHEN COUNT(*) > 50 THEN 'Short (3-5 min)'
-                WHEN COUNT(*) > 20 THEN 'Medium (5-10 min)'
-                ELSE 'Long (10+ min)'
-            END as estimated_wait
-        FROM yellow_taxi_clean
-        WHERE pulocationid = {zone_id}
-        GROUP BY pulocationid;
-        """
+        if not 0 < zone_id < N_ZONES:
+            return []
+        records = [model.wait(zone_id, dow, hour, detail=True)]
     else:
-        query = """
-        SELECT 
-            pulocationid as zone_id,
-            COUNT(*) as trips_per_hour,
-            CASE 
-                WHEN COUNT(*) > 100 THEN 'Very Short'
-                WHEN COUNT(*) > 50 THEN 'Short'
-                WHEN COUNT(*) > 20 THEN 'Medium'
-                ELSE 'Long'
-            END as estimated_wait
-        FROM yellow_taxi_clean
-        WHERE pulocationid IS NOT NULL
-        GROUP BY pulocationid
-        ORDER BY trips_per_hour DESC
-        LIMIT 20;
-        """
-    with get_connection() as conn:
-        return pd.read_sql(query, conn).to_dict('records')
+        records = model.busiest(dow, hour, limit=20)
+    return get_zone_directory().label(records, 'zone_id', 'zone_name', 'borough')
 
-# ============== NYC 311 Complaints Heatmap ==============
+@stepwise
+def get_demand_timeline(start=None, end=None, zone_id=None, borough=None, metric='trip_count', max_points=None):
+    """
+    行程数 / 收入 / 平均车费随时间的变化（读多分辨率时间序列 trip_series，见 timeseries.py）
 
-def classify_descriptor(desc):
-    """分类投诉描述"""
-    desc = str(desc).lower()
-    if "driver complaint" in desc or "driver report" in desc:
-        return "Driver Behavior Issues"
-    elif "vehicle complaint" in desc:
-        return "Vehicle Issues"
-    elif "car service company" in desc:
-        return "Company Service Issues"
-    else:
-        return "Other"
+    参数:
+        zone_id / borough: 只看某个上车区域 / 行政区，默认全市
+        metric: 降采样时保留形状的指标：trip_count、revenue 或 avg_fare
+        max_points: 最多返回的点数，默认 TIMESERIES_CONFIG["max_points"]
+    """
+    result = yield from timeline.steps(start, end, zone_id, borough, metric, max_points)
+    if zone_id is not None:
+        zones = get_zone_directory()
+        result.update({'zone_id': zone_id, 'zone_name': zones.name(zone_id), 'borough': zones.borough(zone_id)})
+    elif borough is not None:
+        result['borough'] = borough
+    return result
+
+@stepwise
+def get_public_dashboard_bundle(start=None, end=None):
+    """公众仪表板的区域 / 时段 / 星期面板：一次扫描 trip_rollup；等待时间面板读到达率模型"""
+    source, window, params = rollup_source(start, end)
+    query = f"""
+    SELECT 
+        GROUPING(pulocationid, pickup_hour, pickup_dow) as grouping_id,
+        pulocationid,
+        pickup_hour,
+        pickup_dow,
+        SUM(trip_count)::bigint as trip_count,
+        SUM(fare_sum) as fare_sum,
+        SUM(distance_sum) as distance_sum,
+        SUM(distance_trips)::bigint as distance_trips,
+        SUM(passenger_sum) as passenger_sum,
+        SUM(passenger_trips)::bigint as passenger_trips
+    FROM {source}
+    WHERE {window}
+    GROUP BY GROUPING SETS ((pulocationid), (pickup_hour), (pickup_dow));
+    """
+    df = yield SqlStep(query, params)
+    # 等待时间面板：当前星期 / 小时的到达率模型（与 /api/public/wait-times 相同），有窗口时用窗口内的数据估计；
+    # 模型不可用时只有这个面板为空，其余面板照常返回
+    try:
+        wait_times = yield from estimate_wait_time_by_zone.steps(start=start, end=end)
+    except Exception as e:
+        print(f"Arrival rates unavailable, wait-time panel left empty: {e}")
+        wait_times = []
+    
+    by_zone = df[(df['grouping_id'] == 3) & df['pulocationid'].notna()].sort_values(
+        ['trip_count', 'pulocationid'], ascending=[False, True])
+    by_hour = df[(df['grouping_id'] == 5) & df['pickup_hour'].notna()].sort_values('pickup_hour')
+    by_day = df[(df['grouping_id'] == 6) & df['pickup_dow'].notna()].sort_values('pickup_dow')
+    
+    zones = get_zone_directory()
+    busiest_zones = [
+        {
+            'zone_id': int(r.pulocationid),
+            'trip_count': int(r.trip_count),
+            'avg_fare': r.fare_sum / r.trip_count,
+            'avg_distance': r.distance_sum / r.distance_trips if r.distance_trips else None
+        }
+        for r in by_zone.head(15).itertuples()
+    ]
+    demand_by_hour = [
+        {
+            'hour': int(r.pickup_hour),
+            'trip_count': int(r.trip_count),
+            'avg_passengers': r.passenger_sum / r.passenger_trips if r.passenger_trips else None
+        }
+        for r in by_hour.itertuples()
+    ]
+    demand_by_day = [
+        {
+            'day_of_week': int(r.pickup_dow),
+            'day_name': DAY_NAMES[int(r.pickup_dow)],
+            'trip_count': int(r.trip_count)
+        }
+        for r in by_day.itertuples()
+    ]
+    return {
+        'busiest_zones': zones.label(label_bands(busiest_zones, 'zone', 'zone_id', start, end),
+                                     'zone_id', 'zone_name', 'borough'),
+        'demand_by_hour': label_bands(demand_by_hour, 'hour', 'hour', start, end),
+        'demand_by_day': demand_by_day,
+        'wait_times': wait_times
+    }
+
+def _num(value):
+    """numpy / NaN 转为可 JSON 序列化的 float 或 None"""
+    return float(value) if pd.notna(value) else None
+
+# ============== NYC 311 Complaints Heatmap ==============
 
-def generate_311_heatmap(limit=200000):
+@timed
+def generate_311_heatmap(limit=200000, start=None, end=None):
     """生成 NYC 311 投诉热点图（带分类图层）"""
     try:
-        # 连接 MongoDB
-        client = MongoClient(MONGO_URI)
-        db = client[MONGO_DB]
-        collection = db[MONGO_COLLECTION]
-        
-        # 获取数据（包含 descriptor）
-        cursor = collection.find(
-            {}, 
-            {"latitude": 1, "longitude": 1, "descriptor": 1, "_id": 0}
-        ).limit(limit)
-        df = pd.DataFrame(list(cursor))
-        
-        # 数据清洗
-        df = df.dropna(subset=["latitude", "longitude"])
-        df = df[(df.latitude > 35) & (df.latitude < 45)]
-        df = df[(df.longitude > -80) & (df.longitude < -70)]
-        
-        # 分类
-        df["category"] = df["descriptor"].apply(classify_descriptor)
+        # 过滤、清洗和分类都在 MongoDB 聚合管道里完成，这里只拿到坐标和小类编号
+        lat, lon, desc_codes, desc_names, desc_category = load_points(
+            *normalize_window(start, end), limit=limit
+        )
+        points = np.column_stack([lat, lon])
+        cat_codes = desc_category[desc_codes]
+        cat_counts = np.bincount(cat_codes, minlength=len(CATEGORIES))
+        desc_counts = np.bincount(desc_codes, minlength=len(desc_names))
         
         # 初始化地图
         m = folium.Map(location=[40.7128, -74.0060], zoom_start=11)
         
         # 1. Overall 图层
         HeatMap(
-            df[['latitude', 'longitude']].values.tolist(),
+            points.tolist(),
             radius=8,
             blur=6,
             name="Overall Hotspot"
         ).add_to(m)
         
         # 2. 大类图层
-        for cat in df["category"].unique():
-            sub_df = df[df["category"] == cat].dropna(subset=["latitude", "longitude"])
-            
-            if len(sub_df) == 0:
+        for i, cat in enumerate(CATEGORIES):
+            if cat_counts[i] == 0:
                 continue
             
             HeatMap(
-                sub_df[['latitude', 'longitude']].values.tolist(),
+                points[cat_codes == i].tolist(),
                 radius=8,
                 blur=6,
                 name=f"Category: {cat}"
             ).add_to(m)
         
         # 3. 小类 Descriptor 图层
-        for desc in df["descriptor"].unique():
-            sub_df = df[df["descriptor"] == desc].dropna(subset=["latitude", "longitude"])
-            
-            if len(sub_df) < 10:
+        for i, desc in enumerate(desc_names):
+            if desc_counts[i] < 10:
                 continue
             
             HeatMap(
-                sub_df[['latitude', 'longitude']].values.tolist(),
+                points[desc_codes == i].tolist(),
                 radius=8,
                 blur=6,
                 name=f"Descriptor: {desc}"
@@ -444,32 +581,61 @@ def generate_311_heatmap(limit=200000):
         
         return {
             "success": True,
-            "total_complaints": len(df),
+            "total_complaints": len(points),
             "map_html": map_html,
-            "categories": df["category"].value_counts().to_dict()
+            "categories": {
+                CATEGORIES[i]: int(cat_counts[i])
+                for i in np.argsort(-cat_counts, kind="stable") if cat_counts[i]
+            }
+        }
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+@timed
+def get_311_heat_grid(zoom, bbox=None, layer="overall", start=None, end=None):
+    """311 投诉热力网格：指定缩放级别下 bbox 内的非空格子及投诉数"""
+    try:
+        grid = get_heat_grid(*normalize_window(start, end))
+        data = grid.query(zoom, bbox, layer)
+        data["success"] = True
+        return data
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
         }
+
+@timed
+def get_311_heat_layers(start=None, end=None):
+    """311 热力网格的图层列表、缩放范围和分类统计"""
+    try:
+        data = get_heat_grid(*normalize_window(start, end)).summary()
+        data["success"] = True
+        return data
     except Exception as e:
         return {
             "success": False,
             "error": str(e)
         }
 
-def get_311_stats():
+@stepwise
+def get_311_stats(start=None, end=None):
     """获取 311 投诉统计信息"""
     try:
-        client = MongoClient(MONGO_URI)
-        db = client[MONGO_DB]
-        collection = db[MONGO_COLLECTION]
-        
-        total = collection.count_documents({})
-        with_coords = collection.count_documents({
-            "latitude": {"$exists": True, "$ne": None},
-            "longitude": {"$exists": True, "$ne": None}
-        })
+        window = normalize_window(start, end)
+        # 总数和有坐标的投诉数在同一次聚合里统计；分类计数只含坐标有效的投诉（两个聚合互不依赖，可并发）
+        (total, with_coords), summary = yield from gather(
+            complaint_stats.steps(*window), descriptor_summary.steps(*window)
+        )
+        categories = {c: info["count"] for c, info in summary.items()}
         
         return {
             "total_complaints": total,
             "complaints_with_location": with_coords,
+            "categories": categories,
             "success": True
         }
     except Exception as e:
@@ -1,7 +1,108 @@
-from flask import Flask, render_template, jsonify
+import atexit
+
+import gzip
+import time
+from datetime import datetime
+
+from flask import Flask, render_template, jsonify, request, make_response, url_for, g
 import analysis
+import arrival_rates
+import db
+import metrics
+from cache import cached, response_cache
+from columnar import FastJSONProvider
+import fare_matrix
+import quantiles
+from jobs import runner, DONE, FAILED
+from backends import get_backend
+from config import QUERY_BACKEND
+from partitions import normalize_window
 
 app = Flask(__name__)
+# orjson 序列化；所有 JSON 接口支持 ?format=columns / ?format=arrow
+app.json = FastJSONProvider(app, request)
+
+# 启动时建立共享连接池，进程退出时关闭
+# （duckdb 后端直接读 parquet，PostgreSQL 连接池按需创建）
+if QUERY_BACKEND == 'postgres':
+    db.init_pools()
+atexit.register(db.close_pools)
+
+# 预加载 OD 费用矩阵，费用估算不再访问数据库
+# （磁盘文件记录了构建时的数据版本号，与当前后端的版本不一致时重新计算，例如 duckdb 的 parquet 有更新）
+try:
+    fare_matrix.load_fare_matrix()
+except Exception as e:
+    print(f"Fare matrix not loaded at startup: {e}")
+
+# 同样预加载分位数摘要（费用估算和区域 / 时段面板的 p50 / p90）
+try:
+    quantiles.load_quantile_sketches()
+except Exception as e:
+    print(f"Quantile sketches not loaded at startup: {e}")
+
+# 同样预加载上车到达率模型（等待时间估算）
+try:
+    arrival_rates.load_arrival_rates()
+except Exception as e:
+    print(f"Arrival rates not loaded at startup: {e}")
+
+class InvalidTimeWindow(ValueError):
+    """start / end 查询参数格式错误"""
+
+def _time_window():
+    """从查询参数读取时间窗口 [start, end)：ISO 日期或时间，例如 ?start=2024-01-01&end=2024-04-01"""
+    try:
+        start, end = normalize_window(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        raise InvalidTimeWindow(str(e))
+    return {'start': start, 'end': end}
+
+def _approx():
+    """?approx=true：在分层样本 trip_sample 上近似计算，结果带置信区间（只对扫描明细表的接口有效）"""
+    return request.args.get('approx', '').lower() in ('1', 'true', 'yes')
+
+@app.errorhandler(InvalidTimeWindow)
+def handle_invalid_window(e):
+    return jsonify({"error": f"Invalid start/end: {e}"}), 400
+
+# 每个路由的请求耗时（按路由模板统计，/api/jobs/status/<job_id> 不会按任务 id 展开）
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code,
+                                time.perf_counter() - g.request_started)
+    return response
+
+# 后台任务：耗时的计算在线程池里执行，结果按数据版本保存到磁盘
+runner.register('complaints_heatmap', analysis.generate_311_heatmap, '311')
+runner.register('company_bundle', analysis.get_company_dashboard_bundle, 'taxi')
+runner.register('public_bundle', analysis.get_public_dashboard_bundle, 'taxi')
+
+def _job_response(job):
+    """任务状态：完成前返回 202，客户端轮询 status_url"""
+    data = job.to_dict()
+    data['status_url'] = url_for('api_job_status', job_id=job.id)
+    data['result_url'] = url_for('api_job_result', job_id=job.id)
+    return jsonify(data), 200 if job.status in (DONE, FAILED) else 202
+
+def _artifact_response(job):
+    """返回任务结果：客户端支持 gzip 时直接发送磁盘上的压缩文件"""
+    body = runner.read_artifact(job)
+    if request.accept_encodings['gzip']:
+        response = make_response(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(gzip.decompress(body))
+    response.mimetype = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(job.id)
+    return response.make_conditional(request)
 
 # ============== 主页路由 ==============
 
@@ -18,10 +119,12 @@ def company_dashboard():
     return render_template('company_dashboard.html')
 
 @app.route('/api/company/revenue-summary')
+@cached('taxi')
 def api_revenue_summary():
     """收入总览 API"""
+    window = _time_window()
     try:
-        data = analysis.get_revenue_summary()
+        data = analysis.get_revenue_summary(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -32,6 +135,7 @@ def api_revenue_by_distance():
     return jsonify({"message": "This endpoint has been replaced by fare calculator"}), 404
 
 @app.route('/api/company/zones')
+@cached('zones')
 def api_zones():
     """获取所有区域列表 API"""
     try:
@@ -41,53 +145,73 @@ def api_zones():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/company/fare-estimate')
+@cached('taxi')
 def api_fare_estimate():
     """费用估算 API"""
+    window = _time_window()
     try:
-        from flask import request
         pickup = request.args.get('pickup', type=int)
         dropoff = request.args.get('dropoff', type=int)
         
         if not pickup or not dropoff:
             return jsonify({"error": "Missing pickup or dropoff zone ID"}), 400
         
-        data = analysis.get_fare_estimate(pickup, dropoff)
+        data = analysis.get_fare_estimate(pickup, dropoff, **window, approx=_approx())
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/company/payment-breakdown')
+@cached('taxi')
 def api_payment_breakdown():
     """支付方式分布 API"""
+    window = _time_window()
     try:
-        data = analysis.get_payment_breakdown()
+        data = analysis.get_payment_breakdown(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/company/top-zones')
+@cached('taxi')
 def api_top_zones():
     """最高收入区域 API"""
+    window = _time_window()
     try:
-        data = analysis.get_top_pickup_zones()
+        data = analysis.get_top_pickup_zones(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/company/surcharges')
+@cached('taxi')
 def api_surcharges():
     """附加费用分析 API"""
+    window = _time_window()
     try:
-        data = analysis.get_surcharge_analysis()
+        data = analysis.get_surcharge_analysis(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/company/hourly-demand')
+@cached('taxi')
 def api_hourly_demand():
     """按小时需求 API"""
+    window = _time_window()
     try:
-        data = analysis.get_hourly_demand()
+        data = analysis.get_hourly_demand(**window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/bundle')
+@cached('taxi')
+def api_company_bundle():
+    """公司仪表板全部面板（一次查询）API"""
+    window = _time_window()
+    try:
+        data = analysis.get_company_dashboard_bundle(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -100,55 +224,107 @@ def public_dashboard():
     return render_template('public_dashboard.html')
 
 @app.route('/api/public/busiest-zones')
+@cached('taxi')
 def api_busiest_zones():
     """最繁忙区域 API"""
+    window = _time_window()
     try:
-        data = analysis.get_busiest_pickup_zones()
+        data = analysis.get_busiest_pickup_zones(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/public/popular-routes')
+@cached('taxi')
 def api_popular_routes():
     """热门路线 API"""
+    window = _time_window()
     try:
-        data = analysis.get_popular_routes()
+        data = analysis.get_popular_routes(**window, approx=_approx())
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/public/demand-by-hour')
+@cached('taxi')
 def api_demand_by_hour():
     """各时段需求 API"""
+    window = _time_window()
     try:
-        data = analysis.get_demand_by_hour()
+        data = analysis.get_demand_by_hour(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/public/demand-by-day')
+@cached('taxi')
 def api_demand_by_day():
     """各星期需求 API"""
+    window = _time_window()
+    try:
+        data = analysis.get_demand_by_day(**window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/demand-timeline')
+@cached('taxi')
+def api_demand_timeline():
+    """
+    需求时间线 API：?zone=区域编号 或 ?borough=行政区，?metric=trip_count|revenue|avg_fare，?points=最多点数
+
+    按窗口长度和点数选择时间序列的分辨率（5 分钟 / 小时 / 天 / 周），再用 LTTB 降采样
+    """
+    window = _time_window()
+    zone = request.args.get('zone', type=int)
+    borough = request.args.get('borough')
+    metric = request.args.get('metric', 'trip_count')
+    points = request.args.get('points', type=int)
     try:
-        data = analysis.get_demand_by_day()
+        data = analysis.get_demand_timeline(**window, zone_id=zone, borough=borough, metric=metric, max_points=points)
         return jsonify(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/public/wait-times')
 def api_wait_times():
-    """等待时间估算 API"""
+    """
+    等待时间估算 API：?zone=区域编号&time=2024-03-01T18:30（time 默认当前时间）
+
+    到达率模型常驻内存，不指定 time 时结果随当前时间变化，所以不经过响应缓存
+    """
+    window = _time_window()
+    zone = request.args.get('zone', type=int)
     try:
-        data = analysis.estimate_wait_time_by_zone()
+        at = datetime.fromisoformat(request.args['time']) if request.args.get('time') else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid time: {e}"}), 400
+    try:
+        data = analysis.estimate_wait_time_by_zone(zone, at, **window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/public/zone-activity')
+@cached('taxi')
 def api_zone_activity():
     """区域活跃度 API"""
+    window = _time_window()
     try:
-        data = analysis.get_zone_activity_heatmap()
+        data = analysis.get_zone_activity_heatmap(**window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/bundle')
+@cached('taxi')
+def api_public_bundle():
+    """公众仪表板区域 / 时段 / 等待时间面板（一次查询）API"""
+    window = _time_window()
+    try:
+        data = analysis.get_public_dashboard_bundle(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -157,22 +333,124 @@ def api_zone_activity():
 
 @app.route('/api/complaints/heatmap')
 def api_complaints_heatmap():
-    """生成 311 投诉热点图 API"""
+    """生成 311 投诉热点图 API：在后台任务中生成，完成前返回 202 和任务状态"""
+    job = runner.submit('complaints_heatmap', _time_window())
+    if job.status == DONE:
+        return _artifact_response(job)
+    return _job_response(job)
+
+@app.route('/api/complaints/heat-layers')
+@cached('311')
+def api_complaints_heat_layers():
+    """311 热力网格图层列表 API"""
+    window = _time_window()
+    try:
+        data = analysis.get_311_heat_layers(**window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/complaints/heat-grid')
+@cached('311')
+def api_complaints_heat_grid():
+    """311 热力网格 API：?zoom=12&bbox=west,south,east,north&layer=overall"""
+    window = _time_window()
+    zoom = request.args.get('zoom', default=11, type=int)
+    layer = request.args.get('layer', default='overall')
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            bbox = [float(v) for v in bbox.split(',')]
+        except ValueError:
+            bbox = None
+        if bbox is None or len(bbox) != 4:
+            return jsonify({"error": "bbox must be west,south,east,north"}), 400
     try:
-        data = analysis.generate_311_heatmap()
+        data = analysis.get_311_heat_grid(zoom, bbox, layer, **window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/complaints/stats')
+@cached('311')
 def api_complaints_stats():
     """311 投诉统计 API"""
+    window = _time_window()
     try:
-        data = analysis.get_311_stats()
+        data = analysis.get_311_stats(**window)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ============== 后台任务路由 ==============
+
+@app.route('/api/jobs/<name>', methods=['POST'])
+def api_submit_job(name):
+    """提交后台任务 API：POST /api/jobs/company_bundle?start=2024-01-01"""
+    window = _time_window()
+    try:
+        job = runner.submit(name, window)
+    except KeyError:
+        return jsonify({"error": f"Unknown job '{name}'", "jobs": runner.names}), 404
+    return _job_response(job)
+
+@app.route('/api/jobs/status/<job_id>')
+def api_job_status(job_id):
+    """后台任务状态 API"""
+    job = runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return _job_response(job)
+
+@app.route('/api/jobs/result/<job_id>')
+def api_job_result(job_id):
+    """后台任务结果 API（gzip 压缩的 JSON）"""
+    job = runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    if job.status == FAILED:
+        return jsonify({"error": job.error}), 500
+    if job.status != DONE:
+        return _job_response(job)
+    return _artifact_response(job)
+
+# ============== 系统状态路由 ==============
+
+@app.route('/api/system/health')
+def api_health():
+    """数据库健康检查 API"""
+    if QUERY_BACKEND == 'postgres':
+        status = db.check_health()
+    else:
+        status = {QUERY_BACKEND: get_backend().health(), **db.check_health(postgres=False)}
+    ok = all(v == "ok" for v in status.values())
+    return jsonify(status), 200 if ok else 503
+
+@app.route('/api/system/pool-stats')
+def api_pool_stats():
+    """连接池统计 API"""
+    return jsonify(db.pool_stats())
+
+@app.route('/api/system/cache-stats')
+def api_cache_stats():
+    """响应缓存命中 / 淘汰统计 API"""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/system/job-stats')
+def api_job_stats():
+    """后台任务统计 API"""
+    return jsonify(runner.stats())
+
+@app.route('/api/system/slow-queries')
+def api_slow_queries():
+    """最近的慢查询（含参数和执行计划）API"""
+    return jsonify(metrics.slow_query_log.recent())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 指标"""
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
 # ============== 启动应用 ==============
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from backends import TableStep, get_backend, in_event_loop, stepwise
+from partitions import normalize_window, window_condition
+from rollup import rollup_source
+from timeseries import SERIES_TABLE
+from versions import get_version
+
+# 上车到达率：区域 × 星期 × 小时 的平均每小时上车次数（LocationID 为 1..265，下标 0 不使用；星期 0 = 周日）
+# 某区域在星期 d、小时 h 的上车总数 / 有数据的星期 d 的天数（每一天贡献一个这样的小时段）
+N_ZONES = 266
+ARRIVAL_RATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arrival_rates.npz")
+
+# 由 trip_rollup 聚合，不扫描明细表
+RATE_QUERY = """
+SELECT
+    pulocationid,
+    pickup_dow,
+    pickup_hour,
+    SUM(trip_count)::bigint as trip_count
+FROM {source}
+WHERE {window}
+    AND pulocationid BETWEEN 1 AND 265
+    AND pickup_dow IS NOT NULL
+    AND pickup_hour IS NOT NULL
+GROUP BY pulocationid, pickup_dow, pickup_hour;
+"""
+
+# 每个星期几有数据的天数：trip_series 里全市按天的桶（只数真正有行程的天，
+# 数据从月中开始或下个月只有零星几条时不会把整月的天数算进分母）
+DAYS_QUERY = f"""
+SELECT
+    EXTRACT(DOW FROM bucket_start)::integer as pickup_dow,
+    COUNT(DISTINCT bucket_start)::bigint as days
+FROM {SERIES_TABLE}
+WHERE resolution = 'day' AND pulocationid IS NULL AND {{window}}
+GROUP BY 1;
+"""
+
+# 等待时间分级（期望等待分钟数的上限, 名称, 说明）
+WAIT_BUCKETS = [
+    (3, "Very Short", "< 3 min"),
+    (5, "Short", "3-5 min"),
+    (10, "Medium", "5-10 min"),
+    (float("inf"), "Long", "10+ min"),
+]
+WAIT_PERCENTILES = (50, 90, 95)
+
+# 检查磁盘文件 / 数据版本是否更新的最小间隔（秒）
+RELOAD_CHECK_INTERVAL = 30
+
+# npz 里没有记录数据版本（旧文件）
+NO_VERSION = -1
+
+
+def days_window(start=None, end=None):
+    """DAYS_QUERY 的窗口条件：只计算完整落在 [start, end) 里的天"""
+    if start is not None and start.time() != datetime.min.time():
+        start = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+    if end is not None:
+        end = datetime.combine(end.date(), datetime.min.time())
+    return window_condition("bucket_start", start, end)
+
+
+def weekday_counts(rows):
+    """DAYS_QUERY 的结果行 -> 每个星期几的天数，下标 0 = 周日"""
+    counts = np.zeros(7, dtype=np.int64)
+    for dow, days in rows:
+        counts[int(dow)] = days
+    return counts
+
+
+def wait_bucket(expected_minutes):
+    """期望等待分钟数 -> (名称, 说明)"""
+    for limit, name, label in WAIT_BUCKETS:
+        if expected_minutes is not None and expected_minutes < limit:
+            return name, label
+    return WAIT_BUCKETS[-1][1:]
+
+
+class ArrivalRates:
+    """266×7×24 的到达率数组；等待时间按泊松到达计算，查询为 O(1) 数组下标"""
+
+    def __init__(self, trip_count, days, data_version=NO_VERSION):
+        self.trip_count = trip_count
+        self.days = days
+        # 构建时 taxi 数据集的版本号（带时间窗口的临时模型不使用）
+        self.data_version = data_version
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.rates = np.where(days[None, :, None] > 0, trip_count / days[None, :, None], 0.0).astype(np.float32)
+
+    @classmethod
+    def from_rows(cls, rows, day_rows):
+        """RATE_QUERY 和 DAYS_QUERY 的结果行 -> 模型"""
+        trip_count = np.zeros((N_ZONES, 7, 24), dtype=np.int64)
+        if len(rows):
+            data = np.array(rows, dtype=np.int64)
+            trip_count[data[:, 0], data[:, 1], data[:, 2]] = data[:, 3]
+        return cls(trip_count, weekday_counts(day_rows))
+
+    @classmethod
+    def from_db(cls):
+        backend = get_backend()
+        version = get_version("taxi")
+        source, window, params = rollup_source()
+        rows = backend.fetchall(RATE_QUERY.format(source=source, window=window), params)
+        days_window_sql, days_params = days_window()
+        day_rows = backend.fetchall(DAYS_QUERY.format(window=days_window_sql), days_params)
+        model = cls.from_rows(rows, day_rows)
+        model.data_version = version
+        return model
+
+    @classmethod
+    def load(cls, path=ARRIVAL_RATES_PATH):
+        with np.load(path) as f:
+            version = int(f["data_version"]) if "data_version" in f.files else NO_VERSION
+            return cls(f["trip_count"], f["days"], version)
+
+    def save(self, path=ARRIVAL_RATES_PATH):
+        # 先写临时文件再替换，避免其他进程读到一半
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, data_version=np.int64(self.data_version), trip_count=self.trip_count, days=self.days)
+        os.replace(tmp, path)
+
+    def wait(self, zone_id, dow, hour, detail=False):
+        """
+        某区域在星期 dow、小时 hour 的上车速率和等待时间
+
+        上车看成速率 λ（次/小时）的泊松过程，等到下一次上车的时间服从指数分布：
+        期望 60/λ 分钟，第 p 百分位 -ln(1 - p/100)·60/λ 分钟
+        """
+        rate = float(self.rates[zone_id, dow, hour])
+        expected = 60.0 / rate if rate > 0 else None
+        name, label = wait_bucket(expected)
+        result = {
+            "zone_id": int(zone_id),
+            "day_of_week": int(dow),
+            "hour": int(hour),
+            "trips_per_hour": round(rate, 2),
+            "expected_wait_min": round(expected, 2) if expected is not None else None,
+            "estimated_wait": f"{name} ({label})" if detail else name,
+        }
+        for p in WAIT_PERCENTILES:
+            result[f"wait_p{p}_min"] = round(-math.log(1 - p / 100) * expected, 2) if expected is not None else None
+        return result
+
+    def busiest(self, dow, hour, limit=20):
+        """给定时段上车速率最高的区域（等待最短）"""
+        rates = self.rates[:, dow, hour]
+        # 速率降序，相同时区域编号升序
+        order = np.lexsort((np.arange(N_ZONES), -rates))
+        return [self.wait(z, dow, hour) for z in order if z > 0 and rates[z] > 0][:limit]
+
+
+def time_slot(when):
+    """datetime -> (星期, 小时)，星期 0 = 周日（与 EXTRACT(DOW) 一致）"""
+    return (when.weekday() + 1) % 7, when.hour
+
+
+@stepwise
+def query_arrival_rates(start=None, end=None):
+    """带时间窗口的模型（内存中的模型覆盖全部时间，窗口查询读 trip_rollup）"""
+    start, end = normalize_window(start, end)
+    source, window, params = rollup_source(start, end)
+    days_window_sql, days_params = days_window(start, end)
+    rows, days = yield [
+        TableStep(RATE_QUERY.format(source=source, window=window), params),
+        TableStep(DAYS_QUERY.format(window=days_window_sql), days_params),
+    ]
+    rows = np.column_stack([rows.columns[c] for c in ("pulocationid", "pickup_dow", "pickup_hour", "trip_count")])
+    day_rows = zip(days.columns["pickup_dow"], days.columns["days"])
+    return ArrivalRates.from_rows(rows, day_rows)
+
+
+_model = None
+_model_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+
+def refresh_arrival_rates(path=ARRIVAL_RATES_PATH):
+    """从 trip_rollup 重新计算模型并写入磁盘（导入新数据后调用）"""
+    global _model, _model_mtime
+    start = time.time()
+    model = ArrivalRates.from_db()
+    model.save(path)
+    with _lock:
+        _model = model
+        _model_mtime = os.path.getmtime(path)
+    print(f"✅ Arrival rates rebuilt: {int((model.trip_count > 0).sum()):,} zone-hour slots "
+          f"over {int(model.days.sum()):,} days in {time.time() - start:.1f}s")
+    return model
+
+
+def load_arrival_rates(path=ARRIVAL_RATES_PATH):
+    """从磁盘加载模型；文件不存在或与当前数据版本不一致时从数据库计算"""
+    global _model, _model_mtime
+    if not os.path.exists(path):
+        return refresh_arrival_rates(path)
+    model = ArrivalRates.load(path)
+    if model.data_version != get_version("taxi"):
+        return refresh_arrival_rates(path)
+    with _lock:
+        _model = model
+        _model_mtime = os.path.getmtime(path)
+    return model
+
+
+def get_arrival_rates(path=ARRIVAL_RATES_PATH):
+    """获取当前模型；磁盘文件被其他进程刷新或数据版本变化后自动重新加载 / 重建"""
+    global _last_check
+    if in_event_loop():
+        # asgi_app.py：启动时已在线程里加载，之后由后台任务定期检查
+        if _model is None:
+            raise RuntimeError("Arrival rates not loaded yet")
+        return _model
+    if _model is None:
+        return load_arrival_rates(path)
+    now = time.time()
+    if now - _last_check > RELOAD_CHECK_INTERVAL:
+        _last_check = now
+        changed = os.path.exists(path) and os.path.getmtime(path) != _model_mtime
+        if changed or _model.data_version != get_version("taxi"):
+            try:
+                return load_arrival_rates(path)
+            except Exception as e:
+                # 重建失败时继续使用内存中的模型，下次检查再试
+                print(f"Error reloading arrival rates: {e}")
+    return _model
+
+
+if __name__ == "__main__":
+    refresh_arrival_rates()
@@ -0,0 +1,516 @@
+"""
+app.py 的异步版本：同样的路由和 JSON，运行在 ASGI 服务器上
+
+查询通过 aio.py 的异步连接池执行，等待数据库时事件循环继续处理其他请求；
+同一请求里互不依赖的查询（例如 311 统计的两个聚合）并发执行。
+CPU 密集的部分（热力网格构建、folium 热点图）仍放到线程 / 后台任务里。
+数据集版本号和内存中的模型由后台任务刷新，处理请求时不做同步 IO，进程里也不建同步的 PostgreSQL 连接池。
+
+启动:
+    hypercorn asgi_app:app --bind 0.0.0.0:5001
+"""
+import asyncio
+import gzip
+import time
+from datetime import datetime
+from functools import wraps
+
+from quart import Quart, render_template, jsonify, request, make_response, url_for, g
+
+import aio
+import analysis
+import arrival_rates
+import complaints
+import fare_matrix
+import metrics
+import quantiles
+import versions
+from cache import cached_async, response_cache
+from columnar import FastJSONProvider
+from config import QUERY_BACKEND
+from jobs import runner, DONE, FAILED
+from partitions import normalize_window
+from zones import get_zone_directory
+
+app = Quart(__name__)
+# orjson 序列化；所有 JSON 接口支持 ?format=columns / ?format=arrow
+app.json = FastJSONProvider(app, request)
+
+_loop = None
+_refresher = None
+
+def _on_loop(func):
+    """后台任务在 runner 的线程里执行；@stepwise 函数的查询交回事件循环，通过异步连接池执行（不建同步连接池）"""
+    @wraps(func)
+    def run(**kwargs):
+        return asyncio.run_coroutine_threadsafe(aio.run(func, **kwargs), _loop).result()
+    return run
+
+# 后台任务（与 app.py 相同）
+runner.register('complaints_heatmap', analysis.generate_311_heatmap, '311')
+runner.register('company_bundle', _on_loop(analysis.get_company_dashboard_bundle), 'taxi')
+runner.register('public_bundle', _on_loop(analysis.get_public_dashboard_bundle), 'taxi')
+
+async def _refresh_versions():
+    # duckdb 后端没有异步连接池，版本号仍由 versions.get_versions 在线程里读取
+    if QUERY_BACKEND == 'postgres':
+        try:
+            await versions.refresh_versions_async(aio.fetch)
+        except Exception as e:
+            print(f"Error reading dataset versions: {e}")
+
+async def _refresh_loop():
+    """
+    请求处理中不做同步 IO，需要定期检查的状态都在这里刷新：
+    数据集版本号通过异步连接池读取；费用矩阵、分位数摘要、到达率模型在线程里检查磁盘文件和数据版本，
+    有变化时重新加载 / 重建（各自按 RELOAD_CHECK_INTERVAL 限制检查频率）
+    """
+    while True:
+        await asyncio.sleep(versions.VERSION_CHECK_INTERVAL)
+        await _refresh_versions()
+        for get_model in (fare_matrix.get_fare_matrix, quantiles.get_quantile_sketches, arrival_rates.get_arrival_rates):
+            try:
+                await asyncio.to_thread(get_model)
+            except Exception as e:
+                print(f"Error refreshing {get_model.__module__}: {e}")
+
+@app.before_serving
+async def startup():
+    """建立异步连接池；区域目录、费用矩阵、分位数摘要、到达率模型在线程里预先准备好，311 索引用异步客户端创建"""
+    global _loop, _refresher
+    _loop = asyncio.get_running_loop()
+    await aio.open_pools()
+    await _refresh_versions()
+    await asyncio.to_thread(get_zone_directory)
+    try:
+        await asyncio.to_thread(fare_matrix.load_fare_matrix)
+    except Exception as e:
+        print(f"Fare matrix not loaded at startup: {e}")
+    try:
+        await asyncio.to_thread(quantiles.load_quantile_sketches)
+    except Exception as e:
+        print(f"Quantile sketches not loaded at startup: {e}")
+    try:
+        await asyncio.to_thread(arrival_rates.load_arrival_rates)
+    except Exception as e:
+        print(f"Arrival rates not loaded at startup: {e}")
+    try:
+        await complaints.ensure_indexes_async(aio.get_mongo_collection())
+    except Exception as e:
+        print(f"311 indexes not checked at startup: {e}")
+    _refresher = asyncio.create_task(_refresh_loop())
+
+@app.after_serving
+async def shutdown():
+    if _refresher is not None:
+        _refresher.cancel()
+    await aio.close_pools()
+
+class InvalidTimeWindow(ValueError):
+    """start / end 查询参数格式错误"""
+
+def _time_window():
+    """从查询参数读取时间窗口 [start, end)：ISO 日期或时间，例如 ?start=2024-01-01&end=2024-04-01"""
+    try:
+        start, end = normalize_window(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        raise InvalidTimeWindow(str(e))
+    return {'start': start, 'end': end}
+
+def _approx():
+    """?approx=true：在分层样本 trip_sample 上近似计算，结果带置信区间（只对扫描明细表的接口有效）"""
+    return request.args.get('approx', '').lower() in ('1', 'true', 'yes')
+
+@app.errorhandler(InvalidTimeWindow)
+async def handle_invalid_window(e):
+    return jsonify({"error": f"Invalid start/end: {e}"}), 400
+
+# 每个路由的请求耗时（与 app.py 相同）
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request_time(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code,
+                                time.perf_counter() - g.request_started)
+    return response
+
+def _job_response(job):
+    """任务状态：完成前返回 202，客户端轮询 status_url"""
+    data = job.to_dict()
+    data['status_url'] = url_for('api_job_status', job_id=job.id)
+    data['result_url'] = url_for('api_job_result', job_id=job.id)
+    return jsonify(data), 200 if job.status in (DONE, FAILED) else 202
+
+async def _artifact_response(job):
+    """返回任务结果：客户端支持 gzip 时直接发送磁盘上的压缩文件"""
+    body = await asyncio.to_thread(runner.read_artifact, job)
+    if request.accept_encodings['gzip']:
+        response = await make_response(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = await make_response(gzip.decompress(body))
+    response.mimetype = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(job.id)
+    return await response.make_conditional(request)
+
+# ============== 主页路由 ==============
+
+@app.route('/')
+async def index():
+    """主页 - 选择仪表板"""
+    return await render_template('index.html')
+
+# ============== Company Dashboard 路由 ==============
+
+@app.route('/company')
+async def company_dashboard():
+    """公司运营仪表板"""
+    return await render_template('company_dashboard.html')
+
+@app.route('/api/company/revenue-summary')
+@cached_async('taxi')
+async def api_revenue_summary():
+    """收入总览 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_revenue_summary, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/revenue-by-distance')
+async def api_revenue_by_distance():
+    """收入与距离关系 API - 已移除"""
+    return jsonify({"message": "This endpoint has been replaced by fare calculator"}), 404
+
+@app.route('/api/company/zones')
+@cached_async('zones')
+async def api_zones():
+    """获取所有区域列表 API"""
+    try:
+        data = analysis.get_all_zones()
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/fare-estimate')
+@cached_async('taxi')
+async def api_fare_estimate():
+    """费用估算 API"""
+    window = _time_window()
+    try:
+        pickup = request.args.get('pickup', type=int)
+        dropoff = request.args.get('dropoff', type=int)
+
+        if not pickup or not dropoff:
+            return jsonify({"error": "Missing pickup or dropoff zone ID"}), 400
+
+        data = await aio.run(analysis.get_fare_estimate, pickup, dropoff, **window, approx=_approx())
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/payment-breakdown')
+@cached_async('taxi')
+async def api_payment_breakdown():
+    """支付方式分布 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_payment_breakdown, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/top-zones')
+@cached_async('taxi')
+async def api_top_zones():
+    """最高收入区域 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_top_pickup_zones, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/surcharges')
+@cached_async('taxi')
+async def api_surcharges():
+    """附加费用分析 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_surcharge_analysis, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/hourly-demand')
+@cached_async('taxi')
+async def api_hourly_demand():
+    """按小时需求 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_hourly_demand, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/company/bundle')
+@cached_async('taxi')
+async def api_company_bundle():
+    """公司仪表板全部面板（一次查询）API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_company_dashboard_bundle, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ============== Public Dashboard 路由 ==============
+
+@app.route('/public')
+async def public_dashboard():
+    """公众乘客仪表板"""
+    return await render_template('public_dashboard.html')
+
+@app.route('/api/public/busiest-zones')
+@cached_async('taxi')
+async def api_busiest_zones():
+    """最繁忙区域 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_busiest_pickup_zones, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/popular-routes')
+@cached_async('taxi')
+async def api_popular_routes():
+    """热门路线 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_popular_routes, **window, approx=_approx())
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/demand-by-hour')
+@cached_async('taxi')
+async def api_demand_by_hour():
+    """各时段需求 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_demand_by_hour, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/demand-by-day')
+@cached_async('taxi')
+async def api_demand_by_day():
+    """各星期需求 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_demand_by_day, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/demand-timeline')
+@cached_async('taxi')
+async def api_demand_timeline():
+    """
+    需求时间线 API：?zone=区域编号 或 ?borough=行政区，?metric=trip_count|revenue|avg_fare，?points=最多点数
+
+    按窗口长度和点数选择时间序列的分辨率（5 分钟 / 小时 / 天 / 周），再用 LTTB 降采样
+    """
+    window = _time_window()
+    zone = request.args.get('zone', type=int)
+    borough = request.args.get('borough')
+    metric = request.args.get('metric', 'trip_count')
+    points = request.args.get('points', type=int)
+    try:
+        data = await aio.run(analysis.get_demand_timeline, **window, zone_id=zone, borough=borough,
+                             metric=metric, max_points=points)
+        return jsonify(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/wait-times')
+async def api_wait_times():
+    """
+    等待时间估算 API：?zone=区域编号&time=2024-03-01T18:30（time 默认当前时间）
+
+    到达率模型常驻内存，不指定 time 时结果随当前时间变化，所以不经过响应缓存
+    """
+    window = _time_window()
+    zone = request.args.get('zone', type=int)
+    try:
+        at = datetime.fromisoformat(request.args['time']) if request.args.get('time') else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid time: {e}"}), 400
+    try:
+        data = await aio.run(analysis.estimate_wait_time_by_zone, zone, at, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/zone-activity')
+@cached_async('taxi')
+async def api_zone_activity():
+    """区域活跃度 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_zone_activity_heatmap, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/public/bundle')
+@cached_async('taxi')
+async def api_public_bundle():
+    """公众仪表板区域 / 时段 / 等待时间面板（一次查询）API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_public_dashboard_bundle, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ============== NYC 311 Complaints 路由 ==============
+
+@app.route('/api/complaints/heatmap')
+async def api_complaints_heatmap():
+    """生成 311 投诉热点图 API：在后台任务中生成，完成前返回 202 和任务状态"""
+    job = await asyncio.to_thread(runner.submit, 'complaints_heatmap', _time_window())
+    if job.status == DONE:
+        return await _artifact_response(job)
+    return _job_response(job)
+
+@app.route('/api/complaints/heat-layers')
+@cached_async('311')
+async def api_complaints_heat_layers():
+    """311 热力网格图层列表 API"""
+    window = _time_window()
+    try:
+        # 网格构建是 CPU 密集的 numpy 计算，放到线程里
+        data = await asyncio.to_thread(analysis.get_311_heat_layers, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/complaints/heat-grid')
+@cached_async('311')
+async def api_complaints_heat_grid():
+    """311 热力网格 API：?zoom=12&bbox=west,south,east,north&layer=overall"""
+    window = _time_window()
+    zoom = request.args.get('zoom', default=11, type=int)
+    layer = request.args.get('layer', default='overall')
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            bbox = [float(v) for v in bbox.split(',')]
+        except ValueError:
+            bbox = None
+        if bbox is None or len(bbox) != 4:
+            return jsonify({"error": "bbox must be west,south,east,north"}), 400
+    try:
+        data = await asyncio.to_thread(analysis.get_311_heat_grid, zoom, bbox, layer, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/complaints/stats')
+@cached_async('311')
+async def api_complaints_stats():
+    """311 投诉统计 API"""
+    window = _time_window()
+    try:
+        data = await aio.run(analysis.get_311_stats, **window)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ============== 后台任务路由 ==============
+
+@app.route('/api/jobs/<name>', methods=['POST'])
+async def api_submit_job(name):
+    """提交后台任务 API：POST /api/jobs/company_bundle?start=2024-01-01"""
+    window = _time_window()
+    try:
+        job = await asyncio.to_thread(runner.submit, name, window)
+    except KeyError:
+        return jsonify({"error": f"Unknown job '{name}'", "jobs": runner.names}), 404
+    return _job_response(job)
+
+@app.route('/api/jobs/status/<job_id>')
+async def api_job_status(job_id):
+    """后台任务状态 API"""
+    job = runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return _job_response(job)
+
+@app.route('/api/jobs/result/<job_id>')
+async def api_job_result(job_id):
+    """后台任务结果 API（gzip 压缩的 JSON）"""
+    job = runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    if job.status == FAILED:
+        return jsonify({"error": job.error}), 500
+    if job.status != DONE:
+        return _job_response(job)
+    return await _artifact_response(job)
+
+# ============== 系统状态路由 ==============
+
+@app.route('/api/system/health')
+async def api_health():
+    """数据库健康检查 API"""
+    status = await aio.check_health()
+    ok = all(v == "ok" for v in status.values())
+    return jsonify(status), 200 if ok else 503
+
+@app.route('/api/system/pool-stats')
+async def api_pool_stats():
+    """连接池统计 API"""
+    return jsonify(aio.pool_stats())
+
+@app.route('/api/system/cache-stats')
+async def api_cache_stats():
+    """响应缓存命中 / 淘汰统计 API"""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/system/job-stats')
+async def api_job_stats():
+    """后台任务统计 API"""
+    return jsonify(runner.stats())
+
+@app.route('/api/system/slow-queries')
+async def api_slow_queries():
+    """最近的慢查询（含参数和执行计划）API"""
+    return jsonify(metrics.slow_query_log.recent())
+
+@app.route('/metrics')
+async def prometheus_metrics():
+    """Prometheus 指标"""
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+# ============== 启动应用 ==============
+
+if __name__ == '__main__':
+    print("=" * 60)
+    print("🚕 NYC Taxi Analytics Dashboard (async)")
+    print("=" * 60)
+    print("📊 Company Dashboard: http://127.0.0.1:5001/company")
+    print("👥 Public Dashboard:  http://127.0.0.1:5001/public")
+    print("=" * 60)
+    app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,449 @@
+"""
+analysis.py 的查询后端
+
+    postgres - 连接池访问 PostgreSQL（默认）
+    duckdb   - 进程内列式引擎，直接查询 pipeline.py 输出的 parquet，不需要数据库服务
+
+由 config.QUERY_BACKEND（环境变量 QUERY_BACKEND）选择。两个后端执行同样的 SQL，
+结果都按 pd.read_sql 的规则转成 DataFrame，所以 analysis.py 的输出格式一致。
+
+analysis.py 的查询函数写成"步骤生成器"：yield 出 SqlStep / MongoStep（或它们的列表，表示可以并发执行），
+得到结果后继续计算。同一个函数既可以由 run_steps 同步执行（Flask），也可以由 aio.run_steps
+在事件循环里异步执行（asgi_app.py），SQL 和结果处理只写一份。
+
+验证与基准测试:
+    python backends.py --repeat 5
+"""
+import argparse
+import asyncio
+import glob
+import os
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from columnar import Table
+from config import QUERY_BACKEND, TAXI_PARQUET_PATH, DUCKDB_CONFIG
+from db import explain_analyze, explain_pipeline, get_connection, get_mongo_collection
+
+
+class QueryBackend:
+    """查询后端接口"""
+
+    name = None
+
+    def fetch(self, query, params=None):
+        """执行查询，返回 (列名, 行列表)"""
+        raise NotImplementedError
+
+    def read_sql(self, query, params=None):
+        """执行查询并返回 DataFrame（与 pd.read_sql 相同：Decimal 转为 float）"""
+        columns, rows = self.fetch(query, params)
+        with metrics.phase("convert", self.name):
+            return to_frame(columns, rows)
+
+    def fetch_table(self, query, params=None):
+        """执行查询并按列返回 columnar.Table（不经过 DataFrame）"""
+        columns, rows = self.fetch(query, params)
+        with metrics.phase("convert", self.name):
+            return Table.from_rows(columns, rows)
+
+    def fetchall(self, query, params=None):
+        return self.fetch(query, params)[1]
+
+    def data_version(self):
+        """数据版本号；None 表示由 versions.py 的 dataset_version 表管理"""
+        return None
+
+    def health(self):
+        try:
+            self.fetch("SELECT 1")
+            return "ok"
+        except Exception as e:
+            return f"error: {e}"
+
+
+def to_frame(columns, rows):
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+class PostgresBackend(QueryBackend):
+    name = "postgres"
+
+    def fetch(self, query, params=None):
+        timer = metrics.QueryTimer(self.name, query, params, explain=lambda: explain_analyze(query, params))
+        with get_connection() as conn:
+            timer.lap("connect")
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                timer.lap("execute")
+                rows = cur.fetchall()
+                timer.lap("fetch")
+                columns = [d.name for d in cur.description]
+        timer.done(len(rows))
+        return columns, rows
+
+
+class DuckDBBackend(QueryBackend):
+    """
+    DuckDB 后端：yellow_taxi_clean 是 parquet 上的视图，trip_rollup 在内存里建一次
+
+    pipeline.py 输出按时间排序，带时间窗口的查询可以利用 row group 的 min/max 统计跳过无关数据，
+    效果相当于 PostgreSQL 的分区裁剪。parquet 目录有变化时自动重建。
+    """
+
+    name = "duckdb"
+
+    # 检查 parquet 目录是否更新的最小间隔（秒）
+    RELOAD_CHECK_INTERVAL = 30
+
+    def __init__(self, path=TAXI_PARQUET_PATH, config=DUCKDB_CONFIG):
+        import duckdb
+        self.path = path
+        self._conn = duckdb.connect(config={k: v for k, v in config.items() if v is not None})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._version = None
+        self._last_check = 0.0
+
+    def _files(self):
+        if os.path.isdir(self.path):
+            return sorted(glob.glob(os.path.join(self.path, "**", "*.parquet"), recursive=True))
+        return sorted(glob.glob(self.path))
+
+    def _scan_version(self):
+        files = self._files()
+        return (len(files), max((os.path.getmtime(f) for f in files), default=0.0))
+
+    def _build(self, files):
+        """建视图、立方体、样本表、top-K 摘要和时间序列（与 rollup.py / sample.py / topk.py / timeseries.py 中 PostgreSQL 的表结构相同）"""
+        from rollup import ROLLUP_SELECT_SQL
+        start = time.time()
+        file_list = ", ".join("'" + f.replace("'", "''") + "'" for f in files)
+        source = f"read_parquet([{file_list}], union_by_name = true)"
+        # 列名统一成小写，与 PostgreSQL 表一致（查询结果的列名也因此相同）
+        names = [r[0] for r in self._conn.execute(f"DESCRIBE SELECT * FROM {source};").fetchall()]
+        # trips.py 的紧凑类型（int8 / int16 / float32）在视图里还原成 INTEGER / 两位小数的 DOUBLE
+        from trips import sql_columns
+        columns = sql_columns(names)
+        self._conn.execute(f"CREATE OR REPLACE VIEW yellow_taxi_clean AS SELECT {columns} FROM {source};")
+        self._conn.execute(
+            f"CREATE OR REPLACE TABLE trip_rollup AS {ROLLUP_SELECT_SQL.format(source='yellow_taxi_clean', where='')};"
+        )
+        # 近似查询的分层样本（与 PostgreSQL 的 trip_sample 相同）
+        from sample import sample_select_sql
+        self._conn.execute(f"CREATE OR REPLACE TABLE trip_sample AS {sample_select_sql(source='yellow_taxi_clean')};")
+        # 热门路线的每月 top-K 摘要（与 topk.py 中 PostgreSQL 的 route_topk 相同）
+        from topk import build_topk
+        build_topk(self._conn, source="yellow_taxi_clean", insert="CREATE OR REPLACE TABLE {table} AS")
+        # 多分辨率时间序列（与 timeseries.py 中 PostgreSQL 的 trip_series 相同）
+        from timeseries import build_series
+        build_series(self._conn, source="yellow_taxi_clean", insert="CREATE OR REPLACE TABLE {table} AS")
+        cells = self._conn.execute("SELECT COUNT(*) FROM trip_rollup;").fetchone()[0]
+        print(f"✅ DuckDB rollup built from {len(files)} parquet files: {cells:,} cells in {time.time() - start:.1f}s")
+
+    def _ensure_loaded(self):
+        now = time.time()
+        if self._version is not None and now - self._last_check < self.RELOAD_CHECK_INTERVAL:
+            return
+        with self._lock:
+            if self._version is not None and now - self._last_check < self.RELOAD_CHECK_INTERVAL:
+                return
+            version = self._scan_version()
+            if version != self._version:
+                files = self._files()
+                if not files:
+                    raise FileNotFoundError(f"No parquet files found under {self.path}")
+                self._build(files)
+                self._version = version
+            self._last_check = now
+
+    def _cursor(self):
+        # DuckDB 连接不能跨线程共享，每个线程用自己的 cursor
+        cur = getattr(self._local, "cursor", None)
+        if cur is None:
+            cur = self._local.cursor = self._conn.cursor()
+        return cur
+
+    def _execute(self, query, params):
+        """执行查询，返回 (cursor, 计时器)；第一次查询时建视图和立方体的时间计入 connect 阶段"""
+        timer = metrics.QueryTimer(self.name, query, params, explain=lambda: self.explain(query, params))
+        self._ensure_loaded()
+        cur = self._cursor()
+        timer.lap("connect")
+        # analysis.py 的 SQL 使用 psycopg 的 %s 占位符
+        cur.execute(query.replace("%s", "?"), params or [])
+        timer.lap("execute")
+        return cur, timer
+
+    def fetch(self, query, params=None):
+        cur, timer = self._execute(query, params)
+        rows = cur.fetchall()
+        timer.lap("fetch")
+        timer.done(len(rows))
+        return [d[0] for d in cur.description], rows
+
+    def fetch_table(self, query, params=None):
+        """DuckDB 可以直接输出 numpy 列"""
+        cur, timer = self._execute(query, params)
+        arrays = cur.fetchnumpy()
+        timer.lap("fetch")
+        timer.done(len(next(iter(arrays.values()), ())))
+        with metrics.phase("convert", self.name):
+            return self._to_table(arrays)
+
+    def _to_table(self, arrays):
+        columns = {}
+        for name, values in arrays.items():
+            if isinstance(values, np.ma.MaskedArray):
+                # 含 NULL 的列：数值列转成 float（NaN），与 PostgreSQL 后端一致
+                if values.dtype.kind in "biuf":
+                    values = values.astype(np.float64).filled(np.nan)
+                else:
+                    values = np.array([None if m else v for v, m in zip(values.data, np.ma.getmaskarray(values))], dtype=object)
+            columns[name] = values
+        return Table(columns)
+
+    def explain(self, query, params=None):
+        """EXPLAIN ANALYZE 的文本执行计划（DuckDB 没有 BUFFERS 选项）"""
+        cur = self._cursor()
+        rows = cur.execute("EXPLAIN ANALYZE " + query.replace("%s", "?"), params or []).fetchall()
+        return "\n".join(r[-1] for r in rows)
+
+    def data_version(self):
+        self._ensure_loaded()
+        files, mtime = self._version
+        return int(mtime * 1000) + files
+
+
+BACKENDS = {"postgres": PostgresBackend, "duckdb": DuckDBBackend}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """当前进程使用的查询后端（按 config.QUERY_BACKEND 创建一次）"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if QUERY_BACKEND not in BACKENDS:
+                    raise ValueError(f"Unknown QUERY_BACKEND '{QUERY_BACKEND}', expected one of {sorted(BACKENDS)}")
+                _backend = BACKENDS[QUERY_BACKEND]()
+    return _backend
+
+
+def set_backend(backend):
+    """切换后端（验证 / 基准测试用），返回之前的后端"""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+# ============== 查询步骤 ==============
+
+# SQL 查询，结果是 DataFrame
+SqlStep = namedtuple("SqlStep", ["query", "params"], defaults=[None])
+# SQL 查询，结果是 columnar.Table（按列的 numpy 数组，适合直接输出的大结果）
+TableStep = namedtuple("TableStep", ["query", "params"], defaults=[None])
+# 311 集合上的聚合管道，结果是文档列表（只用于返回少量文档的聚合）
+MongoStep = namedtuple("MongoStep", ["pipeline"])
+
+
+def aggregate(pipeline):
+    """执行 311 集合上的聚合管道，返回文档列表"""
+    timer = metrics.QueryTimer("mongo", pipeline, explain=lambda: explain_pipeline(pipeline))
+    cursor = get_mongo_collection().aggregate(pipeline, allowDiskUse=True)
+    timer.lap("execute")
+    docs = list(cursor)
+    timer.lap("fetch")
+    timer.done(len(docs))
+    return docs
+
+
+def _execute(step):
+    if isinstance(step, list):
+        return [_execute(s) for s in step]
+    if isinstance(step, MongoStep):
+        return aggregate(step.pipeline)
+    if isinstance(step, TableStep):
+        return get_backend().fetch_table(step.query, step.params)
+    return get_backend().read_sql(step.query, step.params)
+
+
+def run_steps(steps):
+    """同步执行步骤生成器，返回它的返回值；查询出错时把异常抛回生成器，由函数自己的 try/except 处理"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = _execute(step), None
+        except Exception as e:
+            result, error = None, e
+
+
+def in_event_loop():
+    """
+    当前线程是否正在运行事件循环（aio.run_steps 执行步骤生成器时为真）
+
+    这时不能做同步的数据库 / 文件 IO：内存中的模型只返回已加载的版本，检查和重新加载由 asgi_app.py 的后台任务在线程里执行
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def gather(*generators):
+    """
+    同时推进多个步骤生成器：每一轮把各自的当前步骤合成一个列表（异步执行时并发），
+    用法: a, b = yield from gather(f.steps(...), g.steps(...))
+    """
+    results = [None] * len(generators)
+    pending = {}
+    for i, gen in enumerate(generators):
+        try:
+            pending[i] = next(gen)
+        except StopIteration as stop:
+            results[i] = stop.value
+    while pending:
+        order = list(pending)
+        # 任一查询出错时整个列表抛出同一个异常，交给各生成器自己处理
+        try:
+            outputs, error = (yield [pending[i] for i in order]), None
+        except Exception as e:
+            outputs, error = [None] * len(order), e
+        for i, output in zip(order, outputs):
+            gen = generators[i]
+            try:
+                pending[i] = gen.throw(error) if error is not None else gen.send(output)
+            except StopIteration as stop:
+                results[i] = stop.value
+                del pending[i]
+    return results
+
+
+def stepwise(steps):
+    """把步骤生成器函数包装成普通函数；原函数保留在 .steps 上，供异步路径使用"""
+    @wraps(steps)
+    def run(*args, **kwargs):
+        with metrics.function_timer(steps.__name__):
+            return run_steps(steps(*args, **kwargs))
+    run.steps = steps
+    return run
+
+
+# ============== 验证与基准测试 ==============
+
+# (名称, 函数名, 参数)
+BENCHMARK_CASES = [
+    ("revenue_summary", "get_revenue_summary", {}),
+    ("payment_breakdown", "get_payment_breakdown", {}),
+    ("top_zones", "get_top_pickup_zones", {}),
+    ("surcharges", "get_surcharge_analysis", {}),
+    ("hourly_demand", "get_hourly_demand", {}),
+    ("company_bundle", "get_company_dashboard_bundle", {}),
+    ("busiest_zones", "get_busiest_pickup_zones", {}),
+    ("popular_routes", "get_popular_routes", {}),
+    ("demand_by_hour", "get_demand_by_hour", {}),
+    ("demand_by_day", "get_demand_by_day", {}),
+    ("zone_activity", "get_zone_activity_heatmap", {}),
+    ("wait_times", "estimate_wait_time_by_zone", {}),
+    ("public_bundle", "get_public_dashboard_bundle", {}),
+    ("demand_timeline", "get_demand_timeline", {}),
+    ("revenue_summary[quarter]", "get_revenue_summary", {"start": "2024-01-01", "end": "2024-04-01"}),
+    ("company_bundle[partial]", "get_company_dashboard_bundle", {"start": "2023-12-15", "end": "2024-03-10"}),
+    ("popular_routes[month]", "get_popular_routes", {"start": "2024-02-01", "end": "2024-03-01"}),
+    ("demand_timeline[week]", "get_demand_timeline", {"start": "2024-03-04", "end": "2024-03-11",
+                                                      "metric": "revenue"}),
+    ("fare_estimate[year]", "get_fare_estimate", {"pickup_zone_id": 132, "dropoff_zone_id": 236,
+                                                  "start": "2024-01-01", "end": "2025-01-01"}),
+]
+
+
+def same_result(a, b, rel_tol=1e-9, path="result"):
+    """比较两个后端的结果：数值按相对误差比较，NULL 与 NaN 视为相同；返回差异列表"""
+    a = a.records() if isinstance(a, Table) else a
+    b = b.records() if isinstance(b, Table) else b
+    if isinstance(a, dict) and isinstance(b, dict):
+        if set(a) != set(b):
+            return [f"{path}: keys {sorted(set(a) ^ set(b))} differ"]
+        return [d for k in a for d in same_result(a[k], b[k], rel_tol, f"{path}.{k}")]
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return [f"{path}: length {len(a)} != {len(b)}"]
+        return [d for i, (x, y) in enumerate(zip(a, b)) for d in same_result(x, y, rel_tol, f"{path}[{i}]")]
+    if (a is None or (isinstance(a, float) and a != a)) and (b is None or (isinstance(b, float) and b != b)):
+        return []
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+        if abs(a - b) <= rel_tol * max(abs(a), abs(b), 1.0):
+            return []
+        return [f"{path}: {a!r} != {b!r}"]
+    return [] if a == b else [f"{path}: {a!r} != {b!r}"]
+
+
+def _time_case(func, kwargs, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(**kwargs)
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, sorted(timings)[len(timings) // 2]
+
+
+def compare_backends(backends, repeat=3):
+    """在各后端上运行同样的 analysis 函数，校验结果一致并比较耗时（中位数，毫秒）"""
+    import analysis
+    # 以脚本运行时本模块是 __main__，analysis 使用的是 import 进来的 backends 模块
+    from backends import set_backend
+    report = []
+    previous = set_backend(backends[0])
+    try:
+        for label, func_name, kwargs in BENCHMARK_CASES:
+            func = getattr(analysis, func_name)
+            results, timings = {}, {}
+            for backend in backends:
+                set_backend(backend)
+                # 第一次调用包含 DuckDB 建视图 / 立方体的时间，不计入
+                func(**kwargs)
+                results[backend.name], timings[backend.name] = _time_case(func, kwargs, repeat)
+            base = backends[0].name
+            diffs = [d for b in backends[1:] for d in same_result(results[base], results[b.name])]
+            report.append({"case": label, "timings_ms": timings, "identical": not diffs, "diffs": diffs[:5]})
+    finally:
+        set_backend(previous)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and benchmark the DuckDB backend against PostgreSQL")
+    parser.add_argument("--parquet", default=TAXI_PARQUET_PATH, help="pipeline.py 输出目录（需与 PostgreSQL 中的数据一致）")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    report = compare_backends([PostgresBackend(), DuckDBBackend(args.parquet)], args.repeat)
+    print(f"\n{'case':<28}{'postgres ms':>14}{'duckdb ms':>14}{'speedup':>10}  identical")
+    for r in report:
+        pg, duck = r["timings_ms"]["postgres"], r["timings_ms"]["duckdb"]
+        print(f"{r['case']:<28}{pg:>14.1f}{duck:>14.1f}{pg / max(duck, 1e-9):>9.1f}x  {'✅' if r['identical'] else '❌'}")
+        for d in r["diffs"]:
+            print(f"    {d}")
+    mismatches = sum(not r["identical"] for r in report)
+    print(f"\n{len(report) - mismatches}/{len(report)} cases identical")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,459 @@
+"""
+合成数据基准测试：ETL 各阶段的吞吐量 + analysis.py 各查询函数的延迟
+
+1. 生成与 TLC 原始文件结构相同的合成行程（每月一个 parquet，区域 id 来自 taxi_zone_lookup.csv，
+   按服务区分配上车热度，按小时分配需求曲线），规模用 --rows 指定（1M / 10M / 100M）
+2. pipeline.py 清洗排序 -> 导入查询引擎：
+       duckdb   - 进程内引擎直接查询清洗后的 parquet（默认，不需要数据库服务）
+       postgres - loader.py 并行 COPY 到 PG_CONFIG 指向的库，再重建 trip_rollup 和费用矩阵
+3. 依次运行 backends.BENCHMARK_CASES 中的每个查询，记录首次调用和重复调用的耗时
+4. 结果写入 {report_dir}/{engine}-{rows}-{时间}.json；指定 --baseline 时与之前的报告比较，
+   有退化时退出码为 1（可用于比较不同提交）
+
+用法:
+    python bench.py --rows 1M
+    python bench.py --rows 10M --engine postgres --allow-truncate
+    python bench.py --rows 1M --baseline benchmark_reports/duckdb-1M-20240101-120000.json
+    python bench.py --compare old.json new.json
+
+postgres 引擎会清空目标库的 yellow_taxi_clean，请用 PG_DB 指向单独的基准测试库。
+同样参数（行数、月份、随机种子）生成的原始数据会保留在 work_dir 中复用。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import BENCHMARK_CONFIG
+from zones import ZoneDirectory
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# TLC 原始文件的列（包含 pipeline.py 会丢掉的 store_and_fwd_flag 和 Airport_fee）
+RAW_SCHEMA = pa.schema([
+    ("VendorID", pa.int32()),
+    ("tpep_pickup_datetime", pa.timestamp("us")),
+    ("tpep_dropoff_datetime", pa.timestamp("us")),
+    ("passenger_count", pa.float64()),
+    ("trip_distance", pa.float64()),
+    ("RatecodeID", pa.float64()),
+    ("store_and_fwd_flag", pa.string()),
+    ("PULocationID", pa.int32()),
+    ("DOLocationID", pa.int32()),
+    ("payment_type", pa.int64()),
+    ("fare_amount", pa.float64()),
+    ("extra", pa.float64()),
+    ("mta_tax", pa.float64()),
+    ("tip_amount", pa.float64()),
+    ("tolls_amount", pa.float64()),
+    ("improvement_surcharge", pa.float64()),
+    ("total_amount", pa.float64()),
+    ("congestion_surcharge", pa.float64()),
+    ("Airport_fee", pa.float64()),
+])
+
+# 各服务区的相对上车热度（曼哈顿核心区和机场占绝大多数行程）
+SERVICE_ZONE_WEIGHTS = {"Yellow Zone": 40.0, "Airports": 150.0, "Boro Zone": 1.0, "EWR": 0.2, "N/A": 2.0}
+# 0~23 点的相对需求
+HOUR_WEIGHTS = np.array([
+    3.0, 2.0, 1.4, 1.0, 0.8, 1.0, 2.0, 3.5, 4.5, 4.6, 4.5, 4.7,
+    5.0, 5.0, 5.3, 5.6, 5.7, 6.2, 6.8, 6.6, 6.0, 5.8, 5.5, 4.3,
+])
+# 值 -> 概率
+RATECODES = ([1.0, 2.0, 5.0, 99.0], [0.95, 0.03, 0.015, 0.005])
+PASSENGERS = ([0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0], [0.02, 0.72, 0.14, 0.04, 0.02, 0.04, 0.02])
+PAYMENTS = ([1, 2, 3, 4], [0.76, 0.21, 0.02, 0.01])
+EXTRAS = ([0.0, 0.5, 1.0, 2.5], [0.45, 0.2, 0.25, 0.1])
+TIP_RATES = ([0.0, 0.15, 0.2, 0.25, 0.3], [0.1, 0.2, 0.4, 0.2, 0.1])
+# 缺少乘客数 / 费率的行（TLC 数据里这些行的附加费也为空）
+MISSING_RATE = 0.02
+TOLL_RATE = 0.05
+TOLL_AMOUNT = 6.94
+CONGESTION_SURCHARGE = 2.5
+AIRPORT_FEE = 1.75
+
+SCALES = {"k": 1_000, "m": 1_000_000, "b": 1_000_000_000}
+
+
+def parse_rows(text):
+    """'1M' / '10m' / '250k' / '100000' -> 行数"""
+    text = str(text).strip().lower().replace("_", "")
+    if text and text[-1] in SCALES:
+        return int(float(text[:-1]) * SCALES[text[-1]])
+    return int(text)
+
+
+def format_rows(rows):
+    for suffix, scale in (("B", 10 ** 9), ("M", 10 ** 6), ("k", 10 ** 3)):
+        if rows >= scale and rows % scale == 0:
+            return f"{rows // scale}{suffix}"
+    return str(rows)
+
+
+def month_range(start, end):
+    """[start, end) 内的每个月份（'YYYY-MM'）"""
+    months = np.arange(np.datetime64(start, "M"), np.datetime64(end, "M"))
+    return [str(m) for m in months]
+
+
+def zone_weights(directory=None):
+    """(区域 id 数组, 上车概率)：按服务区的热度，再乘上每个区域固定的随机系数"""
+    directory = directory or ZoneDirectory.from_csv()
+    ids = np.array([z.locationid for z in directory], dtype=np.int32)
+    base = np.array([SERVICE_ZONE_WEIGHTS.get(z.service_zone, 1.0) for z in directory])
+    jitter = np.random.default_rng(0).lognormal(0.0, 0.7, len(ids))
+    weights = base * jitter
+    return ids, weights / weights.sum()
+
+
+def trip_batch(rng, n, month, zone_ids, zone_p, airports, yellow):
+    """一个月中的 n 条合成行程（RecordBatch，列与 RAW_SCHEMA 一致）"""
+    month = np.datetime64(month, "M")
+    days = ((month + 1).astype("datetime64[D]") - month.astype("datetime64[D]")).astype(int)
+    hours = rng.choice(24, n, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    seconds = rng.integers(0, days, n) * 86400 + hours * 3600 + rng.integers(0, 3600, n)
+    pickup = month.astype("datetime64[us]") + (seconds * 1_000_000).astype("timedelta64[us]")
+
+    pu = rng.choice(zone_ids, n, p=zone_p)
+    do = rng.choice(zone_ids, n, p=zone_p)
+    distance = np.round(np.clip(rng.lognormal(0.6, 0.8, n), 0.01, 60.0), 2)
+    # 机场行程更远
+    distance = np.where(np.isin(pu, airports) | np.isin(do, airports), np.round(distance * 4 + 8, 2), distance)
+    minutes = distance / rng.uniform(6.0, 20.0, n) * 60 + rng.uniform(1.0, 5.0, n)
+    dropoff = pickup + (minutes * 60_000_000).astype(np.int64).astype("timedelta64[us]")
+
+    missing = rng.random(n) < MISSING_RATE
+    ratecode = np.where(missing, np.nan, rng.choice(RATECODES[0], n, p=RATECODES[1]))
+    passengers = np.where(missing, np.nan, rng.choice(PASSENGERS[0], n, p=PASSENGERS[1]))
+    payment = np.where(missing, 0, rng.choice(PAYMENTS[0], n, p=PAYMENTS[1]))
+
+    fare = np.round(3.0 + 2.5 * distance + 0.5 * minutes, 2)
+    # 争议 / 退款的行程金额为负
+    fare = np.where(payment == 4, -fare, fare)
+    extra = rng.choice(EXTRAS[0], n, p=EXTRAS[1])
+    mta_tax = np.where(fare > 0, 0.5, -0.5)
+    improvement = np.where(fare > 0, 1.0, -1.0)
+    tolls = np.where(rng.random(n) < TOLL_RATE, TOLL_AMOUNT, 0.0)
+    tips = np.where(payment == 1, np.round(fare * rng.choice(TIP_RATES[0], n, p=TIP_RATES[1]), 2), 0.0)
+    congestion = np.where(missing, np.nan, np.where(np.isin(do, yellow), CONGESTION_SURCHARGE, 0.0))
+    airport_fee = np.where(missing, np.nan, np.where(np.isin(pu, airports), AIRPORT_FEE, 0.0))
+    total = np.round(fare + extra + mta_tax + tips + tolls + improvement
+                     + np.nan_to_num(congestion) + np.nan_to_num(airport_fee), 2)
+
+    columns = [
+        rng.choice(np.array([1, 2], dtype=np.int32), n, p=[0.3, 0.7]),
+        pickup, dropoff, passengers, distance, ratecode,
+        pa.array(np.full(n, "N", dtype=object), pa.string()),
+        pu, do, payment, fare, extra, mta_tax, tips, tolls, improvement, total, congestion, airport_fee,
+    ]
+    arrays = [
+        c if isinstance(c, pa.Array) else pa.array(c, field.type, from_pandas=True)
+        for c, field in zip(columns, RAW_SCHEMA)
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=RAW_SCHEMA)
+
+
+def generate_raw(rows, out_dir, start, end, seed=0, chunk_rows=1_000_000):
+    """
+    生成 rows 条合成行程，按月写成 yellow_tripdata_YYYY-MM.parquet（与 TLC 的文件组织相同）
+
+    每个月份用独立的随机数种子，分块生成，内存占用与总行数无关。返回写出的文件列表
+    """
+    months = month_range(start, end)
+    if not months:
+        raise ValueError(f"Empty month range [{start}, {end})")
+    os.makedirs(out_dir, exist_ok=True)
+    directory = ZoneDirectory.from_csv()
+    zone_ids, zone_p = zone_weights(directory)
+    airports = np.array([z.locationid for z in directory.by_service_zone("Airports")], dtype=np.int32)
+    yellow = np.array([z.locationid for z in directory.by_service_zone("Yellow Zone")], dtype=np.int32)
+
+    per_month = np.full(len(months), rows // len(months))
+    per_month[:rows % len(months)] += 1
+    files = []
+    for i, (month, count) in enumerate(zip(months, per_month)):
+        rng = np.random.default_rng([seed, i])
+        path = os.path.join(out_dir, f"yellow_tripdata_{month}.parquet")
+        with pq.ParquetWriter(path, RAW_SCHEMA) as writer:
+            remaining = int(count)
+            while remaining:
+                n = min(remaining, chunk_rows)
+                writer.write_batch(trip_batch(rng, n, month, zone_ids, zone_p, airports, yellow))
+                remaining -= n
+        files.append(path)
+    return files
+
+
+# ============== 计时 ==============
+
+def _timed(stages, name, rows, func, *args, **kwargs):
+    """执行一个阶段并记录耗时和吞吐量"""
+    print(f"▶ {name} ...")
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    stages[name] = {
+        "seconds": round(seconds, 3),
+        "rows": int(rows(result) if callable(rows) else rows),
+    }
+    stages[name]["rows_per_sec"] = round(stages[name]["rows"] / max(seconds, 1e-9))
+    print(f"  {name}: {stages[name]['rows']:,} rows in {seconds:.1f}s ({stages[name]['rows_per_sec']:,} rows/sec)")
+    return result
+
+
+def _failed(result):
+    # analysis.py 的函数把错误放在返回值里
+    return isinstance(result, dict) and result.get("success") is False
+
+
+def time_cases(cases, repeat):
+    """依次运行每个查询：首次调用（冷）+ repeat 次重复调用的最小 / 中位数 / 最大耗时（毫秒）"""
+    import analysis
+    report = {}
+    for label, func_name, kwargs in cases:
+        func = getattr(analysis, func_name)
+        started = time.perf_counter()
+        result = func(**kwargs)
+        cold = (time.perf_counter() - started) * 1000
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func(**kwargs)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        report[label] = {
+            "function": func_name,
+            "params": kwargs,
+            "ok": not _failed(result),
+            "cold_ms": round(cold, 2),
+            "min_ms": round(timings[0], 2),
+            "median_ms": round(timings[len(timings) // 2], 2),
+            "max_ms": round(timings[-1], 2),
+        }
+        status = "" if report[label]["ok"] else f"  ❌ {result.get('error')}"
+        print(f"  {label:<28}{cold:>10.1f}{report[label]['median_ms']:>12.1f}{status}")
+    return report
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _raw_files(rows, start, end, seed, work_dir, stages):
+    """生成（或复用同样参数生成过的）原始数据"""
+    raw_dir = os.path.join(work_dir, f"raw-{format_rows(rows)}-{start}-{end}-s{seed}")
+    manifest_path = os.path.join(raw_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        print(f"Reusing {manifest['rows']:,} generated rows in {raw_dir}")
+        return raw_dir
+    shutil.rmtree(raw_dir, ignore_errors=True)
+    files = _timed(stages, "generate", rows, generate_raw, rows, raw_dir, start, end, seed)
+    # 清单最后写入：中途失败的目录不会被复用
+    with open(manifest_path, "w") as f:
+        json.dump({"rows": rows, "start": start, "end": end, "seed": seed,
+                   "files": [os.path.basename(p) for p in files]}, f, indent=2)
+    return raw_dir
+
+
+def _load_postgres(clean_dir, workers, stages):
+    """loader.py 的 COPY + 派生表重建，各自计时"""
+    import loader
+    import rollup
+    import sample
+    import timeseries
+    import topk
+    import versions
+    from backends import PostgresBackend
+    from arrival_rates import ArrivalRates
+    from fare_matrix import FareMatrix
+    from quantiles import QuantileSketches
+
+    _timed(stages, "copy", lambda results: sum(r["rows"] for r in results),
+           loader.load_parquet, clean_dir, workers, truncate=True, refresh=False)
+    rows = stages["copy"]["rows"]
+    _timed(stages, "rollup", rows, rollup.refresh_rollup)
+    _timed(stages, "sample", rows, sample.refresh_sample)
+    _timed(stages, "topk", rows, topk.refresh_topk)
+    _timed(stages, "timeseries", rows, timeseries.refresh_series)
+    # 费用矩阵、分位数摘要和到达率模型只计时，不覆盖项目目录下的 .npz 文件
+    _timed(stages, "fare_matrix", rows, FareMatrix.from_db)
+    _timed(stages, "quantiles", rows, QuantileSketches.from_db)
+    _timed(stages, "arrival_rates", rows, ArrivalRates.from_db)
+    versions.bump_version("taxi")
+    return PostgresBackend()
+
+
+def _load_duckdb(clean_dir, stages):
+    """DuckDB 首次查询时在 parquet 上建视图和 trip_rollup"""
+    from backends import DuckDBBackend
+    backend = DuckDBBackend(clean_dir)
+    _timed(stages, "rollup", lambda result: result[1][0][0],
+           backend.fetch, "SELECT SUM(trip_count) FROM trip_rollup;")
+    return backend
+
+
+def run_benchmark(rows, engine="duckdb", start="2023-07-01", end="2025-01-01", seed=0,
+                  repeat=5, workers=None, memory_mb=1024, work_dir=None):
+    """完整的基准测试，返回报告（dict）"""
+    import pipeline
+    from backends import BENCHMARK_CASES, set_backend
+
+    work_dir = os.path.join(PROJECT_DIR, work_dir or BENCHMARK_CONFIG["work_dir"])
+    stages = {}
+    raw_dir = _raw_files(rows, start, end, seed, work_dir, stages)
+    clean_dir = os.path.join(work_dir, f"clean-{engine}")
+    # pipeline.py 的日期窗口两端都包含
+    _timed(stages, "clean", lambda months: sum(months.values()), pipeline.run_pipeline,
+           os.path.join(raw_dir, "*.parquet"), clean_dir, start, end, memory_mb)
+
+    if engine == "postgres":
+        backend = _load_postgres(clean_dir, workers, stages)
+    else:
+        backend = _load_duckdb(clean_dir, stages)
+
+    previous = set_backend(backend)
+    try:
+        print(f"\n  {'case':<28}{'cold ms':>10}{'median ms':>12}")
+        cases = time_cases(BENCHMARK_CASES, repeat)
+    finally:
+        set_backend(previous)
+
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "engine": engine,
+        "rows": rows,
+        "months": [start, end],
+        "seed": seed,
+        "repeat": repeat,
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "stages": stages,
+        "cases": cases,
+    }
+
+
+def save_report(report, report_dir=None):
+    report_dir = os.path.join(PROJECT_DIR, report_dir or BENCHMARK_CONFIG["report_dir"])
+    os.makedirs(report_dir, exist_ok=True)
+    stamp = datetime.fromisoformat(report["created_at"]).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(report_dir, f"{report['engine']}-{format_rows(report['rows'])}-{stamp}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+# ============== 退化检查 ==============
+
+def compare_reports(baseline, current, ratio=None, min_delta_ms=None):
+    """
+    比较两份报告，返回退化列表
+
+    查询：重复调用的中位数比基准慢 ratio 倍以上，且差值超过 min_delta_ms
+    ETL 阶段：耗时按同样的规则比较（两份报告的行数不同时只比较查询）
+    """
+    ratio = ratio or BENCHMARK_CONFIG["regression_ratio"]
+    min_delta_ms = BENCHMARK_CONFIG["min_delta_ms"] if min_delta_ms is None else min_delta_ms
+    for key in ("engine", "rows"):
+        if baseline.get(key) != current.get(key):
+            print(f"⚠️  Reports differ in {key}: {baseline.get(key)} vs {current.get(key)}")
+
+    def check(kind, name, before, after):
+        if after > before * ratio and after - before > min_delta_ms:
+            return {"kind": kind, "name": name, "baseline_ms": before, "current_ms": after,
+                    "ratio": round(after / max(before, 1e-9), 2)}
+        return None
+
+    regressions = []
+    for name, case in current["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        if base["ok"] and not case["ok"]:
+            regressions.append({"kind": "case", "name": name, "error": "query failed"})
+            continue
+        regressions.append(check("case", name, base["median_ms"], case["median_ms"]))
+    if baseline.get("rows") == current.get("rows"):
+        for name, stage in current["stages"].items():
+            base = baseline["stages"].get(name)
+            if base is not None:
+                regressions.append(check("stage", name, base["seconds"] * 1000, stage["seconds"] * 1000))
+    return [r for r in regressions if r is not None]
+
+
+def print_comparison(baseline, current, regressions):
+    print(f"\nBaseline {baseline.get('git_commit')} ({baseline['created_at']}) "
+          f"-> current {current.get('git_commit')} ({current['created_at']})")
+    print(f"{'case':<28}{'baseline ms':>14}{'current ms':>14}{'change':>10}")
+    for name, case in current["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is not None:
+            change = case["median_ms"] / max(base["median_ms"], 1e-9)
+            print(f"{name:<28}{base['median_ms']:>14.1f}{case['median_ms']:>14.1f}{change:>9.2f}x")
+    if not regressions:
+        print("✅ No regressions")
+    for r in regressions:
+        detail = r.get("error") or f"{r['baseline_ms']:.1f} ms -> {r['current_ms']:.1f} ms ({r['ratio']}x)"
+        print(f"❌ {r['kind']} {r['name']}: {detail}")
+
+
+def _load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ETL path and analysis queries on synthetic trips")
+    parser.add_argument("--rows", default="1M", help="合成行程数，如 1M / 10M / 100M")
+    parser.add_argument("--engine", choices=["duckdb", "postgres"], default="duckdb")
+    parser.add_argument("--start", default="2023-07-01", help="第一个月份")
+    parser.add_argument("--end", default="2025-01-01", help="最后一个月份之后的月份")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="每个查询的重复次数")
+    parser.add_argument("--workers", type=int, default=None, help="loader.py 的并行连接数")
+    parser.add_argument("--memory-mb", type=int, default=1024, help="pipeline.py 排序阶段的内存预算")
+    parser.add_argument("--allow-truncate", action="store_true", help="postgres 引擎：允许清空目标库的 yellow_taxi_clean")
+    parser.add_argument("--baseline", default=None, help="与之前的报告比较，有退化时退出码为 1")
+    parser.add_argument("--ratio", type=float, default=None, help="退化阈值（倍数）")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="只比较两份已有的报告")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    if args.compare:
+        baseline, current = (_load_report(p) for p in args.compare)
+    else:
+        if args.engine == "postgres" and not args.allow_truncate:
+            parser.error("--engine postgres truncates yellow_taxi_clean in the configured database; "
+                         "point PG_DB at a benchmark database and pass --allow-truncate")
+        current = run_benchmark(parse_rows(args.rows), args.engine, args.start, args.end, args.seed,
+                                args.repeat, args.workers, args.memory_mb)
+        print(f"\n✅ Report written to {save_report(current)}")
+        if not args.baseline:
+            return 1 if any(not c["ok"] for c in current["cases"].values()) else 0
+        baseline = _load_report(args.baseline)
+
+    regressions = compare_reports(baseline, current, args.ratio)
+    print_comparison(baseline, current, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
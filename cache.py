@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response
+
+import versions
+from config import CACHE_CONFIG
+
+
+class ResponseCache:
+    """按 (接口, 查询参数, 数据集版本) 缓存 JSON 响应，LRU 淘汰"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._seen_versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, dataset, body, mimetype):
+        # ETag 由版本号和响应内容共同决定（强校验）
+        etag = hashlib.sha1(f"{key[-1]}:".encode() + body).hexdigest()
+        entry = (body, mimetype, etag, dataset)
+        if len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = entry
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+                self.evictions += 1
+        return entry
+
+    def observe_version(self, dataset, version):
+        """发现数据集版本变化时，清掉该数据集的旧条目"""
+        with self._lock:
+            if self._seen_versions.get(dataset) == version:
+                return
+            self._seen_versions[dataset] = version
+            stale = [k for k, e in self._entries.items() if e[3] == dataset and k[-1] != version]
+            for k in stale:
+                self._bytes -= len(self._entries.pop(k)[0])
+            self.invalidations += len(stale)
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "versions": dict(self._seen_versions)
+            }
+
+
+response_cache = ResponseCache(CACHE_CONFIG["max_entries"], CACHE_CONFIG["max_bytes"])
+
+
+def _respond(entry):
+    body, mimetype, etag, _ = entry
+    if request.if_none_match.contains(etag):
+        response_cache.record_not_modified()
+        response = make_response("", 304)
+    else:
+        response = make_response(body)
+        response.mimetype = mimetype
+    response.set_etag(etag)
+    # 浏览器每次都带 If-None-Match 重新验证
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def cached(dataset):
+    """Flask 路由装饰器：只缓存 200 的响应"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = versions.get_version(dataset)
+            response_cache.observe_version(dataset, version)
+            params = tuple(sorted(request.args.items(multi=True)))
+            key = (request.path, params, version)
+            entry = response_cache.get(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # 接口内部捕获的错误（success: false）不缓存
+                payload = response.get_json(silent=True)
+                if isinstance(payload, dict) and payload.get("success") is False:
+                    return response
+                entry = response_cache.put(key, dataset, response.get_data(), response.mimetype)
+            return _respond(entry)
+        return wrapper
+    return decorator
+
+
+def cached_async(dataset):
+    """cached 的 Quart 版本（asgi_app.py），与 Flask 应用共用同样的缓存逻辑"""
+    from quart import request as quart_request, make_response as quart_make_response
+
+    async def respond(entry):
+        body, mimetype, etag, _ = entry
+        if quart_request.if_none_match.contains(etag):
+            response_cache.record_not_modified()
+            response = await quart_make_response("", 304)
+        else:
+            response = await quart_make_response(body)
+            response.mimetype = mimetype
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            # 版本号有短时间缓存，过期时才会访问数据库，放到线程里避免阻塞事件循环
+            version = await asyncio.to_thread(versions.get_version, dataset)
+            response_cache.observe_version(dataset, version)
+            params = tuple(sorted(quart_request.args.items(multi=True)))
+            key = (quart_request.path, params, version)
+            entry = response_cache.get(key)
+            if entry is None:
+                response = await quart_make_response(await view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                payload = await response.get_json(silent=True)
+                if isinstance(payload, dict) and payload.get("success") is False:
+                    return response
+                entry = response_cache.put(key, dataset, await response.get_data(), response.mimetype)
+            return await respond(entry)
+        return wrapper
+    return decorator
@@ -0,0 +1,217 @@
+"""
+按列存放的查询结果和 API 响应格式
+
+Table: 查询结果直接按列存成 numpy 数组，不经过 DataFrame，也不为每行建字典；
+按下标 / 迭代访问时表现为原来的 records 列表，所以 analysis.py 的调用方不需要改动。
+
+FastJSONProvider: 用 orjson 序列化（numpy 数组原样输出），并支持 ?format= 参数：
+    json     默认，与原来相同的 records 结构
+    columns  按列的 JSON：records 列表变成 {列名: [值, ...]}
+    arrow    Arrow IPC stream（application/vnd.apache.arrow.stream），只适用于表格型结果，
+             其他结果按 columns 输出
+"""
+import time
+from collections.abc import Sequence
+from decimal import Decimal
+
+import numpy as np
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+import metrics
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+FORMATS = ("json", "columns", "arrow")
+
+# 与 Flask 默认的 jsonify 一致：键排序
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
+
+def _to_array(values):
+    """一列 Python 值 -> numpy 数组；含 NULL 的数值列转成 float（NaN），与 pd.read_sql 相同"""
+    arr = np.asarray(values)
+    if arr.dtype == object:
+        try:
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        except (TypeError, ValueError):
+            return np.array(values, dtype=object)
+    return arr
+
+
+def _to_list(column):
+    return column.tolist() if isinstance(column, np.ndarray) else list(column)
+
+
+class Table(Sequence):
+    """按列存放的查询结果（列名 -> 等长的数组）"""
+
+    def __init__(self, columns):
+        self.columns = dict(columns)
+        lengths = {len(v) for v in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def from_rows(cls, names, rows):
+        if not rows:
+            return cls({n: np.empty(0, dtype=np.float64) for n in names})
+        return cls({n: _to_array(c) for n, c in zip(names, zip(*rows))})
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Table({n: c[index] for n, c in self.columns.items()})
+        row = {}
+        for n, c in self.columns.items():
+            value = c[index]
+            row[n] = value.item() if isinstance(value, np.generic) else value
+        return row
+
+    def __iter__(self):
+        return iter(self.records())
+
+    def __eq__(self, other):
+        if isinstance(other, Table):
+            other = other.records()
+        return isinstance(other, list) and self.records() == other
+
+    def __repr__(self):
+        return f"Table({len(self)} rows, columns={self.names})"
+
+    def add_column(self, name, values):
+        if len(values) != len(self):
+            raise ValueError(f"Column '{name}' has {len(values)} values, expected {len(self)}")
+        self.columns[name] = values
+        return self
+
+    def records(self):
+        """原来的 records 结构：每行一个字典，值为 Python 标量"""
+        names = self.names
+        lists = [_to_list(c) for c in self.columns.values()]
+        return [dict(zip(names, row)) for row in zip(*lists)]
+
+    def to_columns(self):
+        """按列的结构；数值列保留 numpy 数组，由 orjson 直接序列化"""
+        return {
+            n: c if isinstance(c, np.ndarray) and c.dtype.kind in "biuf" else _to_list(c)
+            for n, c in self.columns.items()
+        }
+
+    def to_arrow(self):
+        import pyarrow as pa
+        return pa.table({n: _narrow(c) for n, c in self.columns.items()})
+
+
+def _narrow(column):
+    """Arrow 输出时整数列用能放下的最小类型（区域编号、小时等只需要 1~2 字节）"""
+    if isinstance(column, np.ndarray) and column.dtype.kind in "iu" and len(column):
+        lo, hi = column.min(), column.max()
+        for dtype in (np.int8, np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if info.min <= lo and hi <= info.max:
+                return column.astype(dtype)
+    if isinstance(column, np.ndarray) and column.dtype.kind in "biuf":
+        return column
+    return _to_list(column)
+
+
+def _default(obj):
+    if isinstance(obj, Table):
+        return obj.records()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj, indent=False):
+    """orjson 序列化为 bytes（NaN 输出为 null）"""
+    options = JSON_OPTIONS | orjson.OPT_INDENT_2 if indent else JSON_OPTIONS
+    return orjson.dumps(obj, default=_default, option=options)
+
+
+def _is_records(value):
+    return isinstance(value, list) and value and all(isinstance(r, dict) for r in value)
+
+
+def to_columns(obj):
+    """把结果里的 Table 和 records 列表都转成按列的结构"""
+    if isinstance(obj, Table):
+        return obj.to_columns()
+    if _is_records(obj):
+        names = list(dict.fromkeys(k for r in obj for k in r))
+        return {n: [r.get(n) for r in obj] for n in names}
+    if isinstance(obj, dict):
+        return {k: to_columns(v) for k, v in obj.items()}
+    return obj
+
+
+def to_arrow_stream(obj):
+    """表格型结果 -> Arrow IPC stream 字节；其他结果返回 None"""
+    import pyarrow as pa
+    if isinstance(obj, Table):
+        table = obj.to_arrow()
+    elif _is_records(obj):
+        table = pa.Table.from_pylist(obj)
+    else:
+        return None
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask / Quart 共用的 JSON provider（两者都用 app.json.response 实现 jsonify）
+
+    request 是对应框架的 request 代理，用来读取 ?format= 参数
+    """
+
+    def __init__(self, app, request):
+        super().__init__(app)
+        self._request = request
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def _format(self):
+        """(格式, 路由)"""
+        try:
+            fmt = self._request.args.get("format", "json")
+            rule = self._request.url_rule
+        except RuntimeError:
+            # 不在请求上下文中
+            return "json", ""
+        return (fmt if fmt in FORMATS else "json"), (rule.rule if rule is not None else "")
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        fmt, route = self._format()
+        started = time.perf_counter()
+        body, mimetype = self._encode(obj, fmt)
+        metrics.SERIALIZE_SECONDS.observe(time.perf_counter() - started, route, fmt)
+        return self._app.response_class(body, mimetype=mimetype)
+
+    def _encode(self, obj, fmt):
+        if fmt == "arrow":
+            body = to_arrow_stream(obj)
+            if body is not None:
+                return body, ARROW_MIMETYPE
+        if fmt != "json":
+            obj = to_columns(obj)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return dumps(obj, indent) + b"\n", self.mimetype
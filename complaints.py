@@ -0,0 +1,251 @@
+"""
+311 投诉的 MongoDB 查询：时间窗口、坐标范围、空值过滤、小类 -> 大类的分类和计数
+都在服务端的聚合管道里完成，Python 端只接收需要的数值
+
+    ensure_indexes      location_geojson 的 2dsphere 索引 + created_date 复合索引
+                        （asgi_app.py 启动时用 ensure_indexes_async，通过异步客户端创建）
+    descriptor_summary  各大类 / 小类的投诉数（$group + $switch）
+    load_points         坐标和小类编号，批量游标直接写进 numpy 数组
+    complaint_stats     总数和有坐标的投诉数（一次聚合）
+"""
+import threading
+
+import numpy as np
+from pymongo.errors import OperationFailure
+
+import metrics
+from backends import MongoStep, in_event_loop, stepwise
+from db import explain_pipeline, get_mongo_collection
+
+# 与原 notebook 一致的坐标清洗范围（纽约市周边）
+LAT_RANGE = (35, 45)
+LON_RANGE = (-80, -70)
+
+# 小类 -> 大类：按顺序匹配，描述（小写）包含任一关键词即归入该类，都不包含的归入 Other
+CATEGORY_RULES = [
+    ("Driver Behavior Issues", ["driver complaint", "driver report"]),
+    ("Vehicle Issues", ["vehicle complaint"]),
+    ("Company Service Issues", ["car service company"]),
+]
+OTHER_CATEGORY = "Other"
+CATEGORIES = [c for c, _ in CATEGORY_RULES] + [OTHER_CATEGORY]
+
+# 坐标范围对应的 GeoJSON 多边形（边是球面上的测地线，对纽约市的数据没有影响）
+BBOX_POLYGON = {
+    "type": "Polygon",
+    "coordinates": [[
+        [LON_RANGE[0], LAT_RANGE[0]], [LON_RANGE[1], LAT_RANGE[0]],
+        [LON_RANGE[1], LAT_RANGE[1]], [LON_RANGE[0], LAT_RANGE[1]],
+        [LON_RANGE[0], LAT_RANGE[0]]
+    ]]
+}
+
+# 小类名：去掉首尾空格，缺失的记为空字符串
+DESCRIPTOR_EXPR = {"$trim": {"input": {"$toString": {"$ifNull": ["$descriptor", ""]}}}}
+
+INDEXES = [
+    # 坐标范围 + 时间窗口
+    [("location_geojson", "2dsphere"), ("created_date", 1)],
+    # 时间窗口 + 按小类分组
+    [("created_date", 1), ("descriptor", 1)],
+]
+
+# 聚合的批大小（每批只有三个数值，可以取得较大）
+BATCH_SIZE = 50_000
+
+_indexes_ready = False
+# 2dsphere 索引建不起来（例如有格式错误的 GeoJSON）时退回到经纬度字段的范围过滤
+_use_geo = True
+_index_lock = threading.Lock()
+
+
+def classify_descriptor(desc):
+    """分类投诉描述"""
+    desc = str(desc).lower()
+    for category, keywords in CATEGORY_RULES:
+        if any(k in desc for k in keywords):
+            return category
+    return OTHER_CATEGORY
+
+
+def category_expr(descriptor):
+    """classify_descriptor 的聚合表达式版本（$switch）"""
+    text = {"$toLower": descriptor}
+    return {"$switch": {
+        "branches": [
+            {"case": {"$or": [{"$gte": [{"$indexOfCP": [text, k]}, 0]} for k in keywords]}, "then": category}
+            for category, keywords in CATEGORY_RULES
+        ],
+        "default": OTHER_CATEGORY
+    }}
+
+
+def complaint_filter(start=None, end=None):
+    """311 投诉按 created_date 过滤的时间窗口 [start, end)（start / end 为 datetime）"""
+    created = {}
+    if start is not None:
+        created["$gte"] = start
+    if end is not None:
+        created["$lt"] = end
+    return {"created_date": created} if created else {}
+
+
+def _without_geo(error):
+    global _use_geo
+    print(f"⚠️ 2dsphere index on location_geojson unavailable, using latitude/longitude ranges: {error}")
+    _use_geo = False
+
+
+def ensure_indexes(collection=None):
+    """创建查询用到的索引（已存在时不做任何事），每个进程只执行一次"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _index_lock:
+        if _indexes_ready:
+            return
+        collection = collection if collection is not None else get_mongo_collection()
+        for keys in INDEXES:
+            try:
+                collection.create_index(keys)
+            except OperationFailure as e:
+                if keys[0][1] != "2dsphere":
+                    raise
+                _without_geo(e)
+        _indexes_ready = True
+
+
+async def ensure_indexes_async(collection):
+    """ensure_indexes 的异步版本：collection 是 AsyncMongoClient 上的集合（aio.get_mongo_collection）"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    for keys in INDEXES:
+        try:
+            await collection.create_index(keys)
+        except OperationFailure as e:
+            if keys[0][1] != "2dsphere":
+                raise
+            _without_geo(e)
+    _indexes_ready = True
+
+
+def location_match(start=None, end=None):
+    """时间窗口 + 坐标在范围内（同时排除了没有坐标的投诉）"""
+    # 事件循环里不做同步 IO：asgi_app.py 启动时已用异步客户端建好索引
+    if not in_event_loop():
+        ensure_indexes()
+    match = complaint_filter(start, end)
+    if _use_geo:
+        match["location_geojson"] = {"$geoWithin": {"$geometry": BBOX_POLYGON}}
+    else:
+        match["latitude"] = {"$gt": LAT_RANGE[0], "$lt": LAT_RANGE[1]}
+        match["longitude"] = {"$gt": LON_RANGE[0], "$lt": LON_RANGE[1]}
+    return match
+
+
+def _coordinates():
+    """与 location_match 使用同一来源的坐标"""
+    if _use_geo:
+        return (
+            {"$arrayElemAt": ["$location_geojson.coordinates", 1]},
+            {"$arrayElemAt": ["$location_geojson.coordinates", 0]}
+        )
+    return "$latitude", "$longitude"
+
+
+@stepwise
+def descriptor_summary(start=None, end=None):
+    """
+    各大类的投诉数及其包含的小类（只统计坐标有效的投诉）
+
+    返回 {大类: {"count": n, "descriptors": {小类: n}}}
+    """
+    pipeline = [
+        {"$match": location_match(start, end)},
+        {"$group": {"_id": DESCRIPTOR_EXPR, "count": {"$sum": 1}}},
+        # 分类只对不重复的小类做一次
+        {"$group": {
+            "_id": category_expr("$_id"),
+            "count": {"$sum": "$count"},
+            "descriptors": {"$push": {"name": "$_id", "count": "$count"}}
+        }},
+    ]
+    summary = {}
+    for doc in (yield MongoStep(pipeline)):
+        summary[doc["_id"]] = {
+            "count": doc["count"],
+            "descriptors": {d["name"]: d["count"] for d in doc["descriptors"]}
+        }
+    return summary
+
+
+def load_points(start=None, end=None, limit=None):
+    """
+    坐标有效的投诉：纬度、经度、小类编号
+
+    返回 (lat, lon, desc_codes, desc_names, desc_category)：
+        desc_codes 是 desc_names 中的下标，desc_category 是每个小类在 CATEGORIES 中的下标
+    """
+    summary = descriptor_summary(start, end)
+    by_name = {name: CATEGORIES.index(category)
+               for category, info in summary.items() for name in info["descriptors"]}
+    desc_names = sorted(by_name)
+    desc_category = np.array([by_name[d] for d in desc_names], dtype=np.intp)
+    expected = sum(info["count"] for info in summary.values())
+    if limit is not None:
+        expected = min(expected, int(limit))
+
+    lat_expr, lon_expr = _coordinates()
+    pipeline = [{"$match": location_match(start, end)}]
+    if limit is not None:
+        pipeline.append({"$limit": int(limit)})
+    # 每条投诉只返回一个三元数组，不在 Python 端构建字典列表 / DataFrame
+    pipeline.append({"$project": {"_id": 0, "p": [
+        {"$ifNull": [lat_expr, float("nan")]},
+        {"$ifNull": [lon_expr, float("nan")]},
+        {"$indexOfArray": [desc_names, DESCRIPTOR_EXPR]}
+    ]}})
+
+    points = np.empty((max(expected, 1), 3), dtype=np.float64)
+    n = 0
+    timer = metrics.QueryTimer("mongo", pipeline, explain=lambda: explain_pipeline(pipeline))
+    cursor = get_mongo_collection().aggregate(pipeline, batchSize=BATCH_SIZE, allowDiskUse=True)
+    timer.lap("execute")
+    for doc in cursor:
+        if n == len(points):
+            # 两次聚合之间有新数据写入
+            points = np.resize(points, (2 * len(points), 3))
+        points[n] = doc["p"]
+        n += 1
+    points = points[:n]
+    timer.lap("fetch")
+    timer.done(n)
+
+    lat, lon, codes = points[:, 0], points[:, 1], points[:, 2].astype(np.intp)
+    # 第二次聚合时才出现的小类编号为 -1，和坐标缺失的一起丢掉
+    keep = (codes >= 0) & np.isfinite(lat) & np.isfinite(lon)
+    return lat[keep], lon[keep], codes[keep], desc_names, desc_category
+
+
+def _present(field):
+    """字段存在且不为 null"""
+    return {"$ne": [{"$ifNull": [field, None]}, None]}
+
+
+@stepwise
+def complaint_stats(start=None, end=None):
+    """投诉总数和有坐标的投诉数（一次扫描）"""
+    pipeline = [
+        {"$match": complaint_filter(start, end)},
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "with_location": {"$sum": {"$cond": [
+                {"$and": [_present("$latitude"), _present("$longitude")]}, 1, 0
+            ]}}
+        }},
+    ]
+    docs = yield MongoStep(pipeline)
+    result = docs[0] if docs else {}
+    return result.get("total", 0), result.get("with_location", 0)
@@ -0,0 +1,298 @@
+"""
+311 投诉分块导入 MongoDB：代替 nosql.ipynb 里一次读完整个 CSV、逐行 apply、一次 insert_many 的做法
+
+    读取    pd.read_csv 按 chunk_rows 行分块流式读取，内存只保留有限的几块
+    清洗    与 notebook 相同的列名规范化、删除列、去掉没有坐标的行、日期解析、文本 strip + title，
+            全部是按列的向量化操作；另外去掉经纬度超出 WGS84 范围的行（否则 2dsphere 索引建不起来）
+    GeoJSON location_geojson 用 Arrow 的 struct 列一次构造，文档由 Arrow 直接转成字典
+    写入    有界的线程池并行执行无序批量写入（insert_many(ordered=False)），
+            _id 取 unique_key，重复导入同一块时已存在的文档作为重复键跳过，不会写出重复数据
+    断点    每块写完后把块号记入检查点文件；失败后重新运行会跳过已完成的块，只重做剩下的
+
+导入结束后建索引（complaints.ensure_indexes）并把 311 的数据版本号加一，报告每块和整体的 docs/sec。
+
+用法:
+    python complaints_loader.py --input 311_Service_Requests_from_2010_to_Present_20251115.csv
+    python complaints_loader.py --input ... --workers 8 --chunk-rows 100000
+    python complaints_loader.py --input ... --drop    # 清空集合和检查点，重新导入
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pymongo.errors import BulkWriteError
+
+from config import COMPLAINTS_LOAD_CONFIG, MONGO_COLLECTION
+from db import get_mongo_collection
+
+# 与 nosql.ipynb 相同的清洗规则
+DROP_COLUMNS = [
+    "facility_type",
+    "due_date",
+    "vehicle_type",
+    "taxi_company_borough",
+    "bridge_highway_name",
+    "bridge_highway_direction",
+    "road_ramp",
+    "bridge_highway_segment",
+    "location",
+]
+DATE_COLUMNS = ["created_date", "closed_date", "resolution_action_updated_date"]
+TEXT_COLUMNS = ["agency", "agency_name", "complaint_type", "descriptor", "city", "borough", "location_type"]
+# notebook 里 pd.read_csv 推断为数值的列：按块读取时全部先读成字符串，再统一转成 float，
+# 每列在各块之间、与原有集合里的文档类型一致（无法解析的值为 null）；其余列保持字符串
+FLOAT_COLUMNS = [
+    "incident_zip",
+    "bbl",
+    "x_coordinate_(state_plane)",
+    "y_coordinate_(state_plane)",
+    "latitude",
+    "longitude",
+]
+KEY_COLUMN = "unique_key"
+
+# NYC Open Data 导出 CSV 的时间格式；不符合的值再按通用格式解析
+DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+DUPLICATE_KEY = 11000
+
+
+def normalize_columns(columns):
+    """列名规范化：去空格、小写，空格 / 斜杠 / 连字符换成下划线"""
+    return (
+        pd.Index(columns)
+        .str.strip()
+        .str.lower()
+        .str.replace(" ", "_")
+        .str.replace("/", "_")
+        .str.replace("-", "_")
+    )
+
+
+def _parse_dates(values):
+    parsed = pd.to_datetime(values, format=DATE_FORMAT, errors="coerce")
+    retry = parsed.isna() & values.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry], format="mixed", errors="coerce")
+    return parsed
+
+
+def clean_chunk(df, first_row=0, source=""):
+    """
+    清洗一块原始数据，返回 Arrow 表（每行一个文档）
+
+    first_row 是这一块第一行在文件中的行号；没有 unique_key 列时用 "文件名:行号" 作为 _id
+    """
+    df = df.copy()
+    df.columns = normalize_columns(df.columns)
+    if KEY_COLUMN in df.columns:
+        ids = pd.to_numeric(df[KEY_COLUMN], errors="coerce")
+        df[KEY_COLUMN] = ids
+    else:
+        ids = pd.Series([f"{source}:{i}" for i in range(first_row, first_row + len(df))], index=df.index)
+    df.insert(0, "_id", ids)
+    df = df.drop(columns=DROP_COLUMNS, errors="ignore")
+
+    for col in FLOAT_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    lat, lon = df.get("latitude"), df.get("longitude")
+    if lat is None or lon is None:
+        return pa.table({})
+    keep = lat.between(-90, 90) & lon.between(-180, 180) & df["_id"].notna()
+    df = df[keep]
+
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = _parse_dates(df[col])
+    for col in TEXT_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].str.strip().str.title()
+    if KEY_COLUMN in df.columns:
+        df["_id"] = df["_id"].astype(np.int64)
+        df[KEY_COLUMN] = df[KEY_COLUMN].astype(np.int64)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # BSON 的日期是毫秒精度；转成毫秒后 to_pylist 得到 datetime 而不是 pandas.Timestamp
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.timestamp("ms")))
+    coordinates = pa.FixedSizeListArray.from_arrays(
+        pa.array(np.column_stack([df["longitude"].to_numpy(), df["latitude"].to_numpy()]).ravel()), 2
+    )
+    geojson = pa.StructArray.from_arrays(
+        [pa.repeat("Point", len(df)).cast(pa.string()), coordinates], ["type", "coordinates"]
+    )
+    return table.append_column("location_geojson", geojson)
+
+
+def insert_chunk(collection, index, chunk, first_row, source):
+    """worker 线程：清洗一块并无序批量写入，返回这一块的统计"""
+    started = time.time()
+    table = clean_chunk(chunk, first_row, source)
+    docs = table.to_pylist()
+    inserted, duplicates = len(docs), 0
+    if docs:
+        try:
+            collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            # 上次中断前已经写入的文档：重复键，跳过
+            if any(err.get("code") != DUPLICATE_KEY for err in errors):
+                raise
+            duplicates = len(errors)
+            inserted = e.details.get("nInserted", len(docs) - duplicates)
+    return {
+        "chunk": index,
+        "rows": len(chunk),
+        "inserted": inserted,
+        "duplicates": duplicates,
+        "dropped": len(chunk) - len(docs),
+        "seconds": time.time() - started,
+        "thread": threading.current_thread().name,
+    }
+
+
+# ---- 检查点 ----
+
+def checkpoint_path(path, collection_name, checkpoint_dir=COMPLAINTS_LOAD_CONFIG["checkpoint_dir"]):
+    return os.path.join(checkpoint_dir, f"{os.path.basename(path)}.{collection_name}.json")
+
+
+def _signature(path, chunk_rows):
+    """源文件和分块方式；任一变化时旧检查点的块号不再对应相同的数据"""
+    st = os.stat(path)
+    return {"source": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime, "chunk_rows": chunk_rows}
+
+
+def read_checkpoint(path, signature):
+    """已完成的块号集合；检查点不存在或与当前文件不一致时为空"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("signature") != signature:
+        print(f"⚠️  Checkpoint {path} is for a different file or chunk size, starting over")
+        return set()
+    return set(state.get("completed", []))
+
+
+def write_checkpoint(path, signature, completed):
+    # 先写临时文件再替换，中途退出不会留下半个检查点
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"signature": signature, "completed": sorted(completed)}, f)
+    os.replace(tmp, path)
+
+
+def _rate(docs, seconds):
+    return f"{docs / max(seconds, 1e-9):,.0f} docs/sec"
+
+
+def load_complaints(path, workers=None, chunk_rows=None, drop=False, collection=None,
+                    checkpoint_dir=COMPLAINTS_LOAD_CONFIG["checkpoint_dir"]):
+    """
+    分块导入 311 CSV，返回每块的统计
+
+    参数:
+        workers: 并行写入的线程数（同时在途的块最多 2 × workers 个）
+        chunk_rows: 每块的行数，同时是检查点的粒度
+        drop: 导入前清空集合并删除检查点
+    """
+    workers = workers or COMPLAINTS_LOAD_CONFIG["workers"]
+    chunk_rows = chunk_rows or COMPLAINTS_LOAD_CONFIG["chunk_rows"]
+    collection = collection if collection is not None else get_mongo_collection()
+    checkpoint = checkpoint_path(path, collection.name, checkpoint_dir)
+    signature = _signature(path, chunk_rows)
+    if drop:
+        collection.drop()
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    completed = read_checkpoint(checkpoint, signature)
+    if completed:
+        print(f"Resuming {path}: {len(completed)} chunks already loaded")
+    print(f"Loading {path} into {collection.name}: {chunk_rows:,} rows per chunk, {workers} workers")
+
+    source = os.path.basename(path)
+    started = time.time()
+    results, failures = [], []
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            index = pending.pop(future)
+            try:
+                r = future.result()
+            except Exception as e:
+                failures.append(index)
+                print(f"❌ Chunk {index} failed: {e}")
+                continue
+            results.append(r)
+            completed.add(index)
+            write_checkpoint(checkpoint, signature, completed)
+            print(f"  chunk {index}: {r['inserted']:,} docs in {r['seconds']:.1f}s ({_rate(r['inserted'], r['seconds'])})"
+                  + (f", {r['duplicates']:,} already loaded" if r["duplicates"] else ""))
+
+    reader = pd.read_csv(path, chunksize=chunk_rows, dtype=str)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="load311") as pool:
+        for index, chunk in enumerate(reader):
+            if index in completed:
+                continue
+            # 在途的块有上限，读取不会远远跑在写入前面
+            while len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = pool.submit(insert_chunk, collection, index, chunk, index * chunk_rows, source)
+            pending[future] = index
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+    elapsed = time.time() - started
+
+    # 每个写入线程的汇总
+    per_worker = {}
+    for r in results:
+        w = per_worker.setdefault(r["thread"], {"chunks": 0, "docs": 0, "seconds": 0.0})
+        w["chunks"] += 1
+        w["docs"] += r["inserted"]
+        w["seconds"] += r["seconds"]
+    for name, w in sorted(per_worker.items()):
+        print(f"  worker {name}: {w['chunks']} chunks, {w['docs']:,} docs ({_rate(w['docs'], w['seconds'])})")
+
+    inserted = sum(r["inserted"] for r in results)
+    duplicates = sum(r["duplicates"] for r in results)
+    dropped = sum(r["dropped"] for r in results)
+    print(f"✅ Inserted {inserted:,} documents in {elapsed:.1f}s ({_rate(inserted, elapsed)}); "
+          f"{dropped:,} rows without valid coordinates dropped, {duplicates:,} already present")
+    if failures:
+        print(f"⚠️  {len(failures)} chunks failed (e.g. chunk {min(failures)}); rerun the same command to resume")
+    if inserted:
+        import complaints
+        import versions
+        # 写完再建索引，导入时不需要逐条维护 2dsphere 索引
+        complaints.ensure_indexes(collection)
+        versions.bump_version("311")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunked, resumable 311 CSV loader for MongoDB")
+    parser.add_argument("--input", required=True, help="311 Service Requests CSV")
+    parser.add_argument("--workers", type=int, default=None, help="并行写入的线程数")
+    parser.add_argument("--chunk-rows", type=int, default=None, help="每块的行数（检查点粒度）")
+    parser.add_argument("--collection", default=MONGO_COLLECTION)
+    parser.add_argument("--drop", action="store_true", help="清空集合和检查点，重新导入")
+    args = parser.parse_args()
+    load_complaints(args.input, args.workers, args.chunk_rows, drop=args.drop,
+                    collection=get_mongo_collection(args.collection))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+
+# 数据库配置（可通过环境变量覆盖）
+PG_CONFIG = {
+    "host": os.environ.get("PG_HOST", "localhost"),
+    "port": int(os.environ.get("PG_PORT", 5432)),
+    "dbname": os.environ.get("PG_DB", "taxi"),
+    "user": os.environ.get("PG_USER", "postgres"),
+    "password": os.environ.get("PG_PASS", "123")
+}
+
+# MongoDB 配置
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = "nyc311"
+MONGO_COLLECTION = "requests"
+
+# PostgreSQL 连接池配置
+PG_POOL_CONFIG = {
+    "min_size": int(os.environ.get("PG_POOL_MIN", 2)),
+    "max_size": int(os.environ.get("PG_POOL_MAX", 10)),
+    "timeout": 30.0,          # 获取连接的最长等待秒数
+    "max_idle": 600.0,        # 空闲连接回收时间
+    "max_lifetime": 3600.0,   # 连接最长存活时间
+    "check_interval": 60.0    # 后台健康检查间隔
+}
+
+# MongoDB 客户端连接池配置
+MONGO_POOL_CONFIG = {
+    "minPoolSize": int(os.environ.get("MONGO_POOL_MIN", 0)),
+    "maxPoolSize": int(os.environ.get("MONGO_POOL_MAX", 20)),
+    "waitQueueTimeoutMS": 30000,
+    "serverSelectionTimeoutMS": 5000
+}
+
+# API 响应缓存配置
+CACHE_CONFIG = {
+    "max_entries": int(os.environ.get("CACHE_MAX_ENTRIES", 512)),
+    "max_bytes": int(os.environ.get("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+}
+
+# analysis.py 的查询后端："postgres" 或 "duckdb"（直接查询 parquet，不需要数据库服务）
+QUERY_BACKEND = os.environ.get("QUERY_BACKEND", "postgres")
+# duckdb 后端读取的 parquet：pipeline.py 的输出目录或 glob
+TAXI_PARQUET_PATH = os.environ.get("TAXI_PARQUET_PATH", "yellow_taxi_clean_parquet")
+DUCKDB_CONFIG = {
+    "threads": int(os.environ["DUCKDB_THREADS"]) if "DUCKDB_THREADS" in os.environ else None,
+    "memory_limit": os.environ.get("DUCKDB_MEMORY_LIMIT")
+}
+
+# 后台任务（jobs.py）：重计算放到线程池里执行，结果 gzip 后保存到磁盘，数据版本不变时直接复用
+JOB_CONFIG = {
+    "workers": int(os.environ.get("JOB_WORKERS", 2)),
+    "artifact_dir": os.environ.get("JOB_ARTIFACT_DIR", "job_artifacts"),
+    "max_jobs": 256               # 内存中保留的任务记录数
+}
+
+# 指标与慢查询日志（metrics.py）：超过阈值的查询连同参数和执行计划写入日志
+METRICS_CONFIG = {
+    "slow_query_ms": float(os.environ.get("SLOW_QUERY_MS", 500)),
+    "slow_query_log": os.environ.get("SLOW_QUERY_LOG", "slow_queries.jsonl"),
+    "explain": os.environ.get("SLOW_QUERY_EXPLAIN", "1") != "0",   # 是否记录 EXPLAIN (ANALYZE, BUFFERS)
+    "explain_interval": 300.0,    # 同一条查询在这段时间内只 EXPLAIN 一次（秒）
+    "recent_slow_queries": 50     # 内存中保留的最近慢查询数（/api/system/slow-queries）
+}
+
+# 合成数据基准测试（bench.py）
+BENCHMARK_CONFIG = {
+    "work_dir": os.environ.get("BENCH_WORK_DIR", "benchmark_data"),        # 生成的原始 / 清洗后 parquet
+    "report_dir": os.environ.get("BENCH_REPORT_DIR", "benchmark_reports"),  # JSON 报告
+    "regression_ratio": 1.25,     # 比基准慢 25% 以上视为退化
+    "min_delta_ms": 5.0           # 同时绝对差值要超过这个值（忽略毫秒级的抖动）
+}
+
+# 近似查询的分层样本（sample.py）：每个 上车区域 × 月份 抽 max(min_rows, rate × 行数) 行
+SAMPLE_CONFIG = {
+    "rate": float(os.environ.get("SAMPLE_RATE", 0.01)),
+    "min_rows": int(os.environ.get("SAMPLE_MIN_ROWS", 30)),
+    "confidence": 0.95            # 置信区间的置信水平
+}
+
+# 热门路线的 top-K 摘要（topk.py）：每月保存的路线数
+TOPK_CONFIG = {
+    "route_capacity": int(os.environ.get("TOPK_ROUTES", 1000))
+}
+
+# 分位数摘要（quantiles.py）：对数分桶的相对误差和返回的百分位
+QUANTILE_CONFIG = {
+    "relative_accuracy": float(os.environ.get("QUANTILE_ACCURACY", 0.01)),
+    "percentiles": (50, 90)
+}
+
+# 时间序列金字塔（timeseries.py）：按区域保存的分辨率和时间线的默认点数
+TIMESERIES_CONFIG = {
+    "zone_resolutions": ("day", "week"),    # 5 分钟和小时只保存全市的序列
+    "max_points": int(os.environ.get("TIMELINE_MAX_POINTS", 500)),
+    "max_points_limit": 5000      # ?points= 参数的上限
+}
+
+# 311 CSV 分块导入 MongoDB（complaints_loader.py）
+COMPLAINTS_LOAD_CONFIG = {
+    "chunk_rows": int(os.environ.get("COMPLAINTS_CHUNK_ROWS", 50_000)),
+    "workers": int(os.environ.get("COMPLAINTS_LOAD_WORKERS", 4)),            # 并行写入的线程数
+    "checkpoint_dir": os.environ.get("COMPLAINTS_CHECKPOINT_DIR", "load_checkpoints")
+}
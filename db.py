@@ -0,0 +1,219 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg
+from psycopg.types.numeric import FloatLoader
+from psycopg_pool import ConnectionPool, PoolTimeout
+from pymongo import MongoClient, monitoring
+
+from config import PG_CONFIG, PG_POOL_CONFIG, MONGO_URI, MONGO_DB, MONGO_COLLECTION, MONGO_POOL_CONFIG
+
+# 进程级共享的连接池 / 客户端
+_pg_pool = None
+_mongo_client = None
+_health_thread = None
+_stop_event = threading.Event()
+_lock = threading.Lock()
+
+
+class _WaitStats:
+    """记录获取连接的等待时间"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquired = 0
+            self.timeouts = 0
+            self.total_wait_ms = 0.0
+            self.max_wait_ms = 0.0
+
+    def record(self, wait_ms):
+        with self._lock:
+            self.acquired += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": self.total_wait_ms / self.acquired if self.acquired else 0.0,
+                "max_wait_ms": self.max_wait_ms
+            }
+
+
+_pg_wait = _WaitStats()
+_mongo_wait = _WaitStats()
+
+
+class _MongoPoolListener(monitoring.ConnectionPoolListener):
+    """统计 MongoDB 连接池的 checkout 等待时间"""
+
+    def connection_checked_out(self, event):
+        _mongo_wait.record(getattr(event, "duration", 0.0) * 1000)
+
+    def connection_check_out_failed(self, event):
+        _mongo_wait.record_timeout()
+
+    # 其余事件不需要处理
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+def configure_connection(conn):
+    """NUMERIC 直接解析成 float，不经过 Decimal（与 pd.read_sql 的 coerce_float 结果相同）"""
+    conn.adapters.register_loader("numeric", FloatLoader)
+
+
+def _health_check_loop(interval):
+    """后台定期检查空闲连接是否可用"""
+    while not _stop_event.wait(interval):
+        try:
+            if _pg_pool is not None:
+                _pg_pool.check()
+        except Exception as e:
+            print(f"PostgreSQL pool health check failed: {e}")
+
+
+def init_pools(postgres=True, mongo=True):
+    """
+    初始化 PostgreSQL 连接池和 MongoDB 客户端（重复调用无副作用）
+
+    按需创建时只初始化用到的那一个：只读 311 数据的进程（例如 asgi_app.py 在线程里构建热力网格）不会建 PostgreSQL 连接池
+    """
+    global _pg_pool, _mongo_client, _health_thread
+    with _lock:
+        if postgres and _pg_pool is None:
+            pool_config = dict(PG_POOL_CONFIG)
+            check_interval = pool_config.pop("check_interval")
+            _pg_pool = ConnectionPool(
+                kwargs=PG_CONFIG,
+                check=ConnectionPool.check_connection,
+                configure=configure_connection,
+                name="taxi",
+                open=True,
+                **pool_config
+            )
+            _stop_event.clear()
+            _health_thread = threading.Thread(
+                target=_health_check_loop, args=(check_interval,), daemon=True
+            )
+            _health_thread.start()
+        if mongo and _mongo_client is None:
+            _mongo_client = MongoClient(
+                MONGO_URI, event_listeners=[_MongoPoolListener()], **MONGO_POOL_CONFIG
+            )
+
+
+def close_pools():
+    """关闭连接池和 MongoDB 客户端"""
+    global _pg_pool, _mongo_client, _health_thread
+    with _lock:
+        _stop_event.set()
+        if _health_thread is not None:
+            _health_thread.join(timeout=5)
+            _health_thread = None
+        if _pg_pool is not None:
+            _pg_pool.close()
+            _pg_pool = None
+        if _mongo_client is not None:
+            _mongo_client.close()
+            _mongo_client = None
+
+
+atexit.register(close_pools)
+
+
+@contextmanager
+def get_connection():
+    """从连接池获取 PostgreSQL 连接，退出时自动归还"""
+    if _pg_pool is None:
+        init_pools(mongo=False)
+    start = time.perf_counter()
+    acquired = False
+    try:
+        with _pg_pool.connection() as conn:
+            acquired = True
+            _pg_wait.record((time.perf_counter() - start) * 1000)
+            yield conn
+    except PoolTimeout:
+        if not acquired:
+            _pg_wait.record_timeout()
+        raise
+
+
+def get_mongo_collection(name=MONGO_COLLECTION):
+    """获取共享 MongoDB 客户端上的集合"""
+    if _mongo_client is None:
+        init_pools(postgres=False)
+    return _mongo_client[MONGO_DB][name]
+
+
+def explain_analyze(query, params=None):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) 的文本执行计划（慢查询日志用）
+
+    使用单独的一次性连接，不占用连接池；ANALYZE 会真正执行查询，所以在事务里执行后回滚
+    """
+    with psycopg.connect(**PG_CONFIG) as conn:
+        try:
+            rows = conn.execute("EXPLAIN (ANALYZE, BUFFERS) " + query.strip().rstrip(";"), params).fetchall()
+        finally:
+            conn.rollback()
+    return "\n".join(r[0] for r in rows)
+
+
+def explain_pipeline(pipeline, collection=MONGO_COLLECTION):
+    """聚合管道的 executionStats 执行计划（慢查询日志用，同样使用一次性的客户端）"""
+    with MongoClient(MONGO_URI, serverSelectionTimeoutMS=MONGO_POOL_CONFIG["serverSelectionTimeoutMS"]) as client:
+        return client[MONGO_DB].command(
+            "explain", {"aggregate": collection, "pipeline": pipeline, "cursor": {}},
+            verbosity="executionStats"
+        )
+
+
+def check_health(postgres=True):
+    """检查两个数据库是否可用"""
+    status = {}
+    if postgres:
+        try:
+            with get_connection() as conn:
+                conn.execute("SELECT 1")
+            status["postgres"] = "ok"
+        except Exception as e:
+            status["postgres"] = f"error: {e}"
+    try:
+        if _mongo_client is None:
+            init_pools(postgres=False)
+        _mongo_client.admin.command("ping")
+        status["mongo"] = "ok"
+    except Exception as e:
+        status["mongo"] = f"error: {e}"
+    return status
+
+
+def pool_stats():
+    """连接池状态与获取等待时间统计"""
+    pg = {"wait": _pg_wait.snapshot()}
+    if _pg_pool is not None:
+        pg.update(_pg_pool.get_stats())
+    mongo = {"wait": _mongo_wait.snapshot()}
+    mongo.update({k: v for k, v in MONGO_POOL_CONFIG.items() if k.endswith("PoolSize")})
+    return {"postgres": pg, "mongo": mongo}
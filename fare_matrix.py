@@ -0,0 +1,302 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from backends import SqlStep, TableStep, get_backend, in_event_loop, stepwise
+from partitions import TABLE_NAME, normalize_window, window_condition
+from sample import estimator
+from versions import get_version
+
+# 起点-终点（OD）费用矩阵：LocationID 为 1..265，下标 0 不使用
+N_ZONES = 266
+FARE_MATRIX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fare_matrix.npz")
+
+# 每个 OD 对的统计量（与 get_fare_estimate 原查询一致）
+OD_QUERY = """
+SELECT
+    pulocationid,
+    dolocationid,
+    COUNT(*) as trip_count,
+    AVG(fare_amount) as avg_fare,
+    MIN(fare_amount) as min_fare,
+    MAX(fare_amount) as max_fare,
+    AVG(trip_distance) as avg_distance,
+    AVG(EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60) as avg_duration_min,
+    AVG(total_amount) as avg_total,
+    AVG(tip_amount) as avg_tip
+FROM {source}
+WHERE pulocationid BETWEEN 1 AND 265
+    AND dolocationid BETWEEN 1 AND 265
+    AND fare_amount > 0
+    AND total_amount > 0
+    {filters}
+GROUP BY pulocationid, dolocationid;
+"""
+
+MEASURES = ["avg_fare", "min_fare", "max_fare", "avg_distance", "avg_duration_min", "avg_total", "avg_tip"]
+
+# 检查磁盘文件 / 数据版本是否更新的最小间隔（秒）
+RELOAD_CHECK_INTERVAL = 30
+
+# npz 里没有记录数据版本（旧文件）
+NO_VERSION = -1
+
+
+class FareMatrix:
+    """265×265 的 OD 统计矩阵，查询为 O(1) 数组下标；data_version 是构建时 taxi 数据集的版本号"""
+
+    def __init__(self, trip_count, measures, data_version=NO_VERSION):
+        self.trip_count = trip_count
+        self.measures = measures
+        self.data_version = data_version
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.zeros((N_ZONES, N_ZONES), dtype=np.int32),
+            {m: np.full((N_ZONES, N_ZONES), np.nan, dtype=np.float32) for m in MEASURES}
+        )
+
+    @classmethod
+    def from_db(cls):
+        """一次聚合查询构建整个矩阵（版本号在查询前读取，查询期间数据又有变化时下次检查会再重建）"""
+        version = get_version("taxi")
+        matrix = cls.from_rows(get_backend().fetchall(OD_QUERY.format(source=TABLE_NAME, filters="")))
+        matrix.data_version = version
+        return matrix
+
+    @classmethod
+    def from_rows(cls, rows):
+        """OD_QUERY 的结果行 -> 矩阵"""
+        matrix = cls.empty()
+        if rows:
+            data = np.array(rows, dtype=np.float64)
+            pu = data[:, 0].astype(np.intp)
+            do = data[:, 1].astype(np.intp)
+            matrix.trip_count[pu, do] = data[:, 2]
+            for i, m in enumerate(MEASURES):
+                matrix.measures[m][pu, do] = data[:, 3 + i]
+        return matrix
+
+    @classmethod
+    def load(cls, path=FARE_MATRIX_PATH):
+        with np.load(path) as f:
+            version = int(f["data_version"]) if "data_version" in f.files else NO_VERSION
+            return cls(f["trip_count"], {m: f[m] for m in MEASURES}, version)
+
+    def save(self, path=FARE_MATRIX_PATH):
+        # 先写临时文件再替换，避免其他进程读到一半
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, data_version=np.int64(self.data_version), trip_count=self.trip_count, **self.measures)
+        os.replace(tmp, path)
+
+    def merge(self, delta, sign=1):
+        """
+        合并增量（sign=1，新增的行）或扣除（sign=-1，被替换掉的行）的统计，原地修改
+
+        次数和均值可以精确合并；扣除时若被扣掉的数据包含某个 OD 对的最小 / 最大费用，
+        剩余数据的最值无法得知，返回这些 OD 对的布尔掩码，由调用方重新查询
+        """
+        before = self.trip_count.astype(np.int64)
+        added = delta.trip_count.astype(np.int64)
+        count = before + sign * added
+        has = count > 0
+        touched = added > 0
+        stale = np.zeros_like(has)
+        for m in MEASURES:
+            old, new = self.measures[m], delta.measures[m]
+            if m == "min_fare":
+                if sign > 0:
+                    merged = np.fmin(old, new)
+                else:
+                    merged = old
+                    stale |= touched & has & (new <= old)
+            elif m == "max_fare":
+                if sign > 0:
+                    merged = np.fmax(old, new)
+                else:
+                    merged = old
+                    stale |= touched & has & (new >= old)
+            else:
+                total = np.nan_to_num(old.astype(np.float64)) * before + sign * np.nan_to_num(new.astype(np.float64)) * added
+                merged = np.where(has, total / np.maximum(count, 1), np.nan)
+                merged = np.where(touched, merged, old)
+            self.measures[m] = np.where(has, merged, np.nan).astype(np.float32)
+        self.trip_count = np.maximum(count, 0).astype(np.int32)
+        return stale
+
+    def lookup(self, pickup_zone_id, dropoff_zone_id):
+        """返回某个 OD 对的统计，没有历史数据时返回 None"""
+        if not (0 < pickup_zone_id < N_ZONES and 0 < dropoff_zone_id < N_ZONES):
+            return None
+        count = int(self.trip_count[pickup_zone_id, dropoff_zone_id])
+        if count == 0:
+            return None
+        result = {"trip_count": count}
+        for m in MEASURES:
+            # float32 存储，输出时去掉多余的精度噪声
+            result[m] = round(float(self.measures[m][pickup_zone_id, dropoff_zone_id]), 4)
+        return result
+
+
+@stepwise
+def query_fare_stats(pickup_zone_id, dropoff_zone_id, start=None, end=None, approx=False):
+    """
+    带时间窗口的单个 OD 对统计（矩阵只覆盖全部时间，窗口查询直接读明细表）
+
+    返回值格式与 FareMatrix.lookup 相同；approx=True 时读分层样本，见 approx_fare_stats，
+    样本里没有这个 OD 对的行程时（稀有的 OD 对）改为精确查询，结果里没有 approximate 标记
+    """
+    start, end = normalize_window(start, end)
+    condition, params = window_condition("tpep_pickup_datetime", start, end)
+    if approx:
+        result = yield from approx_fare_stats.steps(pickup_zone_id, dropoff_zone_id, condition, params)
+        if result is not None:
+            return result
+    filters = f"AND pulocationid = %s AND dolocationid = %s AND {condition}"
+    df = yield SqlStep(OD_QUERY.format(source=TABLE_NAME, filters=filters), [pickup_zone_id, dropoff_zone_id] + params)
+    if df.empty:
+        return None
+    row = df.iloc[0]
+    result = {"trip_count": int(row["trip_count"])}
+    for m in MEASURES:
+        # read_sql 把 NULL 转成 NaN
+        result[m] = round(float(row[m]), 4) if row[m] is not None and row[m] == row[m] else None
+    return result
+
+
+@stepwise
+def approx_fare_stats(pickup_zone_id, dropoff_zone_id, condition, params):
+    """
+    在 trip_sample 上估计单个 OD 对的统计，另外返回次数和各均值的置信区间
+
+    最小 / 最大费用无法从样本估计，返回的是样本中的最小 / 最大值
+    """
+    est = estimator(True)
+    query = f"""
+    SELECT
+        {est.count('trip_count')},
+        {est.avg('avg_fare', 'fare_amount')},
+        MIN(fare_amount) as min_fare,
+        MAX(fare_amount) as max_fare,
+        {est.avg('avg_distance', 'trip_distance')},
+        {est.avg('avg_duration_min', 'EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60')},
+        {est.avg('avg_total', 'total_amount')},
+        {est.avg('avg_tip', 'tip_amount')}
+    FROM {est.source}
+    WHERE pulocationid = %s AND dolocationid = %s
+        AND fare_amount > 0
+        AND total_amount > 0
+        AND {condition};
+    """
+    table = est.finish((yield TableStep(query, [pickup_zone_id, dropoff_zone_id] + params)))
+    if len(table) == 0 or not table[0]["sample_rows"]:
+        return None
+    result = {"approximate": True}
+    for name, value in table[0].items():
+        if isinstance(value, float):
+            # NULL 转成的 NaN 输出为 None
+            value = round(value, 4) if value == value else None
+        result[name] = value
+    return result
+
+
+_matrix = None
+_matrix_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+
+def refresh_fare_matrix(path=FARE_MATRIX_PATH):
+    """从数据库重新计算矩阵并写入磁盘（导入新数据后调用）"""
+    start = time.time()
+    matrix = FareMatrix.from_db()
+    _store(matrix, path)
+    pairs = int((matrix.trip_count > 0).sum())
+    print(f"✅ Fare matrix rebuilt: {pairs:,} OD pairs in {time.time() - start:.1f}s")
+    return matrix
+
+
+def _store(matrix, path):
+    global _matrix, _matrix_mtime
+    matrix.save(path)
+    with _lock:
+        _matrix = matrix
+        _matrix_mtime = os.path.getmtime(path)
+
+
+def update_fare_matrix(deltas, fetchall, path=FARE_MATRIX_PATH):
+    """
+    按导入的增量更新矩阵（ingest.py 调用），不重新扫描整张明细表
+
+    参数:
+        deltas: [(sign, rows)]，rows 是 OD_QUERY 在新增（sign=1）或被替换掉（sign=-1）的数据上的结果行
+        fetchall: 在 PostgreSQL 上执行查询的函数 (query, params) -> 行列表
+    只有最小 / 最大费用无法扣除的 OD 对会从明细表重新查询（unnest(int[]) 是 PostgreSQL 的写法，
+    只由 ingest.py 在导入连接上调用，DuckDB 后端的矩阵总是整体重建）
+    """
+    if not os.path.exists(path):
+        return refresh_fare_matrix(path)
+    start = time.time()
+    matrix = FareMatrix.load(path)
+    stale = np.zeros(matrix.trip_count.shape, dtype=bool)
+    for sign, rows in deltas:
+        if rows:
+            stale |= matrix.merge(FareMatrix.from_rows(rows), sign)
+    pu, do = np.nonzero(stale)
+    if len(pu):
+        filters = "AND (pulocationid, dolocationid) IN (SELECT * FROM unnest(%s::int[], %s::int[]))"
+        rows = fetchall(OD_QUERY.format(source=TABLE_NAME, filters=filters), [pu.tolist(), do.tolist()])
+        fresh = FareMatrix.from_rows(rows)
+        matrix.trip_count[pu, do] = fresh.trip_count[pu, do]
+        for m in MEASURES:
+            matrix.measures[m][pu, do] = fresh.measures[m][pu, do]
+    # ingest.py 在写派生文件前已把版本号加一
+    matrix.data_version = get_version("taxi")
+    _store(matrix, path)
+    print(f"✅ Fare matrix updated from {len(deltas)} deltas ({len(pu)} OD pairs recomputed) "
+          f"in {time.time() - start:.1f}s")
+    return matrix
+
+
+def load_fare_matrix(path=FARE_MATRIX_PATH):
+    """启动时加载矩阵：优先读取磁盘缓存，没有或与当前数据版本不一致（DuckDB 的 parquet 有更新等）则从数据库构建"""
+    global _matrix, _matrix_mtime
+    if not os.path.exists(path):
+        return refresh_fare_matrix(path)
+    matrix = FareMatrix.load(path)
+    if matrix.data_version != get_version("taxi"):
+        return refresh_fare_matrix(path)
+    with _lock:
+        _matrix = matrix
+        _matrix_mtime = os.path.getmtime(path)
+    return matrix
+
+
+def get_fare_matrix(path=FARE_MATRIX_PATH):
+    """获取当前矩阵；磁盘文件被其他进程刷新或数据版本变化后自动重新加载 / 重建"""
+    global _last_check
+    if in_event_loop():
+        # asgi_app.py：启动时已在线程里加载，之后由后台任务定期检查
+        if _matrix is None:
+            raise RuntimeError("Fare matrix not loaded yet")
+        return _matrix
+    if _matrix is None:
+        return load_fare_matrix(path)
+    now = time.time()
+    if now - _last_check > RELOAD_CHECK_INTERVAL:
+        _last_check = now
+        changed = os.path.exists(path) and os.path.getmtime(path) != _matrix_mtime
+        if changed or _matrix.data_version != get_version("taxi"):
+            try:
+                return load_fare_matrix(path)
+            except Exception as e:
+                # 重建失败（数据库不可用等）时继续使用内存中的矩阵，下次检查再试
+                print(f"Error reloading fare matrix: {e}")
+    return _matrix
+
+
+if __name__ == "__main__":
+    refresh_fare_matrix()
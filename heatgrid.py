@@ -0,0 +1,185 @@
+"""
+311 投诉热力网格：代替 generate_311_heatmap 返回的整张 folium 地图 HTML
+
+按 Web Mercator（与网页地图相同的投影）把投诉坐标分到固定像素大小的格子里，
+在多个缩放级别上预先计算每个格子在每个图层（全部 / 大类 / 小类）的投诉数。
+前端按当前视野的 bbox 和缩放级别只取看得见的格子，自己画热力层。
+"""
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import versions
+from complaints import CATEGORIES, LAT_RANGE, LON_RANGE, classify_descriptor, load_points
+
+# 预计算的缩放级别：9 约为整个纽约市，16 约为街道
+MIN_ZOOM = 9
+MAX_ZOOM = 16
+# 每个格子在屏幕上的边长（像素），与前端热力点半径相当
+CELL_PX = 8
+TILE_PX = 256
+
+# 与原地图一致：小类图层至少 10 条投诉
+MIN_DESCRIPTOR_COUNT = 10
+
+
+def _to_pixels(lat, lon, zoom):
+    """经纬度 -> 指定缩放级别下的世界像素坐标（Web Mercator）"""
+    scale = TILE_PX * (1 << zoom)
+    x = (lon + 180.0) / 360.0 * scale
+    lat_rad = np.radians(lat)
+    y = (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / math.pi) / 2.0 * scale
+    return x, y
+
+
+def _cell_centers(cx, cy, zoom):
+    """格子编号 -> 格子中心的经纬度"""
+    scale = TILE_PX * (1 << zoom)
+    x = (cx + 0.5) * CELL_PX / scale
+    y = (cy + 0.5) * CELL_PX / scale
+    lon = x * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * y))))
+    return lat, lon
+
+
+class HeatGrid:
+    """多缩放级别的稀疏二维直方图"""
+
+    def __init__(self, lat, lon, desc_codes, desc_names, desc_category=None):
+        """
+        参数:
+            lat, lon: 投诉坐标
+            desc_codes: 每条投诉的小类在 desc_names 中的下标
+            desc_names: 小类名
+            desc_category: 每个小类在 CATEGORIES 中的下标（None 时按 classify_descriptor 分类）
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        desc_codes = np.asarray(desc_codes, dtype=np.intp)
+        keep = (
+            np.isfinite(lat) & np.isfinite(lon)
+            & (lat > LAT_RANGE[0]) & (lat < LAT_RANGE[1])
+            & (lon > LON_RANGE[0]) & (lon < LON_RANGE[1])
+        )
+        lat, lon, desc_codes = lat[keep], lon[keep], desc_codes[keep]
+
+        if desc_category is None:
+            desc_category = [CATEGORIES.index(classify_descriptor(d)) for d in desc_names]
+        desc_category = np.asarray(desc_category, dtype=np.intp)
+        cat_codes = desc_category[desc_codes] if len(desc_names) else np.zeros(0, dtype=np.intp)
+
+        # 图层：0 = 全部，之后依次是大类、投诉数足够的小类
+        desc_totals = np.bincount(desc_codes, minlength=len(desc_names))
+        kept_desc = np.flatnonzero(desc_totals >= MIN_DESCRIPTOR_COUNT)
+        desc_layer = np.full(len(desc_names), -1, dtype=np.intp)
+        desc_layer[kept_desc] = 1 + len(CATEGORIES) + np.arange(len(kept_desc))
+        self.layers = (
+            ["overall"]
+            + [f"category:{c}" for c in CATEGORIES]
+            + [f"descriptor:{desc_names[i]}" for i in kept_desc]
+        )
+        self.total = len(lat)
+        self.category_counts = {
+            c: int(n) for c, n in zip(CATEGORIES, np.bincount(cat_codes, minlength=len(CATEGORIES))) if n
+        }
+
+        # 最细级别的格子编号；粗一级的格子编号就是右移一位
+        px, py = _to_pixels(lat, lon, MAX_ZOOM)
+        cell_x = (px // CELL_PX).astype(np.int64)
+        cell_y = (py // CELL_PX).astype(np.int64)
+
+        point_desc_layer = desc_layer[desc_codes] if len(desc_names) else np.zeros(0, dtype=np.intp)
+        self.levels = {}
+        for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
+            shift = MAX_ZOOM - zoom
+            self.levels[zoom] = self._bin(cell_x >> shift, cell_y >> shift, cat_codes, point_desc_layer, zoom)
+
+    def _bin(self, cx, cy, cat_codes, desc_layer, zoom):
+        """向量化分箱：格子编号合成一个整数键，np.unique 得到非空格子，bincount 计数"""
+        n_layers = len(self.layers)
+        key = (cx << 32) | cy
+        cells, inverse = np.unique(key, return_inverse=True)
+        counts = np.zeros((len(cells), n_layers), dtype=np.int32)
+        counts[:, 0] = np.bincount(inverse, minlength=len(cells))
+        n_cat = len(CATEGORIES)
+        counts[:, 1:1 + n_cat] = np.bincount(
+            inverse * n_cat + cat_codes, minlength=len(cells) * n_cat
+        ).reshape(len(cells), n_cat)
+        has_desc = desc_layer >= 0
+        if has_desc.any():
+            n_desc = n_layers - 1 - n_cat
+            flat = inverse[has_desc] * n_desc + (desc_layer[has_desc] - 1 - n_cat)
+            counts[:, 1 + n_cat:] = np.bincount(flat, minlength=len(cells) * n_desc).reshape(len(cells), n_desc)
+        cell_x = (cells >> 32).astype(np.int64)
+        cell_y = (cells & 0xFFFFFFFF).astype(np.int64)
+        lat, lon = _cell_centers(cell_x, cell_y, zoom)
+        return {"cx": cell_x, "cy": cell_y, "lat": lat, "lon": lon, "counts": counts}
+
+    def query(self, zoom, bbox=None, layer="overall"):
+        """
+        取一个缩放级别在 bbox 内的非空格子
+
+        参数:
+            zoom: 缩放级别（超出范围时取最近的预计算级别）
+            bbox: (west, south, east, north)，None 表示全部
+            layer: 图层名，见 self.layers
+        """
+        zoom = min(max(int(zoom), MIN_ZOOM), MAX_ZOOM)
+        if layer not in self.layers:
+            raise ValueError(f"Unknown layer '{layer}'")
+        level = self.levels[zoom]
+        counts = level["counts"][:, self.layers.index(layer)]
+        mask = counts > 0
+        if bbox is not None:
+            west, south, east, north = bbox
+            mask &= (level["lon"] >= west) & (level["lon"] <= east)
+            mask &= (level["lat"] >= south) & (level["lat"] <= north)
+        return {
+            "zoom": zoom,
+            "cell_px": CELL_PX,
+            "layer": layer,
+            "cells": int(mask.sum()),
+            # 颜色按当前级别全图的最大值归一化，平移时热力强度不会跳变
+            "max": int(counts.max()) if len(counts) else 0,
+            "lat": np.round(level["lat"][mask], 5).tolist(),
+            "lon": np.round(level["lon"][mask], 5).tolist(),
+            "count": counts[mask].tolist()
+        }
+
+    def summary(self):
+        return {
+            "total_complaints": self.total,
+            "categories": self.category_counts,
+            "layers": self.layers,
+            "min_zoom": MIN_ZOOM,
+            "max_zoom": MAX_ZOOM
+        }
+
+
+def build_heat_grid(start=None, end=None):
+    """用 MongoDB 聚合管道取坐标和小类编号，构建热力网格"""
+    lat, lon, desc_codes, desc_names, desc_category = load_points(start, end)
+    return HeatGrid(lat, lon, desc_codes, desc_names, desc_category)
+
+
+# 按 (311 数据版本, 时间窗口) 缓存构建好的网格
+MAX_CACHED_GRIDS = 4
+_grids = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_heat_grid(start=None, end=None):
+    key = (versions.get_version("311"), start, end)
+    with _lock:
+        grid = _grids.get(key)
+        if grid is not None:
+            _grids.move_to_end(key)
+            return grid
+    grid = build_heat_grid(start, end)
+    with _lock:
+        _grids[key] = grid
+        while len(_grids) > MAX_CACHED_GRIDS:
+            _grids.popitem(last=False)
+    return grid
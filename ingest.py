@@ -0,0 +1,387 @@
+"""
+增量导入：只处理新增或有变化的 TLC 原始文件，不再整表重建
+
+ingest_manifest 表记录每个源文件导入了哪些月份：校验和（sha256）、文件大小、每个月份的行数。
+每次运行把输入文件与清单对比：
+
+    未变化  跳过
+    新文件  清洗后写成按月分区的 parquet（文件名为源文件名），在一个事务里追加进明细表，
+            同时把这批行的立方体追加到 trip_rollup、重抽这些月份的样本 trip_sample、
+            重算这些月份的路线 top-K 摘要（route_topk）和时间序列（trip_series）、写入清单
+    有变化  重新清洗；受影响的月份按该月的全部 parquet 在暂存表里重建，再在一个事务里替换分区
+            （DETACH 旧分区 / ATTACH 暂存表），同时重算该月的立方体、样本、top-K 摘要和时间序列、更新清单，仪表板不会读到中间状态
+
+派生数据只按增量更新：OD 费用矩阵合并新增 / 被替换数据的统计（fare_matrix.update_fare_matrix），
+分位数摘要加上 / 减去这些数据的桶计数（quantiles.update_quantile_sketches），
+上车到达率模型从更新后的 trip_rollup 重新计算。
+这三个文件不在数据库里，不能和明细一起提交：每个文件的事务同时在 ingest_derived_pending 里记下该文件，
+全部派生文件写完后才清除；上次运行在这之前中断（增量已丢失）时，下次运行从数据库完整重算这三个文件。
+写派生文件之前数据版本号加一（派生文件里记录这个版本号），响应缓存和后台任务结果随之失效。按月分区的 parquet 目录就是 DuckDB 后端读取的目录。
+
+用法:
+    python ingest.py --input "./Raw Data/*.parquet"
+    python ingest.py --input "./Raw Data/*.parquet" --dry-run
+    python ingest.py --input "./Raw Data/*.parquet" --rebuild   # 清空明细表和清单，重新导入全部文件
+"""
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+
+import psycopg
+
+import arrival_rates
+import fare_matrix
+import partitions
+import pipeline
+import quantiles
+import rollup
+import sample
+import timeseries
+import topk
+import versions
+from config import PG_CONFIG, TAXI_PARQUET_PATH
+from db import configure_connection
+from loader import copy_parquet
+from partitions import TABLE_NAME, next_month, partition_name
+
+MANIFEST_TABLE = "ingest_manifest"
+
+CREATE_MANIFEST_SQL = """
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    source_file TEXT NOT NULL,
+    month DATE NOT NULL,
+    checksum TEXT NOT NULL,
+    source_bytes BIGINT NOT NULL,
+    rows_loaded BIGINT NOT NULL,
+    loaded_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (source_file, month)
+);
+"""
+
+# 已提交、但增量还没写进费用矩阵 / 分位数摘要的源文件
+PENDING_TABLE = "ingest_derived_pending"
+
+CREATE_PENDING_SQL = """
+CREATE TABLE IF NOT EXISTS ingest_derived_pending (
+    source_file TEXT PRIMARY KEY,
+    marked_at TIMESTAMP NOT NULL DEFAULT now()
+);
+"""
+
+# 新文件的行先 COPY 到这张临时表，立方体、费用矩阵和分位数摘要的增量都从它计算
+DELTA_TABLE = "ingest_delta"
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def file_checksum(path, chunk_bytes=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def read_manifest(cur):
+    """{源文件名: {"checksums": {...}, "months": {月份: 行数}}}"""
+    cur.execute(f"SELECT source_file, month, checksum, rows_loaded FROM {MANIFEST_TABLE};")
+    manifest = {}
+    for source, month, checksum, rows in cur.fetchall():
+        entry = manifest.setdefault(source, {"checksums": set(), "months": {}})
+        entry["checksums"].add(checksum)
+        entry["months"][month] = rows
+    return manifest
+
+
+def plan_files(files, manifest):
+    """每个输入文件的 (路径, 文件名, 校验和, 状态)"""
+    plan = []
+    for path in files:
+        name = os.path.basename(path)
+        checksum = file_checksum(path)
+        entry = manifest.get(name)
+        if entry is None:
+            status = NEW
+        elif entry["checksums"] == {checksum}:
+            status = UNCHANGED
+        else:
+            # 包括上次替换到一半中断的文件（部分月份还是旧的校验和）
+            status = CHANGED
+        plan.append((path, name, checksum, status))
+    return plan
+
+
+def _stem(name):
+    return os.path.splitext(name)[0]
+
+
+def month_dir(store, month):
+    return os.path.join(store, f"month={month:%Y-%m}")
+
+
+def part_path(store, month, name):
+    return os.path.join(month_dir(store, month), f"{_stem(name)}.parquet")
+
+
+def month_parts(store, month):
+    return sorted(glob.glob(os.path.join(glob.escape(month_dir(store, month)), "*.parquet")))
+
+
+def clean_file(path, store, start, end, memory_mb):
+    """
+    用 pipeline.py 清洗一个源文件，写到 store/month=YYYY-MM/{源文件名}.parquet
+
+    先写到 store 旁边的临时目录（DuckDB 后端会递归读取 store，不能写在里面）再逐个替换；
+    同一源文件以前写出、现在已不包含的月份文件被删除。返回 {月份: 行数}
+    """
+    os.makedirs(store, exist_ok=True)
+    name = os.path.basename(path)
+    staging = tempfile.mkdtemp(prefix="taxi-ingest-", dir=os.path.dirname(os.path.abspath(store)))
+    try:
+        out_dir = os.path.join(staging, "out")
+        written = pipeline.run_pipeline(glob.escape(path), out_dir, start, end, memory_mb,
+                                        file_name=f"{_stem(name)}.parquet")
+        months = {date.fromisoformat(f"{m}-01"): rows for m, rows in written.items()}
+        for old in glob.glob(os.path.join(glob.escape(store), "month=*", glob.escape(f"{_stem(name)}.parquet"))):
+            os.remove(old)
+        for month in months:
+            os.makedirs(month_dir(store, month), exist_ok=True)
+            os.replace(part_path(out_dir, month, name), part_path(store, month, name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return months
+
+
+def _record(cur, name, checksum, size, month, rows):
+    cur.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE source_file = %s AND month = %s;", (name, month))
+    if rows:
+        cur.execute(
+            f"INSERT INTO {MANIFEST_TABLE} (source_file, month, checksum, source_bytes, rows_loaded) "
+            "VALUES (%s, %s, %s, %s, %s);",
+            (name, month, checksum, size, rows)
+        )
+    # 与清单在同一个事务里：清单标记为已导入时，派生文件一定知道还欠这个文件的增量
+    cur.execute(f"INSERT INTO {PENDING_TABLE} (source_file) VALUES (%s) ON CONFLICT DO NOTHING;", (name,))
+
+
+def _od_stats(cur, source):
+    cur.execute(fare_matrix.OD_QUERY.format(source=source, filters=""))
+    return cur.fetchall()
+
+
+def _delta(cur, sign, source):
+    """source 中的行对费用矩阵和分位数摘要的增量：(sign, OD 统计行, 桶计数行)"""
+    od = _od_stats(cur, source)
+    cur.execute(quantiles.sketch_query(source=source))
+    return sign, od, cur.fetchall()
+
+
+def append_file(conn, store, name, checksum, size, months, batch_rows):
+    """新文件：一个事务里追加明细、立方体增量和清单，返回费用矩阵和分位数摘要的增量"""
+    with conn.transaction():
+        with conn.cursor() as cur:
+            partitions.ensure_partitions(cur, months)
+            cur.execute(f"CREATE TEMP TABLE {DELTA_TABLE} (LIKE {TABLE_NAME}) ON COMMIT DROP;")
+            for month in months:
+                copy_parquet(cur, part_path(store, month, name), batch_rows=batch_rows, table=DELTA_TABLE)
+            cur.execute(f"INSERT INTO {TABLE_NAME} SELECT * FROM {DELTA_TABLE};")
+            rollup.append_rollup(cur, DELTA_TABLE)
+            sample.replace_sample_months(cur, months)
+            topk.replace_topk_months(cur, months)
+            timeseries.replace_series_months(cur, months)
+            added = _delta(cur, 1, DELTA_TABLE)
+            for month, rows in months.items():
+                _record(cur, name, checksum, size, month, rows)
+    return [added]
+
+
+def swap_month(conn, store, month, name, checksum, size, rows, batch_rows):
+    """
+    按该月的全部 parquet 重建一个月份分区并原子替换，返回 (分区行数, 费用矩阵和分位数摘要的增量)
+
+    暂存表在事务外 COPY，期间仪表板照常读取旧分区；替换、立方体重算和清单更新在同一个事务里
+    """
+    partition = partition_name(month)
+    stage = f"{partition}_stage"
+    lo, hi = month.isoformat(), next_month(month).isoformat()
+    total = 0
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {stage};")
+        cur.execute(f"CREATE TABLE {stage} (LIKE {TABLE_NAME});")
+        for part in month_parts(store, month):
+            total += copy_parquet(cur, part, batch_rows=batch_rows, table=stage)[0]
+        # 与分区范围相同的约束，ATTACH 时不需要再扫描整张表校验
+        cur.execute(
+            f"ALTER TABLE {stage} ADD CONSTRAINT {stage}_bounds CHECK ("
+            f"tpep_pickup_datetime IS NOT NULL AND tpep_pickup_datetime >= '{lo}' AND tpep_pickup_datetime < '{hi}');"
+        )
+        cur.execute(f"ANALYZE {stage};")
+
+        deltas = []
+        with conn.transaction():
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (partition,))
+            if cur.fetchone()[0]:
+                deltas.append(_delta(cur, -1, partition))
+                cur.execute(f"ALTER TABLE {TABLE_NAME} DETACH PARTITION {partition};")
+                cur.execute(f"DROP TABLE {partition};")
+            cur.execute(f"ALTER TABLE {stage} RENAME TO {partition};")
+            cur.execute(f"ALTER TABLE {TABLE_NAME} ATTACH PARTITION {partition} FOR VALUES FROM ('{lo}') TO ('{hi}');")
+            cur.execute(f"ALTER TABLE {partition} DROP CONSTRAINT {stage}_bounds;")
+            rollup.replace_rollup_months(cur, [month])
+            sample.replace_sample_months(cur, [month])
+            topk.replace_topk_months(cur, [month])
+            timeseries.replace_series_months(cur, [month])
+            deltas.append(_delta(cur, 1, partition))
+            _record(cur, name, checksum, size, month, rows)
+    return total, deltas
+
+
+def _untracked_parts(store, manifest, names):
+    """store 中不属于任何已导入 / 本次导入源文件的 parquet（例如 pipeline.py 整体输出的 part-0.parquet）"""
+    known = {_stem(n) for n in manifest} | {_stem(n) for n in names}
+    parts = glob.glob(os.path.join(glob.escape(store), "month=*", "*.parquet"))
+    return sorted(p for p in parts if _stem(os.path.basename(p)) not in known)
+
+
+def _prepare(conn, rebuild, store):
+    with conn.cursor() as cur:
+        cur.execute(CREATE_MANIFEST_SQL)
+        cur.execute(CREATE_PENDING_SQL)
+        cur.execute(rollup.CREATE_ROLLUP_SQL)
+        cur.execute(sample.CREATE_SAMPLE_SQL)
+        cur.execute(topk.CREATE_TOPK_SQL)
+        cur.execute(timeseries.CREATE_SERIES_SQL)
+        if rebuild:
+            cur.execute(
+                f"TRUNCATE {MANIFEST_TABLE}, {TABLE_NAME}, {rollup.ROLLUP_TABLE}, {sample.SAMPLE_TABLE}, "
+                f"{topk.TOPK_TABLE}, {topk.TOPK_MONTHS_TABLE}, {timeseries.SERIES_TABLE}, {PENDING_TABLE};"
+            )
+            for part in glob.glob(os.path.join(glob.escape(store), "month=*", "*.parquet")):
+                os.remove(part)
+            return {}, set()
+        manifest = read_manifest(cur)
+        cur.execute(f"SELECT source_file FROM {PENDING_TABLE};")
+        pending = {r[0] for r in cur.fetchall()}
+        if not manifest:
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM {TABLE_NAME});")
+            if cur.fetchone()[0]:
+                raise RuntimeError(
+                    f"{TABLE_NAME} already has rows that are not in {MANIFEST_TABLE} "
+                    "(loaded by loader.py / sql.ipynb); run once with --rebuild to reload it through the manifest"
+                )
+        return manifest, pending
+
+
+def ingest(input_glob, store=TAXI_PARQUET_PATH, start=pipeline.DEFAULT_START, end=pipeline.DEFAULT_END,
+           memory_mb=1024, batch_rows=256_000, rebuild=False, dry_run=False):
+    """
+    按清单增量导入，返回每个文件的处理结果
+
+    参数:
+        input_glob: 原始 TLC parquet 的 glob
+        store: 按月分区的清洗后 parquet 目录（DuckDB 后端读取的目录）
+        rebuild: 清空明细表、立方体、清单和 store 后重新导入全部文件
+        dry_run: 只打印每个文件的状态
+    """
+    files = sorted(glob.glob(input_glob))
+    if not files:
+        print(f"❌ No parquet files match {input_glob}")
+        return []
+    # 明细表不存在时建成分区表；旧的普通表会先迁移
+    partitions.prepare_table()
+
+    results = []
+    deltas = []
+    with psycopg.connect(**PG_CONFIG, autocommit=True) as conn:
+        configure_connection(conn)
+        if not conn.execute("SELECT pg_try_advisory_lock(hashtext(%s));", (MANIFEST_TABLE,)).fetchone()[0]:
+            raise RuntimeError("Another ingest is already running")
+        manifest, pending = ({}, set()) if dry_run and rebuild else _prepare(conn, rebuild and not dry_run, store)
+        if pending:
+            print(f"⚠️  Derived files are missing the deltas of {len(pending)} ingested files "
+                  f"(e.g. {sorted(pending)[0]}); they will be rebuilt from the database")
+        plan = plan_files(files, manifest)
+        for path, name, _, status in plan:
+            print(f"  {status:<10} {name}")
+        untracked = _untracked_parts(store, manifest, [name for _, name, _, _ in plan])
+        if untracked:
+            print(f"⚠️  {len(untracked)} parquet files under {store} are not tracked by {MANIFEST_TABLE} "
+                  f"(e.g. {untracked[0]}); they are included whenever their month is rebuilt")
+        if dry_run:
+            return [{"file": name, "status": status} for _, name, _, status in plan]
+
+        for path, name, checksum, status in plan:
+            if status == UNCHANGED:
+                continue
+            started = time.time()
+            size = os.path.getsize(path)
+            months = clean_file(path, store, start, end, memory_mb)
+            if status == NEW:
+                deltas += append_file(conn, store, name, checksum, size, months, batch_rows)
+                swapped = []
+            else:
+                # 旧清单里有、新清洗结果里没有的月份也要重建（该文件的数据已从这些月份中移除）
+                swapped = sorted(set(months) | set(manifest[name]["months"]))
+                for month in swapped:
+                    _, month_deltas = swap_month(conn, store, month, name, checksum, size,
+                                                 months.get(month, 0), batch_rows)
+                    deltas += month_deltas
+            rows = sum(months.values())
+            results.append({"file": name, "status": status, "rows": rows, "months": len(months),
+                            "swapped_months": len(swapped), "seconds": round(time.time() - started, 1)})
+            action = f"swapped {len(swapped)} months" if swapped else "appended"
+            print(f"✅ {name}: {rows:,} rows {action} in {time.time() - started:.1f}s")
+
+        if results or pending:
+            # 先把版本号加一，派生文件记录新的版本号；写完之前中断时，
+            # 服务进程发现文件的版本号过期会从数据库自行重建
+            versions.bump_version("taxi")
+            with conn.cursor() as cur:
+                cur.execute(f"ANALYZE {rollup.ROLLUP_TABLE};")
+                cur.execute(f"ANALYZE {sample.SAMPLE_TABLE};")
+                cur.execute(f"ANALYZE {timeseries.SERIES_TABLE};")
+
+                def fetchall(query, params=None):
+                    return cur.execute(query, params).fetchall()
+
+                if rebuild or pending:
+                    fare_matrix.refresh_fare_matrix()
+                    quantiles.refresh_quantile_sketches()
+                else:
+                    fare_matrix.update_fare_matrix([(sign, od) for sign, od, _ in deltas], fetchall=fetchall)
+                    quantiles.update_quantile_sketches([(sign, counts) for sign, _, counts in deltas])
+            # 到达率模型只读 trip_rollup，直接重新计算
+            arrival_rates.refresh_arrival_rates()
+            # 派生文件都已包含本次和之前所有已提交文件的数据
+            conn.execute(f"DELETE FROM {PENDING_TABLE};")
+    if not (results or pending):
+        print("✅ Nothing to ingest, all files are up to date")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally ingest new or changed TLC yellow taxi files")
+    parser.add_argument("--input", default="./Raw Data/*.parquet", help="原始 parquet 文件的 glob")
+    parser.add_argument("--store", default=TAXI_PARQUET_PATH, help="按月分区的清洗后 parquet 目录")
+    parser.add_argument("--start", default=pipeline.DEFAULT_START)
+    parser.add_argument("--end", default=pipeline.DEFAULT_END)
+    parser.add_argument("--memory-mb", type=int, default=1024, help="清洗排序阶段的内存预算")
+    parser.add_argument("--batch-rows", type=int, default=256_000)
+    parser.add_argument("--rebuild", action="store_true", help="清空后按清单重新导入全部文件")
+    parser.add_argument("--dry-run", action="store_true", help="只显示每个文件是新增 / 有变化 / 未变化")
+    args = parser.parse_args()
+    ingest(args.input, args.store, args.start, args.end, args.memory_mb, args.batch_rows,
+           args.rebuild, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
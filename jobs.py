@@ -0,0 +1,174 @@
+"""
+后台任务：耗时的计算（311 热点图、整表聚合）提交到线程池执行，不占用 Flask 的请求线程
+
+    runner.submit(name, params)  -> Job（相同任务 + 参数 + 数据版本只会执行一次）
+    runner.get(job_id)           -> Job，轮询状态
+    runner.read_artifact(job)    -> gzip 压缩的 JSON 结果
+
+结果保存为 {artifact_dir}/{name}-v{数据版本}-{job_id}.json.gz，进程重启后仍然可用；
+数据版本变化后 job_id 随之变化，旧版本的文件在新结果写入时删除。
+"""
+import glob
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import versions
+from columnar import dumps
+from config import JOB_CONFIG
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job:
+    """一次任务提交的状态"""
+
+    def __init__(self, job_id, name, params, dataset, version, path):
+        self.id = job_id
+        self.name = name
+        self.params = params
+        self.dataset = dataset
+        self.version = version
+        self.path = path
+        self.status = QUEUED
+        self.error = None
+        self.size = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "dataset": self.dataset,
+            "version": self.version,
+            "error": self.error,
+            "artifact_bytes": self.size,
+            "queued_ms": _elapsed_ms(self.submitted_at, self.started_at),
+            "run_ms": _elapsed_ms(self.started_at, self.finished_at)
+        }
+
+
+def _elapsed_ms(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start) * 1000, 1)
+
+
+class JobRunner:
+    """线程池 + 按数据版本复用的磁盘结果"""
+
+    def __init__(self, artifact_dir, workers, max_jobs):
+        self.artifact_dir = artifact_dir
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._tasks = {}
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(artifact_dir, exist_ok=True)
+
+    def register(self, name, func, dataset):
+        """注册任务：func(**params) 返回可 JSON 序列化的结果，dataset 决定结果何时过期"""
+        self._tasks[name] = (func, dataset)
+
+    @property
+    def names(self):
+        return sorted(self._tasks)
+
+    def _job_id(self, name, params, version):
+        key = json.dumps([name, sorted(params.items()), version], default=str)
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def submit(self, name, params=None):
+        """提交任务；已有相同的任务在排队 / 执行 / 已完成时直接返回它（未注册的任务名抛出 KeyError）"""
+        func, dataset = self._tasks[name]
+        params = params or {}
+        version = versions.get_version(dataset)
+        job_id = self._job_id(name, params, version)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status != FAILED and (job.status != DONE or os.path.exists(job.path)):
+                self._jobs.move_to_end(job_id)
+                return job
+            path = os.path.join(self.artifact_dir, f"{name}-v{version}-{job_id}.json.gz")
+            job = Job(job_id, name, params, dataset, version, path)
+            if os.path.exists(path):
+                # 之前（可能是上一个进程）已经算好
+                job.status = DONE
+                job.size = os.path.getsize(path)
+                job.started_at = job.finished_at = job.submitted_at
+            else:
+                self._executor.submit(self._run, job, func)
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job
+
+    def _run(self, job, func):
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            data = func(**job.params)
+            # analysis.py 的函数把错误放在返回值里
+            if isinstance(data, dict) and data.get("success") is False:
+                raise RuntimeError(data.get("error", "job failed"))
+            body = dumps(data)
+            tmp = f"{job.path}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp, "wb", compresslevel=6) as f:
+                f.write(body)
+            os.replace(tmp, job.path)
+            job.size = os.path.getsize(job.path)
+            job.finished_at = time.time()
+            job.status = DONE
+            self._prune(job)
+        except Exception as e:
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.status = FAILED
+            print(f"Job {job.name} ({job.id}) failed: {e}")
+
+    def _prune(self, job):
+        """删除同一任务其他数据版本的结果文件"""
+        for path in glob.glob(os.path.join(self.artifact_dir, f"{job.name}-v*.json.gz")):
+            if not os.path.basename(path).startswith(f"{job.name}-v{job.version}-"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def read_artifact(self, job):
+        """gzip 压缩的 JSON 结果"""
+        with open(job.path, "rb") as f:
+            return f.read()
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {s: 0 for s in (QUEUED, RUNNING, DONE, FAILED)}
+        for job in jobs:
+            counts[job.status] += 1
+        return {
+            "tasks": self.names,
+            "jobs": counts,
+            "recent": [job.to_dict() for job in reversed(jobs[-20:])]
+        }
+
+
+# 相对路径按项目目录解析（与 fare_matrix.npz 一致）
+ARTIFACT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), JOB_CONFIG["artifact_dir"])
+
+runner = JobRunner(ARTIFACT_DIR, JOB_CONFIG["workers"], JOB_CONFIG["max_jobs"])
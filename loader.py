@@ -0,0 +1,317 @@
+"""
+并行批量导入：代替 sql.ipynb 里的 load_cleaned_parquet_to_postgres
+
+按批次读取清洗后的 parquet（pipeline.py 的按月分区目录，或单个大文件），
+用 numpy 向量化地编码成 PostgreSQL 二进制 COPY 格式，
+多个进程各开一条连接并行 COPY（每个月份分区一个任务），并报告每个 worker 的 rows/sec 和 MB/sec。
+目标表按月分区（见 partitions.py），导入前按 parquet 统计信息自动创建涉及的月份分区。
+
+用法:
+    python loader.py --input yellow_taxi_clean_parquet --workers 8
+"""
+import argparse
+import glob
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import psycopg
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import partitions
+import trips
+from config import PG_CONFIG
+
+TABLE_NAME = partitions.TABLE_NAME
+DATE_COL = "tpep_pickup_datetime"
+
+# 列顺序与 yellow_taxi_clean 表一致，值为 COPY 编码方式
+TABLE_COLUMNS = [
+    ("vendorid", "int4"),
+    ("tpep_pickup_datetime", "timestamp"),
+    ("tpep_dropoff_datetime", "timestamp"),
+    ("passenger_count", "int4"),
+    ("trip_distance", "numeric"),
+    ("ratecodeid", "int4"),
+    ("pulocationid", "int4"),
+    ("dolocationid", "int4"),
+    ("payment_type", "int4"),
+    ("fare_amount", "numeric"),
+    ("extra", "numeric"),
+    ("mta_tax", "numeric"),
+    ("tip_amount", "numeric"),
+    ("tolls_amount", "numeric"),
+    ("improvement_surcharge", "numeric"),
+    ("total_amount", "numeric"),
+    ("congestion_surcharge", "numeric"),
+]
+
+# ---- PostgreSQL 二进制 COPY 格式 ----
+# 文件头：签名 + flags + 扩展头长度；文件尾：字段数 -1
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+# timestamp 以 2000-01-01 起的微秒数传输
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+# 金额和里程都是两位小数，按分取整后编码成固定 4 位（base 10000）的 numeric：
+# weight=2 表示整数部分最多 3 组，即最大 10^12，最后一组是小数部分
+NUMERIC_SCALE = 2
+NUMERIC_NDIGITS = 4
+NUMERIC_WEIGHT = 2
+NUMERIC_NEG = 0x4000
+
+_PAYLOAD_DTYPES = {
+    "int4": np.dtype(">i4"),
+    "timestamp": np.dtype(">i8"),
+    "numeric": np.dtype((">i2", 4 + NUMERIC_NDIGITS)),
+}
+
+
+def _column_values(array, kind):
+    """arrow 列 -> numpy（缺失值为 NaN / NaT）"""
+    if kind == "timestamp":
+        return array.cast(pa.timestamp("us")).to_numpy(zero_copy_only=False)
+    return array.cast(pa.float64()).to_numpy(zero_copy_only=False)
+
+
+def _null_mask(values, kind):
+    if kind == "timestamp":
+        return np.isnat(values)
+    return ~np.isfinite(values)
+
+
+def _encode_payload(values, kind):
+    """把一列非空值编码成大端字节的 numpy 数组"""
+    if kind == "int4":
+        return values.astype(np.int32)
+    if kind == "timestamp":
+        return (values - PG_EPOCH).astype(np.int64)
+    cents = np.rint(np.abs(values) * 10 ** NUMERIC_SCALE).astype(np.int64)
+    whole, frac = np.divmod(cents, 10 ** NUMERIC_SCALE)
+    out = np.empty((len(values), 4 + NUMERIC_NDIGITS), dtype=np.int16)
+    out[:, 0] = NUMERIC_NDIGITS
+    out[:, 1] = NUMERIC_WEIGHT
+    out[:, 2] = np.where(values < 0, NUMERIC_NEG, 0)
+    out[:, 3] = NUMERIC_SCALE
+    out[:, 4] = whole // 10 ** 8 % 10 ** 4
+    out[:, 5] = whole // 10 ** 4 % 10 ** 4
+    out[:, 6] = whole % 10 ** 4
+    out[:, 7] = frac * 10 ** (4 - NUMERIC_SCALE)
+    return out
+
+
+def encode_batch(batch):
+    """
+    把一个 RecordBatch 编码成二进制 COPY 的行数据（不含文件头尾）
+
+    二进制 COPY 的行是变长的（NULL 字段没有数据部分），
+    所以按"哪些列为 NULL"分组，每组行长固定，可以用结构化数组一次写出。
+    """
+    values = [_column_values(batch.column(i), kind) for i, (_, kind) in enumerate(TABLE_COLUMNS)]
+    masks = [_null_mask(v, kind) for v, (_, kind) in zip(values, TABLE_COLUMNS)]
+    pattern = np.zeros(batch.num_rows, dtype=np.int64)
+    for i, mask in enumerate(masks):
+        pattern |= mask.astype(np.int64) << i
+
+    chunks = []
+    patterns = np.unique(pattern)
+    for p in patterns:
+        # 大多数批次只有一种模式，这时不需要挑选行
+        rows = np.flatnonzero(pattern == p) if len(patterns) > 1 else slice(None)
+        fields = [("n", ">i2")]
+        for i, (_, kind) in enumerate(TABLE_COLUMNS):
+            fields.append((f"l{i}", ">i4"))
+            if not (p >> i) & 1:
+                fields.append((f"v{i}", _PAYLOAD_DTYPES[kind]))
+        out = np.empty(len(pattern[rows]), dtype=np.dtype(fields))
+        out["n"] = len(TABLE_COLUMNS)
+        for i, (_, kind) in enumerate(TABLE_COLUMNS):
+            if (p >> i) & 1:
+                out[f"l{i}"] = -1
+            else:
+                out[f"l{i}"] = _PAYLOAD_DTYPES[kind].itemsize
+                out[f"v{i}"] = _encode_payload(values[i][rows], kind)
+        chunks.append(out.tobytes())
+    return b"".join(chunks)
+
+
+def _read_batches(path, row_groups, batch_rows):
+    """按批次读取 parquet 并转换成 trips.TRIP_SCHEMA（列名不区分大小写，缺失的列补 NULL），列名对齐到表结构"""
+    pf = pq.ParquetFile(path)
+    wanted = {c for c, _ in TABLE_COLUMNS}
+    names = [n for n in pf.schema_arrow.names if n.lower() in wanted]
+    for batch in pf.iter_batches(batch_size=batch_rows, row_groups=row_groups, columns=names):
+        # TRIP_SCHEMA 的列顺序与 TABLE_COLUMNS 相同
+        batch = trips.cast_batch(batch)
+        yield pa.RecordBatch.from_arrays(batch.columns, names=[c for c, _ in TABLE_COLUMNS])
+
+
+def copy_parquet(cur, path, row_groups=None, batch_rows=256_000, table=TABLE_NAME):
+    """在给定的游标上把一个 parquet 文件（或其中几个 row group）COPY 进 table，返回 (行数, 字节数)"""
+    rows = 0
+    nbytes = 0
+    copy_sql = f"COPY {table} ({', '.join(c for c, _ in TABLE_COLUMNS)}) FROM STDIN (FORMAT BINARY)"
+    with cur.copy(copy_sql) as copy:
+        copy.write(COPY_HEADER)
+        for batch in _read_batches(path, row_groups, batch_rows):
+            data = encode_batch(batch)
+            copy.write(data)
+            rows += batch.num_rows
+            nbytes += len(data)
+        copy.write(COPY_TRAILER)
+    return rows, nbytes
+
+
+def load_task(task):
+    """worker 进程：一条独立连接，一个事务，COPY 一个文件（或其中几个 row group）"""
+    path, row_groups, batch_rows = task
+    started = time.time()
+    with psycopg.connect(**PG_CONFIG) as conn:
+        with conn.cursor() as cur:
+            # 导入失败时整个任务回滚，重跑即可；这里不需要等待 WAL 刷盘
+            cur.execute("SET synchronous_commit = off;")
+            rows, nbytes = copy_parquet(cur, path, row_groups, batch_rows)
+    return {
+        "task": path if row_groups is None else f"{path} [row groups {row_groups[0]}-{row_groups[-1]}]",
+        "pid": os.getpid(),
+        "rows": rows,
+        "bytes": nbytes,
+        "seconds": time.time() - started,
+    }
+
+
+def plan_tasks(path, workers, batch_rows):
+    """按月分区目录：每个分区文件一个任务；单个文件：按 row group 切成若干段"""
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True))
+        return [(f, None, batch_rows) for f in files]
+    n_groups = pq.ParquetFile(path).num_row_groups
+    n_tasks = max(1, min(n_groups, workers * 2))
+    return [
+        (path, chunk.tolist(), batch_rows)
+        for chunk in np.array_split(np.arange(n_groups), n_tasks) if len(chunk)
+    ]
+
+
+def task_months(task):
+    """任务覆盖的月份：优先用 row group 统计信息，没有统计信息时读取上车时间列"""
+    path, row_groups, _ = task
+    pf = pq.ParquetFile(path)
+    by_lower = {name.lower(): name for name in pf.schema_arrow.names}
+    col = pf.schema_arrow.get_field_index(by_lower[DATE_COL])
+    months = set()
+    for rg in (row_groups if row_groups is not None else range(pf.num_row_groups)):
+        stats = pf.metadata.row_group(rg).column(col).statistics
+        if stats is not None and stats.has_min_max:
+            lo, hi = partitions.month_start(stats.min), partitions.month_start(stats.max)
+            while lo <= hi:
+                months.add(lo)
+                lo = partitions.next_month(lo)
+        else:
+            values = pf.read_row_group(rg, columns=[by_lower[DATE_COL]]).column(0).drop_null()
+            months.update(partitions.month_start(v) for v in set(
+                values.cast(pa.timestamp("us")).to_numpy().astype("datetime64[M]").tolist()
+            ))
+    return months
+
+
+def _rate(rows, nbytes, seconds):
+    seconds = max(seconds, 1e-9)
+    return f"{rows / seconds:,.0f} rows/sec, {nbytes / seconds / 1024 / 1024:,.1f} MB/sec"
+
+
+def load_parquet(path, workers=None, batch_rows=256_000, truncate=True, refresh=True):
+    """
+    并行导入清洗后的 parquet 到 yellow_taxi_clean
+
+    参数:
+        path: pipeline.py 输出的按月分区目录，或单个 parquet 文件
+        workers: 并行进程（连接）数，默认为 CPU 核数
+        truncate: 导入前清空表
+        refresh: 导入后重建 trip_rollup、费用矩阵并更新数据版本号
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = plan_tasks(path, workers, batch_rows)
+    if not tasks:
+        print(f"❌ No parquet files found under {path}")
+        return []
+    workers = min(workers, len(tasks))
+    print(f"Loading {path}: {len(tasks)} tasks on {workers} workers")
+
+    # 分区在主进程里按 parquet 统计信息预先建好，worker 只负责 COPY
+    months = set()
+    for task in tasks:
+        months |= task_months(task)
+    partitions.prepare_table(months, truncate)
+    started = time.time()
+    results, failures = [], []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(load_task, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                r = future.result()
+            except Exception as e:
+                failures.append(futures[future][0])
+                print(f"❌ COPY failed for {futures[future][0]}: {e}")
+                continue
+            results.append(r)
+            print(f"  {r['task']}: {r['rows']:,} rows in {r['seconds']:.1f}s "
+                  f"({_rate(r['rows'], r['bytes'], r['seconds'])})")
+    elapsed = time.time() - started
+
+    # 每个 worker 进程的汇总（一个进程会依次处理多个任务）
+    per_worker = {}
+    for r in results:
+        w = per_worker.setdefault(r["pid"], {"tasks": 0, "rows": 0, "bytes": 0, "seconds": 0.0})
+        w["tasks"] += 1
+        w["rows"] += r["rows"]
+        w["bytes"] += r["bytes"]
+        w["seconds"] += r["seconds"]
+    for pid, w in sorted(per_worker.items()):
+        print(f"  worker {pid}: {w['tasks']} tasks, {w['rows']:,} rows "
+              f"({_rate(w['rows'], w['bytes'], w['seconds'])})")
+
+    rows = sum(r["rows"] for r in results)
+    nbytes = sum(r["bytes"] for r in results)
+    print(f"✅ Inserted {rows:,} rows in {elapsed:.1f}s ({_rate(rows, nbytes, elapsed)})")
+    if failures:
+        print(f"⚠️  {len(failures)} tasks failed, skipping refresh")
+        return results
+
+    if refresh:
+        import arrival_rates
+        import fare_matrix
+        import quantiles
+        import rollup
+        import sample
+        import timeseries
+        import topk
+        import versions
+        rollup.refresh_rollup()
+        sample.refresh_sample()
+        topk.refresh_topk()
+        timeseries.refresh_series()
+        # 派生文件记录重建时的数据版本号，先加一
+        versions.bump_version("taxi")
+        fare_matrix.refresh_fare_matrix()
+        quantiles.refresh_quantile_sketches()
+        arrival_rates.refresh_arrival_rates()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel binary COPY loader for yellow_taxi_clean")
+    parser.add_argument("--input", default="yellow_taxi_clean_parquet", help="按月分区目录或单个 parquet 文件")
+    parser.add_argument("--workers", type=int, default=None, help="并行连接数，默认 CPU 核数")
+    parser.add_argument("--batch-rows", type=int, default=256_000)
+    parser.add_argument("--append", action="store_true", help="不清空表，追加导入")
+    parser.add_argument("--no-refresh", action="store_true", help="导入后不重建派生表")
+    args = parser.parse_args()
+    load_parquet(args.input, args.workers, args.batch_rows,
+                 truncate=not args.append, refresh=not args.no_refresh)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+请求 / 查询的耗时指标（Prometheus 文本格式）和慢查询日志
+
+    taxi_http_request_duration_seconds  每个路由的请求耗时
+    taxi_http_serialize_seconds         响应序列化（JSON / columns / Arrow）耗时
+    taxi_function_duration_seconds      每个 analysis 函数的耗时
+    taxi_query_phase_seconds            查询各阶段耗时：connect（从连接池取连接）/ execute / fetch / convert（转成 DataFrame / Table）
+    taxi_query_rows                     每次查询返回的行数
+    taxi_slow_queries_total             超过 METRICS_CONFIG["slow_query_ms"] 的查询数
+
+查询指标按"当前 analysis 函数"分组：function_timer 把函数名放在 contextvar 里，
+同步（线程）和异步（asyncio 任务）路径都能取到。指标保存在进程内存中，多进程部署时每个进程分别暴露。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from config import METRICS_CONFIG
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+INF_LABEL = 'le="+Inf"'
+
+# 当前正在执行的 analysis 函数
+current_function = ContextVar("current_function", default="")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """固定分桶的直方图（按标签值分组）"""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # 各桶的计数（非累计）+ 总和 + 总数
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labels, key, [f'le="{_number(bound)}"'])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, [INF_LABEL])} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "taxi_http_request_duration_seconds", "HTTP request latency by route", ["route", "method", "status"])
+SERIALIZE_SECONDS = Histogram(
+    "taxi_http_serialize_seconds", "Time spent encoding response bodies", ["route", "format"])
+FUNCTION_SECONDS = Histogram(
+    "taxi_function_duration_seconds", "Latency of analysis functions", ["function"])
+QUERY_PHASE_SECONDS = Histogram(
+    "taxi_query_phase_seconds", "Query latency by phase (connect, execute, fetch, convert)",
+    ["function", "source", "phase"])
+QUERY_ROWS = Histogram(
+    "taxi_query_rows", "Rows returned per query", ["function", "source"], buckets=ROW_BUCKETS)
+SLOW_QUERIES = Counter(
+    "taxi_slow_queries_total", "Queries slower than the slow query threshold", ["function", "source"])
+
+REGISTRY = [REQUEST_SECONDS, SERIALIZE_SECONDS, FUNCTION_SECONDS, QUERY_PHASE_SECONDS, QUERY_ROWS, SLOW_QUERIES]
+
+
+def render():
+    """全部指标的 Prometheus 文本格式"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def observe_request(route, method, status, seconds):
+    REQUEST_SECONDS.observe(seconds, route, method, str(status))
+
+
+@contextmanager
+def function_timer(name):
+    """记录一个 analysis 函数的耗时；期间执行的查询都归到这个函数下"""
+    token = current_function.set(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        FUNCTION_SECONDS.observe(time.perf_counter() - started, name)
+        current_function.reset(token)
+
+
+def timed(func):
+    """function_timer 的装饰器版本"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with function_timer(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def phase(name, source):
+    """不属于某次查询本身的阶段（例如结果转成 DataFrame）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        QUERY_PHASE_SECONDS.observe(time.perf_counter() - started, current_function.get(), source, name)
+
+
+class QueryTimer:
+    """
+    一次查询的分阶段计时：每完成一个阶段调用 lap(阶段名)，最后 done(行数)
+
+    execute + fetch 超过慢查询阈值时写入慢查询日志；explain 是返回执行计划的函数，在后台线程里调用
+    """
+
+    def __init__(self, source, query, params=None, explain=None):
+        self.source = source
+        self.query = query
+        self.params = params
+        self.explain = explain
+        self.function = current_function.get()
+        self.phases = {}
+        self._last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+        QUERY_PHASE_SECONDS.observe(self.phases[name], self.function, self.source, name)
+
+    def done(self, rows):
+        QUERY_ROWS.observe(rows, self.function, self.source)
+        query_ms = (self.phases.get("execute", 0.0) + self.phases.get("fetch", 0.0)) * 1000
+        if query_ms >= METRICS_CONFIG["slow_query_ms"]:
+            SLOW_QUERIES.inc(self.function, self.source)
+            slow_query_log.record(self, query_ms, rows)
+
+
+class SlowQueryLog:
+    """慢查询写入 JSON Lines 文件（每行一条），执行计划在单独的线程里获取，不拖慢原请求"""
+
+    def __init__(self, path, explain, explain_interval, keep):
+        self.path = path
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self._recent = deque(maxlen=keep)
+        self._explained = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+
+    def _should_explain(self, query_text):
+        """同一条查询在 explain_interval 内只 EXPLAIN 一次（EXPLAIN ANALYZE 会再执行一遍查询）"""
+        key = hashlib.sha1(query_text.encode()).hexdigest()
+        now = time.time()
+        with self._lock:
+            if now - self._explained.get(key, float("-inf")) < self.explain_interval:
+                return False
+            self._explained[key] = now
+            return True
+
+    def record(self, timer, query_ms, rows):
+        query_text = timer.query if isinstance(timer.query, str) else json.dumps(timer.query, default=str)
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "function": timer.function,
+            "source": timer.source,
+            "query_ms": round(query_ms, 1),
+            "phases_ms": {k: round(v * 1000, 1) for k, v in timer.phases.items()},
+            "rows": rows,
+            "query": " ".join(query_text.split()),
+            "params": timer.params,
+        }
+        print(f"🐢 Slow {timer.source} query in {timer.function or 'unknown'}: {query_ms:.0f} ms, {rows:,} rows")
+        explain = timer.explain if self.explain and timer.explain is not None and self._should_explain(query_text) else None
+        self._executor.submit(self._write, entry, explain)
+
+    def _write(self, entry, explain):
+        if explain is not None:
+            try:
+                entry["plan"] = explain()
+            except Exception as e:
+                entry["plan_error"] = str(e)
+        line = json.dumps(entry, default=str, ensure_ascii=False)
+        with self._lock:
+            self._recent.append(entry)
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print(f"Slow query log not written: {e}")
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(self._recent))
+
+
+# 相对路径按项目目录解析（与 job_artifacts 一致）
+SLOW_QUERY_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), METRICS_CONFIG["slow_query_log"])
+
+slow_query_log = SlowQueryLog(
+    SLOW_QUERY_LOG_PATH, METRICS_CONFIG["explain"], METRICS_CONFIG["explain_interval"],
+    METRICS_CONFIG["recent_slow_queries"]
+)
@@ -0,0 +1,176 @@
+import time
+from datetime import date, datetime
+
+import psycopg
+
+from config import PG_CONFIG
+
+# yellow_taxi_clean 按 tpep_pickup_datetime 做按月范围分区：
+#   yellow_taxi_clean_y2024m01 存放 [2024-01-01, 2024-02-01) 的行
+#   yellow_taxi_clean_default  存放上车时间为空（或没有对应月份分区）的行
+# 带时间窗口的查询只会扫描相关月份的分区（partition pruning）
+TABLE_NAME = "yellow_taxi_clean"
+DEFAULT_PARTITION = f"{TABLE_NAME}_default"
+
+CREATE_PARTITIONED_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    VendorID INTEGER,
+    tpep_pickup_datetime TIMESTAMP,
+    tpep_dropoff_datetime TIMESTAMP,
+    passenger_count INTEGER,
+    trip_distance NUMERIC,
+    RatecodeID INTEGER,
+    PULocationID INTEGER,
+    DOLocationID INTEGER,
+    payment_type INTEGER,
+    fare_amount NUMERIC,
+    extra NUMERIC,
+    mta_tax NUMERIC,
+    tip_amount NUMERIC,
+    tolls_amount NUMERIC,
+    improvement_surcharge NUMERIC,
+    total_amount NUMERIC,
+    congestion_surcharge NUMERIC
+) PARTITION BY RANGE (tpep_pickup_datetime);
+"""
+
+
+def month_start(value):
+    """任意日期 / 时间 -> 所在月份的第一天"""
+    return date(value.year, value.month, 1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def normalize_window(start=None, end=None):
+    """
+    时间窗口 [start, end)：接受 datetime、date 或 ISO 格式字符串，统一成 datetime
+
+    date 视为当天 0 点；任一端为 None 表示不限制
+    """
+    def parse(value):
+        if value is None or value == "":
+            return None
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if not isinstance(value, datetime):
+            value = datetime(value.year, value.month, value.day)
+        return value
+
+    start, end = parse(start), parse(end)
+    if start is not None and end is not None and start >= end:
+        raise ValueError("start must be earlier than end")
+    return start, end
+
+
+def window_condition(column, start=None, end=None):
+    """时间窗口对应的 WHERE 条件和参数（没有窗口时为 TRUE）"""
+    conditions, params = [], []
+    if start is not None:
+        conditions.append(f"{column} >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{column} < %s")
+        params.append(end)
+    return " AND ".join(conditions) or "TRUE", params
+
+
+def is_month_aligned(value):
+    return value is None or (value.day == 1 and value.time() == datetime.min.time())
+
+
+def partition_name(month):
+    return f"{TABLE_NAME}_y{month.year}m{month.month:02d}"
+
+
+def _relkind(cur, table):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def list_partitions(cur):
+    """已存在的月份分区（不含 default）"""
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname;
+    """, (TABLE_NAME,))
+    return [r[0] for r in cur.fetchall() if r[0] != DEFAULT_PARTITION]
+
+
+def ensure_partitions(cur, months):
+    """为给定月份创建缺失的分区，返回新建的分区名"""
+    existing = set(list_partitions(cur))
+    created = []
+    for month in sorted({month_start(m) for m in months}):
+        name = partition_name(month)
+        if name in existing:
+            continue
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE_NAME} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}');"
+        )
+        created.append(name)
+    return created
+
+
+def _create_partitioned(cur, table=TABLE_NAME):
+    cur.execute(CREATE_PARTITIONED_SQL.format(table=table))
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
+
+
+def _months_in(cur, table):
+    cur.execute(f"""
+        SELECT DISTINCT date_trunc('month', tpep_pickup_datetime)::date
+        FROM {table}
+        WHERE tpep_pickup_datetime IS NOT NULL;
+    """)
+    return [r[0] for r in cur.fetchall()]
+
+
+def prepare_table(months=(), truncate=False):
+    """
+    导入前调用：建分区表（旧的普通表会先迁移）、创建本次导入涉及的月份分区
+
+    参数:
+        months: 本次导入数据覆盖的月份
+        truncate: 导入前清空表
+    """
+    with psycopg.connect(**PG_CONFIG, autocommit=True) as conn:
+        with conn.cursor() as cur:
+            kind = _relkind(cur, TABLE_NAME)
+            if kind == "r":
+                if truncate:
+                    cur.execute(f"DROP TABLE {TABLE_NAME};")
+                else:
+                    _migrate(conn, cur)
+            _create_partitioned(cur)
+            if truncate:
+                cur.execute(f"TRUNCATE {TABLE_NAME};")
+            created = ensure_partitions(cur, months)
+    if created:
+        print(f"Created {len(created)} monthly partitions ({created[0]} .. {created[-1]})")
+    return created
+
+
+def _migrate(conn, cur):
+    """把已有的普通表 yellow_taxi_clean 转成按月分区表（一个事务内完成）"""
+    start = time.time()
+    legacy = f"{TABLE_NAME}_unpartitioned"
+    with conn.transaction():
+        cur.execute(f"ALTER TABLE {TABLE_NAME} RENAME TO {legacy};")
+        _create_partitioned(cur)
+        ensure_partitions(cur, _months_in(cur, legacy))
+        cur.execute(f"INSERT INTO {TABLE_NAME} SELECT * FROM {legacy};")
+        rows = cur.rowcount
+        cur.execute(f"DROP TABLE {legacy};")
+    print(f"✅ Migrated {rows:,} rows into monthly partitions in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    prepare_table()
@@ -0,0 +1,237 @@
+"""
+清洗流水线：代替 cleancodes.ipynb
+
+按批次流式读取原始 TLC parquet，做日期窗口 / RatecodeID 过滤（谓词下推到 row group），
+在固定内存预算内做外部归并排序，最后按月份分区写出按时间排序的 parquet。
+
+用法:
+    python pipeline.py --input "./Raw Data/*.parquet" --output yellow_taxi_clean_parquet
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import trips
+
+DATE_COL = "tpep_pickup_datetime"
+DEFAULT_START = "2022-10-01"
+DEFAULT_END = "2025-10-01"
+
+# 清洗后保留的列与类型：trips.py 中的紧凑类型（int8 / int16 代码和区域 id，float32 金额）
+TARGET_SCHEMA = trips.TRIP_SCHEMA
+
+# 与 notebook 一致的缺失值填充
+CONGESTION_FILL = 2.5
+
+
+def _scan_filter(start, end):
+    """日期窗口（两端都包含，与 notebook 一致）+ 标准费率 RatecodeID == 1"""
+    return (
+        (ds.field(DATE_COL) >= pa.scalar(datetime.fromisoformat(start), pa.timestamp("us")))
+        & (ds.field(DATE_COL) <= pa.scalar(datetime.fromisoformat(end), pa.timestamp("us")))
+        & (ds.field("RatecodeID") == 1)
+    )
+
+
+def clean_batch(batch):
+    """对单个 RecordBatch 做列裁剪、类型转换（trips.cast_batch）和 notebook 里的清洗步骤"""
+    batch = trips.cast_batch(batch, TARGET_SCHEMA)
+    columns = []
+    for field, col in zip(TARGET_SCHEMA, batch.columns):
+        if field.name == "passenger_count":
+            # passenger_count 为 0 的填 1
+            col = pc.if_else(pc.equal(col, 0), pa.scalar(1, field.type), col)
+        elif field.name == "congestion_surcharge":
+            col = pc.fill_null(col, pa.scalar(CONGESTION_FILL, field.type))
+        columns.append(col)
+    return pa.RecordBatch.from_arrays(columns, schema=TARGET_SCHEMA)
+
+
+def scan_batches(files, start, end, batch_rows):
+    """逐个文件流式读取过滤后的批次（各月文件的 schema 不完全一致，所以单独扫描）"""
+    scan_filter = _scan_filter(start, end)
+    for path in files:
+        dataset = ds.dataset(path, format="parquet")
+        names = [f.name for f in TARGET_SCHEMA if f.name in dataset.schema.names]
+        for batch in dataset.to_batches(columns=names, filter=scan_filter, batch_size=batch_rows):
+            if batch.num_rows:
+                yield clean_batch(batch)
+
+
+def _sort_table(table):
+    return table.take(pc.sort_indices(table, sort_keys=[(DATE_COL, "ascending")]))
+
+
+def write_sorted_runs(batches, tmp_dir, memory_bytes, row_group_rows):
+    """第一阶段：内存攒满预算就排序并落盘成一个有序 run"""
+    runs, buffer, buffered = [], [], 0
+    rows_in = 0
+
+    def flush():
+        nonlocal buffer, buffered
+        if not buffer:
+            return
+        table = _sort_table(pa.Table.from_batches(buffer))
+        path = os.path.join(tmp_dir, f"run-{len(runs):05d}.parquet")
+        pq.write_table(table, path, row_group_size=row_group_rows)
+        runs.append(path)
+        buffer, buffered = [], 0
+
+    for batch in batches:
+        rows_in += batch.num_rows
+        buffer.append(batch)
+        buffered += batch.nbytes
+        if buffered >= memory_bytes:
+            flush()
+    flush()
+    return runs, rows_in
+
+
+class _RunReader:
+    """按批次读取一个有序 run"""
+
+    def __init__(self, path, batch_rows):
+        self._batches = pq.ParquetFile(path).iter_batches(batch_size=batch_rows)
+        self.table = None
+        self.ts = None
+        self.advance()
+
+    def advance(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            self.table, self.ts = None, None
+        else:
+            self.table = pa.Table.from_batches([batch])
+            self.ts = self.table.column(DATE_COL).to_numpy()
+
+    @property
+    def done(self):
+        return self.table is None
+
+    def take_until(self, bound):
+        """取出时间 <= bound 的前缀（run 本身有序，所以是一段前缀）"""
+        n = int(np.searchsorted(self.ts, bound, side="right"))
+        head = self.table.slice(0, n)
+        if n == self.table.num_rows:
+            self.advance()
+        else:
+            self.table = self.table.slice(n)
+            self.ts = self.ts[n:]
+        return head
+
+
+def merge_runs(runs, batch_rows):
+    """第二阶段：k 路归并，每次只保留每个 run 的一个批次在内存里"""
+    readers = [r for r in (_RunReader(p, batch_rows) for p in runs) if not r.done]
+    while readers:
+        # 所有 run 当前批次末尾时间的最小值：不超过它的行都可以安全输出
+        bound = min(r.ts[-1] for r in readers)
+        pieces = [r.take_until(bound) for r in readers]
+        pieces = [p for p in pieces if p.num_rows]
+        if pieces:
+            yield _sort_table(pa.concat_tables(pieces))
+        readers = [r for r in readers if not r.done]
+
+
+class MonthPartitionWriter:
+    """按月份分区写出：output/month=YYYY-MM/part-0.parquet（文件名可指定，ingest.py 用源文件名）"""
+
+    def __init__(self, output_dir, row_group_rows, file_name="part-0.parquet"):
+        self.output_dir = output_dir
+        self.row_group_rows = row_group_rows
+        self.file_name = file_name
+        self._writer = None
+        self._month = None
+        self.months = {}
+
+    def write(self, table):
+        months = table.column(DATE_COL).to_numpy().astype("datetime64[M]")
+        # 输入整体有序，同一月份的行是连续的一段
+        cuts = np.flatnonzero(months[1:] != months[:-1]) + 1
+        starts = np.concatenate([[0], cuts])
+        ends = np.concatenate([cuts, [len(months)]])
+        for s, e in zip(starts, ends):
+            self._write_month(str(months[s]), table.slice(s, e - s))
+
+    def _write_month(self, month, table):
+        if month != self._month:
+            self.close()
+            part_dir = os.path.join(self.output_dir, f"month={month}")
+            os.makedirs(part_dir, exist_ok=True)
+            self._writer = pq.ParquetWriter(os.path.join(part_dir, self.file_name), TARGET_SCHEMA)
+            self._month = month
+        self._writer.write_table(table, row_group_size=self.row_group_rows)
+        self.months[month] = self.months.get(month, 0) + table.num_rows
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def run_pipeline(input_glob, output_dir, start=DEFAULT_START, end=DEFAULT_END,
+                 memory_mb=1024, batch_rows=256_000, row_group_rows=1_000_000, tmp_dir=None,
+                 file_name="part-0.parquet"):
+    """完整流程：扫描 + 过滤 + 外部排序 + 按月写出"""
+    files = sorted(glob.glob(input_glob))
+    print(f"找到 {len(files)} 个 parquet 文件。")
+    if not files:
+        return {}
+    started = time.time()
+    memory_bytes = memory_mb * 1024 * 1024
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    work_dir = tempfile.mkdtemp(prefix="taxi-sort-", dir=tmp_dir)
+    try:
+        runs, rows_in = write_sorted_runs(
+            scan_batches(files, start, end, batch_rows), work_dir, memory_bytes, row_group_rows
+        )
+        print(f"Pass 1: {rows_in:,} rows -> {len(runs)} sorted runs in {time.time() - started:.1f}s")
+
+        # 归并阶段每个 run 只保留一个批次，批次大小按内存预算平均分配
+        row_bytes = max(1, sum(f.type.bit_width // 8 for f in TARGET_SCHEMA))
+        merge_rows = max(1024, memory_bytes // (2 * max(1, len(runs)) * row_bytes))
+        writer = MonthPartitionWriter(output_dir, row_group_rows, file_name)
+        try:
+            for table in merge_runs(runs, merge_rows):
+                writer.write(table)
+        finally:
+            writer.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    total = sum(writer.months.values())
+    print(f"✅ Wrote {total:,} rows into {len(writer.months)} monthly partitions "
+          f"under {output_dir} in {time.time() - started:.1f}s")
+    return writer.months
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream, filter and sort raw TLC yellow taxi parquet files")
+    parser.add_argument("--input", default="./Raw Data/*.parquet", help="原始 parquet 文件的 glob")
+    parser.add_argument("--output", default="yellow_taxi_clean_parquet", help="按月分区的输出目录")
+    parser.add_argument("--start", default=DEFAULT_START)
+    parser.add_argument("--end", default=DEFAULT_END)
+    parser.add_argument("--memory-mb", type=int, default=1024, help="排序阶段的内存预算")
+    parser.add_argument("--batch-rows", type=int, default=256_000)
+    parser.add_argument("--row-group-rows", type=int, default=1_000_000)
+    parser.add_argument("--tmp-dir", default=None, help="排序中间文件目录")
+    args = parser.parse_args()
+    run_pipeline(args.input, args.output, args.start, args.end, args.memory_mb,
+                 args.batch_rows, args.row_group_rows, args.tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""
+费用 / 总价 / 小费 / 行程时长的分位数摘要，按 OD 对、上车区域和上车小时分别保存
+
+摘要是对数分桶的直方图（DDSketch）：正数 v 落在第 i = ceil(log_γ(v / MIN_VALUE)) 个桶，γ = (1 + α) / (1 - α)，
+分位数取桶的代表值 2·MIN_VALUE·γ^i / (γ + 1)，相对误差不超过 α（QUANTILE_CONFIG["relative_accuracy"]）；
+≤ 0 的值单独放在 0 号桶，按 0 返回。所有摘要的桶边界相同，合并就是计数相加、扣除就是计数相减：
+    - 上车区域的摘要是该区域所有 OD 对摘要之和，不再单独扫描
+    - ingest.py 按新增 / 被替换的数据增量更新，结果与重建完全相同
+    - 带时间窗口的单个 OD 对在明细表上按桶计数（一次 GROUP BY，不需要排序）
+
+只保存非空的桶：每个 (键, 桶) 存一个 uint32 编号（键 × 桶数 + 桶）和一个 uint32 计数，
+写在 quantile_sketches.npz，常驻内存；查询是一次二分查找加一次累加（加载 / 刷新方式与 fare_matrix.py 相同）。
+
+用法:
+    python quantiles.py   # 从 yellow_taxi_clean 重建
+"""
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from backends import TableStep, get_backend, in_event_loop, stepwise
+from config import QUANTILE_CONFIG
+from partitions import TABLE_NAME, normalize_window, window_condition
+from sample import SAMPLE_TABLE
+from versions import get_version
+
+N_ZONES = 266
+QUANTILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "quantile_sketches.npz")
+
+# 指标名 -> 表达式（与 fare_matrix.OD_QUERY 的均值对应）
+MEASURES = {
+    "fare": "fare_amount",
+    "total": "total_amount",
+    "tip": "tip_amount",
+    "duration_min": "EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60",
+}
+
+# 摘要的键：od = 上车区域 × 266 + 下车区域，zone = 上车区域，hour = 上车小时（0-23）
+# od 和 hour 从数据库聚合，zone 由 od 相加得到
+FAMILIES = ("od", "zone", "hour")
+FAMILY_SETS = {"od": "pulocationid, dolocationid", "hour": "pickup_hour"}
+
+# 最小的正桶下界和最大值（超出的值计入第一个 / 最后一个桶）
+MIN_VALUE = 0.01
+MAX_VALUE = 1e6
+
+SKETCH_COLUMNS = ["pulocationid", "dolocationid", "pickup_hour", *(f"{m}_bucket" for m in MEASURES),
+                  "grouping_id", "weight"]
+
+# 与 fare_matrix.OD_QUERY 相同的过滤条件；GROUPING SETS 一次扫描算出所有指标的桶计数
+SKETCH_QUERY = """
+SELECT
+    pulocationid,
+    dolocationid,
+    pickup_hour,
+    {bucket_columns},
+    GROUPING(pickup_hour, {bucket_columns}) as grouping_id,
+    {weight} as weight
+FROM (
+    SELECT
+        pulocationid,
+        dolocationid,
+        EXTRACT(HOUR FROM tpep_pickup_datetime)::int as pickup_hour,
+        {buckets}{weight_column}
+    FROM {source}
+    WHERE pulocationid BETWEEN 1 AND 265
+        AND dolocationid BETWEEN 1 AND 265
+        AND fare_amount > 0
+        AND total_amount > 0
+        {filters}
+) trips
+GROUP BY GROUPING SETS ({sets});
+"""
+
+# 检查磁盘文件 / 数据版本是否更新的最小间隔（秒）
+RELOAD_CHECK_INTERVAL = 30
+
+# npz 里没有记录数据版本（旧文件）
+NO_VERSION = -1
+
+
+def n_buckets(accuracy):
+    """0 号桶（≤ 0）加上覆盖 (0, MAX_VALUE] 的对数桶"""
+    return math.ceil(math.log(MAX_VALUE / MIN_VALUE) / math.log(_gamma(accuracy))) + 2
+
+
+def _gamma(accuracy):
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def bucket_sql(expr, accuracy):
+    """值 -> 桶编号的 SQL 表达式（PostgreSQL 和 DuckDB 通用，按双精度计算保证两边分桶相同）"""
+    log_gamma = math.log(_gamma(accuracy))
+    return (f"CASE WHEN ({expr}) IS NULL THEN NULL "
+            f"WHEN ({expr}) > 0 THEN LEAST(GREATEST(CEIL(LN(CAST(({expr}) AS DOUBLE PRECISION) / {MIN_VALUE}) "
+            f"/ CAST({log_gamma!r} AS DOUBLE PRECISION)), 1), {n_buckets(accuracy) - 1}) "
+            f"ELSE 0 END")
+
+
+def sketch_query(source=TABLE_NAME, filters="", weighted=False, accuracy=QUANTILE_CONFIG["relative_accuracy"]):
+    """
+    按桶计数的查询，结果列为 SKETCH_COLUMNS
+
+    weighted=True 时（样本表）计数换成 sample_weight 之和
+    """
+    bucket_columns = ", ".join(f"{m}_bucket" for m in MEASURES)
+    buckets = ",\n        ".join(f"{bucket_sql(expr, accuracy)} as {m}_bucket" for m, expr in MEASURES.items())
+    sets = ", ".join(f"({keys}, {m}_bucket)" for keys in FAMILY_SETS.values() for m in MEASURES)
+    return SKETCH_QUERY.format(
+        bucket_columns=bucket_columns, buckets=buckets, sets=sets, source=source, filters=filters,
+        weight="SUM(sample_weight)" if weighted else "COUNT(*)",
+        weight_column=",\n        sample_weight" if weighted else "",
+    )
+
+
+def _grouping_id(family, index):
+    """GROUPING(pickup_hour, 各指标的桶) 的位掩码：未参与分组的列对应位为 1，第一个参数是最高位"""
+    width = len(MEASURES)
+    mask = ((1 << width) - 1) ^ (1 << (width - 1 - index))
+    return mask | (1 << width) if family == "od" else mask
+
+
+def _compact(cells, counts):
+    """相同编号的计数相加，去掉计数为 0 的桶，编号升序"""
+    cells, inverse = np.unique(cells, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts, minlength=len(cells))
+    keep = counts != 0
+    return cells[keep], counts[keep]
+
+
+def _quantiles(buckets, counts, percentiles, accuracy):
+    """单个摘要的分位数：第 p 百分位取累计计数首次达到 p% × n 的桶（与 percentile_disc 相同）"""
+    total = counts.sum()
+    if total <= 0:
+        return [None] * len(percentiles)
+    cumulative = np.cumsum(counts)
+    gamma = _gamma(accuracy)
+    values = []
+    for p in percentiles:
+        i = int(buckets[min(np.searchsorted(cumulative, p / 100 * total), len(buckets) - 1)])
+        values.append(round(2 * MIN_VALUE * gamma ** i / (gamma + 1), 2) if i > 0 else 0.0)
+    return values
+
+
+def od_key(pickup_zone_id, dropoff_zone_id):
+    return int(pickup_zone_id) * N_ZONES + int(dropoff_zone_id)
+
+
+class QuantileSketches:
+    """一组分位数摘要：sketches[(family, measure)] = (编号数组, 计数数组)，编号升序"""
+
+    def __init__(self, sketches, accuracy=QUANTILE_CONFIG["relative_accuracy"], data_version=NO_VERSION):
+        self.sketches = sketches
+        self.accuracy = accuracy
+        self.n_buckets = n_buckets(accuracy)
+        # 构建时 taxi 数据集的版本号
+        self.data_version = data_version
+
+    @classmethod
+    def from_db(cls):
+        """一次聚合查询构建全部摘要"""
+        version = get_version("taxi")
+        sketches = cls.from_rows(get_backend().fetchall(sketch_query()))
+        sketches.data_version = version
+        return sketches
+
+    @classmethod
+    def from_rows(cls, rows, accuracy=QUANTILE_CONFIG["relative_accuracy"]):
+        """sketch_query 的结果行（或同样列顺序的二维数组）-> 摘要"""
+        data = np.array(rows, dtype=np.float64).reshape(-1, len(SKETCH_COLUMNS))
+        nb = n_buckets(accuracy)
+        grouping_id, weight = data[:, -2], data[:, -1]
+        keys = {"od": data[:, 0] * N_ZONES + data[:, 1], "hour": data[:, 2]}
+        sketches = {}
+        for i, m in enumerate(MEASURES):
+            bucket = data[:, 3 + i]
+            for family, key in keys.items():
+                own = (grouping_id == _grouping_id(family, i)) & ~np.isnan(bucket) & ~np.isnan(key)
+                cells = key[own].astype(np.int64) * nb + bucket[own].astype(np.int64)
+                sketches[family, m] = _compact(cells, weight[own])
+            # 区域 = 该上车区域所有 OD 对之和
+            cells, counts = sketches["od", m]
+            sketches["zone", m] = _compact(cells // nb // N_ZONES * nb + cells % nb, counts)
+        return cls(sketches, accuracy)
+
+    @classmethod
+    def load(cls, path=QUANTILES_PATH):
+        with np.load(path) as f:
+            sketches = {
+                (family, m): (f[f"{family}_{m}_cells"].astype(np.int64), f[f"{family}_{m}_counts"].astype(np.float64))
+                for family in FAMILIES for m in MEASURES
+            }
+            version = int(f["data_version"]) if "data_version" in f.files else NO_VERSION
+            return cls(sketches, float(f["accuracy"]), version)
+
+    def save(self, path=QUANTILES_PATH):
+        # 先写临时文件再替换，避免其他进程读到一半
+        tmp = path + ".tmp.npz"
+        arrays = {}
+        for (family, m), (cells, counts) in self.sketches.items():
+            arrays[f"{family}_{m}_cells"] = cells.astype(np.uint32)
+            arrays[f"{family}_{m}_counts"] = np.rint(counts).astype(np.uint32)
+        np.savez(tmp, accuracy=self.accuracy, data_version=np.int64(self.data_version), **arrays)
+        os.replace(tmp, path)
+
+    def merge(self, delta, sign=1):
+        """合并增量（sign=1，新增的行）或扣除（sign=-1，被替换掉的行）的摘要，原地修改"""
+        for name, (cells, counts) in self.sketches.items():
+            delta_cells, delta_counts = delta.sketches[name]
+            self.sketches[name] = _compact(np.concatenate([cells, delta_cells]),
+                                           np.concatenate([counts, sign * delta_counts]))
+
+    def quantiles(self, family, key, measure, percentiles=QUANTILE_CONFIG["percentiles"]):
+        """某个键上某个指标的分位数列表，没有数据时为 None"""
+        cells, counts = self.sketches[family, measure]
+        lo, hi = np.searchsorted(cells, [key * self.n_buckets, (key + 1) * self.n_buckets])
+        return _quantiles(cells[lo:hi] % self.n_buckets, counts[lo:hi], percentiles, self.accuracy)
+
+    def bands(self, family, key, percentiles=QUANTILE_CONFIG["percentiles"]):
+        """{p50_fare, p90_fare, p50_total, ..., p90_duration_min}"""
+        result = {}
+        for m in MEASURES:
+            for p, value in zip(percentiles, self.quantiles(family, key, m, percentiles)):
+                result[f"p{p}_{m}"] = value
+        return result
+
+
+def band_names(percentiles=QUANTILE_CONFIG["percentiles"]):
+    return [f"p{p}_{m}" for m in MEASURES for p in percentiles]
+
+
+def label_bands(records, family, key_name, start=None, end=None):
+    """
+    给查询结果按 key_name 加上分位数（Table 或字典列表，原地修改并返回）
+
+    常驻内存的摘要覆盖全部时间，所以只有不带时间窗口的查询才有值，带窗口时这些字段为 None
+    （按窗口计算需要扫描整个窗口的明细，正是摘要要避免的）。
+    面板本身不依赖摘要：这里只读取已经建好的摘要文件，不在请求里重建；摘要不可用时这些字段同样为 None
+    """
+    windowed = normalize_window(start, end) != (None, None)
+    sketches = None
+    if not windowed:
+        try:
+            sketches = get_quantile_sketches(rebuild=False)
+        except Exception as e:
+            print(f"Quantile sketches unavailable, bands left empty: {e}")
+    names = band_names()
+    if hasattr(records, "columns"):
+        keys = np.asarray(records.columns[key_name]) if len(records) else []
+        bands = [sketches.bands(family, int(k)) if sketches is not None and k == k else {} for k in keys]
+        for name in names:
+            # 与查询结果的数值列一致，没有值的用 NaN
+            values = [b.get(name) for b in bands]
+            records.add_column(name, np.array([np.nan if v is None else v for v in values], dtype=np.float64))
+        return records
+    for r in records:
+        key = r.get(key_name)
+        bands = sketches.bands(family, int(key)) if sketches is not None and key is not None else {}
+        for name in names:
+            r[name] = bands.get(name)
+    return records
+
+
+@stepwise
+def query_od_bands(pickup_zone_id, dropoff_zone_id, start=None, end=None, approx=False):
+    """
+    带时间窗口的单个 OD 对分位数：在明细表上按桶计数后计算（与常驻摘要的分桶相同）
+
+    approx=True 时在分层样本上按 sample_weight 加权计数
+    """
+    start, end = normalize_window(start, end)
+    condition, params = window_condition("tpep_pickup_datetime", start, end)
+    query = sketch_query(
+        source=SAMPLE_TABLE if approx else TABLE_NAME,
+        filters=f"AND pulocationid = %s AND dolocationid = %s AND {condition}",
+        weighted=approx,
+    )
+    table = yield TableStep(query, [pickup_zone_id, dropoff_zone_id] + params)
+    data = np.column_stack([np.asarray(table.columns[c], dtype=np.float64) for c in SKETCH_COLUMNS]) \
+        if len(table) else []
+    return QuantileSketches.from_rows(data).bands("od", od_key(pickup_zone_id, dropoff_zone_id))
+
+
+_sketches = None
+_sketches_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+
+def refresh_quantile_sketches(path=QUANTILES_PATH):
+    """从数据库重新计算全部摘要并写入磁盘（导入新数据后调用）"""
+    start = time.time()
+    sketches = QuantileSketches.from_db()
+    _store(sketches, path)
+    cells = sum(len(c) for c, _ in sketches.sketches.values())
+    print(f"✅ Quantile sketches rebuilt: {cells:,} buckets in {time.time() - start:.1f}s")
+    return sketches
+
+
+def _store(sketches, path):
+    global _sketches, _sketches_mtime
+    sketches.save(path)
+    with _lock:
+        _sketches = sketches
+        _sketches_mtime = os.path.getmtime(path)
+
+
+def update_quantile_sketches(deltas, path=QUANTILES_PATH):
+    """
+    按导入的增量更新摘要（ingest.py 调用），不重新扫描整张明细表
+
+    参数:
+        deltas: [(sign, rows)]，rows 是 sketch_query 在新增（sign=1）或被替换掉（sign=-1）的数据上的结果行
+    """
+    if not os.path.exists(path):
+        return refresh_quantile_sketches(path)
+    start = time.time()
+    sketches = QuantileSketches.load(path)
+    if sketches.accuracy != QUANTILE_CONFIG["relative_accuracy"]:
+        # 分桶参数变了，旧摘要不能合并
+        return refresh_quantile_sketches(path)
+    for sign, rows in deltas:
+        if rows:
+            sketches.merge(QuantileSketches.from_rows(rows), sign)
+    # ingest.py 在写派生文件前已把版本号加一
+    sketches.data_version = get_version("taxi")
+    _store(sketches, path)
+    print(f"✅ Quantile sketches updated from {len(deltas)} deltas in {time.time() - start:.1f}s")
+    return sketches
+
+
+def load_quantile_sketches(path=QUANTILES_PATH, rebuild=True):
+    """
+    启动时加载摘要：优先读取磁盘文件，没有（或分桶参数变了、与当前数据版本不一致）则从数据库构建
+
+    rebuild=False 时只读取已经建好的文件（版本过期也先用着），文件不存在或分桶参数变了时返回 None
+    """
+    global _sketches, _sketches_mtime
+    if not os.path.exists(path):
+        return refresh_quantile_sketches(path) if rebuild else None
+    sketches = QuantileSketches.load(path)
+    if sketches.accuracy != QUANTILE_CONFIG["relative_accuracy"]:
+        return refresh_quantile_sketches(path) if rebuild else None
+    if rebuild and sketches.data_version != get_version("taxi"):
+        return refresh_quantile_sketches(path)
+    with _lock:
+        _sketches = sketches
+        _sketches_mtime = os.path.getmtime(path)
+    return sketches
+
+
+def get_quantile_sketches(path=QUANTILES_PATH, rebuild=True):
+    """
+    获取当前摘要；磁盘文件被其他进程刷新或数据版本变化后自动重新加载 / 重建
+
+    rebuild=False（请求路径上的 label_bands）时只重新加载磁盘文件，不从数据库重建；没有可用的摘要时返回 None
+    """
+    global _last_check
+    if in_event_loop():
+        # asgi_app.py：启动时已在线程里加载，之后由后台任务定期检查
+        if _sketches is None:
+            raise RuntimeError("Quantile sketches not loaded yet")
+        return _sketches
+    if _sketches is None:
+        return load_quantile_sketches(path, rebuild)
+    now = time.time()
+    if now - _last_check > RELOAD_CHECK_INTERVAL:
+        _last_check = now
+        changed = os.path.exists(path) and os.path.getmtime(path) != _sketches_mtime
+        if changed or (rebuild and _sketches.data_version != get_version("taxi")):
+            try:
+                return load_quantile_sketches(path, rebuild) or _sketches
+            except Exception as e:
+                # 重建失败时继续使用内存中的摘要，下次检查再试
+                print(f"Error reloading quantile sketches: {e}")
+    return _sketches
+
+
+if __name__ == "__main__":
+    refresh_quantile_sketches()
@@ -0,0 +1,159 @@
+import time
+from datetime import datetime
+
+from db import get_connection
+from partitions import TABLE_NAME, is_month_aligned, month_start, next_month, normalize_window, window_condition
+
+# 预聚合立方体：上车区域 × 小时 × 星期 × 支付方式 × 月份
+# amount_flag 用来还原原查询里的金额过滤条件：
+#   0 = total_amount <= 0 或为空
+#   1 = total_amount > 0 且 fare_amount <= 0
+#   2 = total_amount > 0 且 fare_amount > 0
+ROLLUP_TABLE = "trip_rollup"
+
+CREATE_ROLLUP_SQL = """
+CREATE TABLE IF NOT EXISTS trip_rollup (
+    pulocationid INTEGER,
+    pickup_hour SMALLINT,
+    pickup_dow SMALLINT,
+    payment_type INTEGER,
+    pickup_month DATE,
+    amount_flag SMALLINT NOT NULL,
+    trip_count BIGINT NOT NULL,
+    passenger_trips BIGINT NOT NULL,
+    passenger_sum BIGINT,
+    distance_sum NUMERIC,
+    fare_sum NUMERIC,
+    tip_sum NUMERIC,
+    tolls_sum NUMERIC,
+    total_sum NUMERIC,
+    extra_sum NUMERIC,
+    mta_tax_sum NUMERIC,
+    improvement_sum NUMERIC,
+    congestion_sum NUMERIC,
+    congestion_pos_sum NUMERIC,
+    congestion_trips BIGINT NOT NULL,
+    distance_trips BIGINT NOT NULL
+);
+-- 旧表补上 distance_trips（加在末尾，与 ROLLUP_SELECT_SQL 的列顺序一致；加列后用 python rollup.py 重建）
+ALTER TABLE trip_rollup ADD COLUMN IF NOT EXISTS distance_trips BIGINT;
+CREATE INDEX IF NOT EXISTS trip_rollup_month_idx ON trip_rollup (pickup_month);
+"""
+
+# 从明细表聚合到立方体粒度
+ROLLUP_SELECT_SQL = """
+SELECT
+    pulocationid,
+    EXTRACT(HOUR FROM tpep_pickup_datetime)::smallint as pickup_hour,
+    EXTRACT(DOW FROM tpep_pickup_datetime)::smallint as pickup_dow,
+    payment_type,
+    date_trunc('month', tpep_pickup_datetime)::date as pickup_month,
+    (CASE
+        WHEN total_amount > 0 AND fare_amount > 0 THEN 2
+        WHEN total_amount > 0 THEN 1
+        ELSE 0
+    END)::smallint as amount_flag,
+    COUNT(*) as trip_count,
+    COUNT(passenger_count) as passenger_trips,
+    SUM(passenger_count) as passenger_sum,
+    SUM(trip_distance) as distance_sum,
+    SUM(fare_amount) as fare_sum,
+    SUM(tip_amount) as tip_sum,
+    SUM(tolls_amount) as tolls_sum,
+    SUM(total_amount) as total_sum,
+    SUM(extra) as extra_sum,
+    SUM(mta_tax) as mta_tax_sum,
+    SUM(improvement_surcharge) as improvement_sum,
+    SUM(congestion_surcharge) as congestion_sum,
+    SUM(CASE WHEN congestion_surcharge > 0 THEN congestion_surcharge END) as congestion_pos_sum,
+    COUNT(*) FILTER (WHERE congestion_surcharge > 0) as congestion_trips,
+    COUNT(trip_distance) as distance_trips
+FROM {source}
+{where}
+GROUP BY 1, 2, 3, 4, 5, 6
+"""
+
+
+def _as_datetime(day):
+    return datetime(day.year, day.month, day.day)
+
+
+def rollup_source(start=None, end=None):
+    """
+    时间窗口对应的立方体数据源，返回 (FROM 子句, WHERE 条件, 参数)
+
+    窗口内的整月直接读 trip_rollup（按 pickup_month 过滤）；
+    两端不足一个月的部分从明细表现算同样结构的立方体，
+    时间条件让这部分查询只扫描首尾月份的分区
+    """
+    start, end = normalize_window(start, end)
+    if is_month_aligned(start) and is_month_aligned(end):
+        condition, params = window_condition("pickup_month", start, end)
+        return ROLLUP_TABLE, condition, params
+
+    # 窗口内的整月部分 [inner_start, inner_end)
+    inner_start = start if is_month_aligned(start) else _as_datetime(next_month(start))
+    inner_end = end if is_month_aligned(end) else _as_datetime(month_start(end))
+    parts, params = [], []
+    if inner_start is not None and inner_end is not None and inner_start >= inner_end:
+        # 窗口落在同一个月内，全部从明细表计算
+        edges = [(start, end)]
+    else:
+        condition, params = window_condition("pickup_month", inner_start, inner_end)
+        parts.append(f"SELECT * FROM {ROLLUP_TABLE} WHERE {condition}")
+        edges = []
+        if not is_month_aligned(start):
+            edges.append((start, inner_start))
+        if not is_month_aligned(end):
+            edges.append((inner_end, end))
+    for s, e in edges:
+        condition, p = window_condition("tpep_pickup_datetime", s, e)
+        parts.append(ROLLUP_SELECT_SQL.format(source=TABLE_NAME, where="WHERE " + condition))
+        params += p
+    source = "(" + "\nUNION ALL\n".join(parts) + f") AS {ROLLUP_TABLE}"
+    return source, "TRUE", params
+
+
+def refresh_rollup():
+    """从 yellow_taxi_clean 重建预聚合立方体（在导入数据后调用）"""
+    start = time.time()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_ROLLUP_SQL)
+            cur.execute(f"TRUNCATE {ROLLUP_TABLE};")
+            cur.execute(f"INSERT INTO {ROLLUP_TABLE} {ROLLUP_SELECT_SQL.format(source=TABLE_NAME, where='')};")
+            rows = cur.rowcount
+            cur.execute(f"ANALYZE {ROLLUP_TABLE};")
+    print(f"✅ Rollup rebuilt: {rows:,} cells in {time.time() - start:.1f}s")
+    return rows
+
+
+def append_rollup(cur, source):
+    """
+    把 source（与 yellow_taxi_clean 结构相同的表，只含新增的行）聚合后追加到 trip_rollup
+
+    追加的格子可能与已有格子的维度相同；所有查询都对格子做 SUM，所以结果不变，
+    refresh_rollup 或 replace_rollup_months 会把它们合并
+    """
+    cur.execute(f"INSERT INTO {ROLLUP_TABLE} {ROLLUP_SELECT_SQL.format(source=source, where='')};")
+    return cur.rowcount
+
+
+def replace_rollup_months(cur, months):
+    """按明细表重新计算给定月份的格子（月份数据被整体替换后，在同一个事务里调用）"""
+    rows = 0
+    for month in sorted(months):
+        cur.execute(f"DELETE FROM {ROLLUP_TABLE} WHERE pickup_month = %s;", (month,))
+        condition, params = window_condition(
+            "tpep_pickup_datetime", _as_datetime(month), _as_datetime(next_month(month))
+        )
+        cur.execute(
+            f"INSERT INTO {ROLLUP_TABLE} {ROLLUP_SELECT_SQL.format(source=TABLE_NAME, where='WHERE ' + condition)};",
+            params
+        )
+        rows += cur.rowcount
+    return rows
+
+
+if __name__ == "__main__":
+    refresh_rollup()
@@ -0,0 +1,195 @@
+"""
+近似查询：yellow_taxi_clean 按 上车区域 × 月份 分层抽样的样本表 trip_sample
+
+每层按行内容的哈希抽 min(层内行数, max(min_rows, rate × 层内行数)) 行，每行带权重
+sample_weight = 层内行数 / 抽样行数，加权求和即为全表的估计（Horvitz-Thompson）；
+min_rows 保证行程少的区域也有足够的样本。样本表按月维护：导入新数据后只重抽受影响的月份。
+
+置信区间用正态近似，方差按每行独立以 1/w 的概率入样估计（整层全部入样时 w = 1，不贡献方差）：
+    总量 Σ w·y        方差 Σ w(w-1)·y²
+    均值 Σ w·y / Σ w  方差 Σ w(w-1)·(y - ȳ)² / (Σ w)²（线性化）
+没有利用层内均值，区间偏保守。
+
+analysis.py 里直接扫描明细表的查询（热门路线、带时间窗口的费用估算）支持 approx=True：
+同一条 SQL 通过 estimator(approx) 生成精确或加权的聚合列，结果里多出 {指标}_ci_low / {指标}_ci_high。
+读 trip_rollup 的面板本身就是精确且快速的，不提供近似模式。
+"""
+import time
+from datetime import datetime
+from statistics import NormalDist
+
+import numpy as np
+
+from columnar import Table
+from config import SAMPLE_CONFIG
+from db import get_connection
+from partitions import TABLE_NAME, next_month, window_condition
+
+SAMPLE_TABLE = "trip_sample"
+
+CREATE_SAMPLE_SQL = f"""
+CREATE TABLE IF NOT EXISTS {SAMPLE_TABLE} (LIKE {TABLE_NAME});
+ALTER TABLE {SAMPLE_TABLE} ADD COLUMN IF NOT EXISTS sample_weight DOUBLE PRECISION NOT NULL DEFAULT 1;
+CREATE INDEX IF NOT EXISTS {SAMPLE_TABLE}_pickup_idx ON {SAMPLE_TABLE} (tpep_pickup_datetime);
+"""
+
+# 与 yellow_taxi_clean 的列顺序一致
+TRIP_COLUMNS = [
+    "vendorid", "tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count", "trip_distance",
+    "ratecodeid", "pulocationid", "dolocationid", "payment_type", "fare_amount", "extra", "mta_tax",
+    "tip_amount", "tolls_amount", "improvement_surcharge", "total_amount", "congestion_surcharge",
+]
+
+# 每层的抽样行数
+STRATUM_SAMPLE = "LEAST(stratum_rows, GREATEST({min_rows}, CEIL(stratum_rows * {rate})))"
+
+# 层内的抽样顺序：行内容的 md5（不用 random()），同样的数据每次重建、在两个后端上都抽到同样的行；
+# 只用文本形式在两个后端上相同的列（时间戳和整数），哈希相同的行再按金额排序
+SAMPLE_ORDER = " || '|' || ".join(
+    f"COALESCE(CAST({c} AS VARCHAR), '')"
+    for c in ("tpep_pickup_datetime", "tpep_dropoff_datetime", "dolocationid", "vendorid", "passenger_count")
+)
+
+# 从明细表抽样（PostgreSQL 和 DuckDB 通用）
+SAMPLE_SELECT_SQL = """
+SELECT {columns}, CAST(stratum_rows AS DOUBLE PRECISION) / {stratum_sample} as sample_weight
+FROM (
+    SELECT *,
+        ROW_NUMBER() OVER (
+            PARTITION BY pulocationid, date_trunc('month', tpep_pickup_datetime)
+            ORDER BY md5({order}), total_amount, fare_amount, trip_distance
+        ) as sample_rank,
+        COUNT(*) OVER (PARTITION BY pulocationid, date_trunc('month', tpep_pickup_datetime)) as stratum_rows
+    FROM {source}
+    {where}
+) strata
+WHERE sample_rank <= {stratum_sample}
+"""
+
+
+def sample_select_sql(source=TABLE_NAME, where="", config=SAMPLE_CONFIG):
+    stratum_sample = STRATUM_SAMPLE.format(min_rows=int(config["min_rows"]), rate=float(config["rate"]))
+    return SAMPLE_SELECT_SQL.format(
+        columns=", ".join(TRIP_COLUMNS), stratum_sample=stratum_sample, order=SAMPLE_ORDER, source=source, where=where
+    )
+
+
+def refresh_sample():
+    """从 yellow_taxi_clean 重新抽取整个样本表（在导入数据后调用）"""
+    start = time.time()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_SAMPLE_SQL)
+            cur.execute(f"TRUNCATE {SAMPLE_TABLE};")
+            cur.execute(f"INSERT INTO {SAMPLE_TABLE} ({', '.join(TRIP_COLUMNS)}, sample_weight) {sample_select_sql()};")
+            rows = cur.rowcount
+            cur.execute(f"ANALYZE {SAMPLE_TABLE};")
+    print(f"✅ Sample rebuilt: {rows:,} rows in {time.time() - start:.1f}s")
+    return rows
+
+
+def replace_sample_months(cur, months):
+    """重新抽取给定月份的样本（分层包含月份，各月互不影响；与 rollup.replace_rollup_months 一起调用）"""
+    cur.execute(CREATE_SAMPLE_SQL)
+    rows = 0
+    for month in sorted(months):
+        following = next_month(month)
+        condition, params = window_condition(
+            "tpep_pickup_datetime",
+            datetime(month.year, month.month, 1), datetime(following.year, following.month, 1)
+        )
+        cur.execute(f"DELETE FROM {SAMPLE_TABLE} WHERE {condition};", params)
+        cur.execute(
+            f"INSERT INTO {SAMPLE_TABLE} ({', '.join(TRIP_COLUMNS)}, sample_weight) "
+            f"{sample_select_sql(where='WHERE ' + condition)};",
+            params
+        )
+        rows += cur.rowcount
+    return rows
+
+
+def _z(confidence):
+    return NormalDist().inv_cdf(0.5 + confidence / 2)
+
+
+class ExactEstimator:
+    """精确查询：明细表上的 COUNT / AVG，SQL 与原来相同"""
+
+    approx = False
+    source = TABLE_NAME
+    rows = "COUNT(*)"
+
+    def count(self, name):
+        return f"COUNT(*) as {name}"
+
+    def avg(self, name, expr):
+        return f"AVG({expr}) as {name}"
+
+    def finish(self, table):
+        return table
+
+
+class SampleEstimator:
+    """近似查询：trip_sample 上的加权估计，finish 把方差项换成置信区间"""
+
+    approx = True
+    source = SAMPLE_TABLE
+    rows = "SUM(sample_weight)"
+
+    def __init__(self, confidence=SAMPLE_CONFIG["confidence"]):
+        self.z = _z(confidence)
+        self._counts = []
+        self._avgs = []
+
+    def count(self, name):
+        self._counts.append(name)
+        return (f"SUM(sample_weight) as {name}, "
+                f"SUM(sample_weight * (sample_weight - 1)) as {name}__var, "
+                f"COUNT(*) as sample_rows")
+
+    def avg(self, name, expr):
+        self._avgs.append(name)
+        w, known = "sample_weight", f"CASE WHEN ({expr}) IS NOT NULL THEN sample_weight END"
+        return (f"SUM({w} * ({expr})) / SUM({known}) as {name}, "
+                f"SUM({known}) as {name}__n, "
+                f"SUM({known} * ({w} - 1)) as {name}__v0, "
+                f"SUM({w} * ({w} - 1) * ({expr})) as {name}__v1, "
+                f"SUM({w} * ({w} - 1) * ({expr}) * ({expr})) as {name}__v2")
+
+    def finish(self, table):
+        """Table -> 估计值 + {指标}_ci_low / {指标}_ci_high，去掉方差项"""
+        cols = {n: c for n, c in table.columns.items() if "__" not in n}
+        out = {}
+        for name, values in cols.items():
+            if name in self._counts:
+                estimate = np.asarray(values, dtype=np.float64)
+                half = self.z * np.sqrt(np.asarray(table.columns[f"{name}__var"], dtype=np.float64))
+                finite = np.isfinite(estimate)
+                counts = np.rint(np.where(finite, estimate, 0.0)).astype(np.int64)
+                # 没有样本行时 SUM 为 NULL（NaN），输出为 None，而不是转成整数后的 INT64_MIN
+                out[name] = counts if finite.all() else np.array(
+                    [int(c) if f else None for c, f in zip(counts, finite)], dtype=object
+                )
+                out[f"{name}_ci_low"] = np.round(np.maximum(estimate - half, 0.0), 1)
+                out[f"{name}_ci_high"] = np.round(estimate + half, 1)
+            elif name in self._avgs:
+                mean = np.asarray(values, dtype=np.float64)
+                n, v0, v1, v2 = (np.asarray(table.columns[f"{name}__{k}"], dtype=np.float64) for k in ("n", "v0", "v1", "v2"))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    var = np.maximum(v2 - 2 * mean * v1 + mean * mean * v0, 0.0) / (n * n)
+                half = self.z * np.sqrt(var)
+                out[name] = mean
+                out[f"{name}_ci_low"] = mean - half
+                out[f"{name}_ci_high"] = mean + half
+            else:
+                out[name] = values
+        return Table(out)
+
+
+def estimator(approx=False):
+    """approx=True 时在样本表上估计"""
+    return SampleEstimator() if approx else ExactEstimator()
+
+
+if __name__ == "__main__":
+    refresh_sample()
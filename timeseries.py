@@ -0,0 +1,282 @@
+"""
+行程时间序列金字塔：5 分钟 / 小时 / 天 / 周 四种分辨率的行程数、收入和平均车费
+
+    trip_series  每行是一个时间桶：resolution, bucket_start, pickup_month, pulocationid（NULL = 全市）,
+                 trip_count, paid_trips, fare_sum, total_sum
+
+收入和平均车费与 get_revenue_summary 的口径相同（total_amount > 0 且 fare_amount > 0 的行程）。
+全市的序列保存全部四种分辨率，按区域的序列只保存 TIMESERIES_CONFIG["zone_resolutions"] 中的分辨率，
+行政区的序列在查询时对区域求和。跨月的周按月份拆成两行保存，查询时按 bucket_start 合并，
+这样每个月份的数据可以单独重算（loader.py / ingest.py 导入时调用 replace_series_months）。
+
+时间线查询选择"桶数不少于点数预算"的最粗分辨率（读取的行最少，同时点数够用），
+再用 LTTB（Largest-Triangle-Three-Buckets）降采样到预算以内，保留峰谷等形状特征。
+
+用法:
+    python timeseries.py   # 从 yellow_taxi_clean 重建全部月份
+"""
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from backends import TableStep, stepwise
+from columnar import Table
+from config import TIMESERIES_CONFIG
+from db import get_connection
+from partitions import TABLE_NAME, next_month, normalize_window, window_condition
+from zones import get_zone_directory
+
+SERIES_TABLE = "trip_series"
+
+CREATE_SERIES_SQL = """
+CREATE TABLE IF NOT EXISTS trip_series (
+    resolution TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    pickup_month DATE NOT NULL,
+    pulocationid INTEGER,
+    trip_count BIGINT NOT NULL,
+    paid_trips BIGINT NOT NULL,
+    fare_sum NUMERIC,
+    total_sum NUMERIC
+);
+CREATE INDEX IF NOT EXISTS trip_series_bucket_idx ON trip_series (resolution, pulocationid, bucket_start);
+CREATE INDEX IF NOT EXISTS trip_series_month_idx ON trip_series (pickup_month);
+"""
+
+# (名称, 桶长度, 桶起点的 SQL 表达式)；由细到粗，PostgreSQL 和 DuckDB 通用
+Resolution = namedtuple("Resolution", ["name", "step", "bucket_sql"])
+RESOLUTIONS = [
+    Resolution("5min", timedelta(minutes=5),
+               "date_trunc('hour', tpep_pickup_datetime) "
+               "+ CAST(floor(EXTRACT(MINUTE FROM tpep_pickup_datetime) / 5) AS INTEGER) * INTERVAL '5 minutes'"),
+    Resolution("hour", timedelta(hours=1), "date_trunc('hour', tpep_pickup_datetime)"),
+    Resolution("day", timedelta(days=1), "date_trunc('day', tpep_pickup_datetime)"),
+    # date_trunc('week') 从周一开始
+    Resolution("week", timedelta(weeks=1), "date_trunc('week', tpep_pickup_datetime)"),
+]
+RESOLUTION_NAMES = [r.name for r in RESOLUTIONS]
+# 所有分辨率的桶都与这个周一 0 点对齐
+BUCKET_ORIGIN = np.datetime64("1970-01-05T00:00:00", "s")
+
+METRICS = ("trip_count", "revenue", "avg_fare")
+
+
+def series_select_sql(source=TABLE_NAME, window="TRUE"):
+    """一次扫描同时聚合出所有分辨率（GROUPING SETS），返回与 trip_series 列顺序相同的 SELECT"""
+    zone_levels = set(TIMESERIES_CONFIG["zone_resolutions"])
+    buckets = [f"bucket_{r.name}" for r in RESOLUTIONS]
+    sets = []
+    for r, bucket in zip(RESOLUTIONS, buckets):
+        sets.append(f"(pickup_month, {bucket})")
+        if r.name in zone_levels:
+            sets.append(f"(pickup_month, {bucket}, pulocationid)")
+    # GROUPING(...) 的位：分组中出现的列为 0，第一列是最高位
+    cases = "\n".join(
+        f"        WHEN {(1 << len(buckets)) - 1 - (1 << (len(buckets) - 1 - i))} THEN '{r.name}'"
+        for i, r in enumerate(RESOLUTIONS)
+    )
+    bucket_columns = ",\n        ".join(f"{r.bucket_sql} as {b}" for r, b in zip(RESOLUTIONS, buckets))
+    return f"""
+SELECT
+    CASE GROUPING({', '.join(buckets)})
+{cases}
+    END as resolution,
+    COALESCE({', '.join(buckets)}) as bucket_start,
+    pickup_month,
+    pulocationid,
+    COUNT(*) as trip_count,
+    COUNT(*) FILTER (WHERE paid) as paid_trips,
+    SUM(fare_amount) FILTER (WHERE paid) as fare_sum,
+    SUM(total_amount) FILTER (WHERE paid) as total_sum
+FROM (
+    SELECT
+        date_trunc('month', tpep_pickup_datetime)::date as pickup_month,
+        {bucket_columns},
+        pulocationid,
+        fare_amount,
+        total_amount,
+        total_amount > 0 AND fare_amount > 0 as paid
+    FROM {source}
+    WHERE tpep_pickup_datetime IS NOT NULL
+        AND {window}
+) trips
+GROUP BY GROUPING SETS ({', '.join(sets)})
+HAVING GROUPING(pulocationid) = 1 OR pulocationid IS NOT NULL
+"""
+
+
+def build_series(cur, window="TRUE", params=None, source=TABLE_NAME, insert="INSERT INTO {table}"):
+    """
+    在 cur 上聚合 window 内的行程并写入 trip_series（调用方先删除这些月份的旧数据）
+
+    cur 可以是 psycopg 游标或 DuckDB 连接；DuckDB 用 insert="CREATE OR REPLACE TABLE {table} AS" 直接建表
+    """
+    cur.execute(f"{insert.format(table=SERIES_TABLE)} {series_select_sql(source, window)};", params)
+
+
+def refresh_series():
+    """从 yellow_taxi_clean 重建全部月份的时间序列（在导入数据后调用）"""
+    start = time.time()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_SERIES_SQL)
+            cur.execute(f"TRUNCATE {SERIES_TABLE};")
+            build_series(cur)
+            rows = cur.rowcount
+            cur.execute(f"ANALYZE {SERIES_TABLE};")
+    print(f"✅ Time series rebuilt: {rows:,} buckets in {time.time() - start:.1f}s")
+    return rows
+
+
+def replace_series_months(cur, months):
+    """重新计算给定月份的时间桶（月份数据被追加 / 替换后，与 rollup.replace_rollup_months 一起调用）"""
+    cur.execute(CREATE_SERIES_SQL)
+    for month in sorted(months):
+        cur.execute(f"DELETE FROM {SERIES_TABLE} WHERE pickup_month = %s;", (month,))
+        following = next_month(month)
+        window, params = window_condition(
+            "tpep_pickup_datetime",
+            datetime(month.year, month.month, 1), datetime(following.year, following.month, 1)
+        )
+        build_series(cur, window, params)
+
+
+def choose_resolution(start, end, max_points, levels=RESOLUTION_NAMES):
+    """桶数不少于 max_points 的最粗分辨率；窗口太短时用最细的分辨率"""
+    span = end - start
+    candidates = [r for r in RESOLUTIONS if r.name in levels]
+    for r in reversed(candidates):
+        if span / r.step >= max_points:
+            return r
+    return candidates[0]
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets 降采样，返回保留的点的下标
+
+    首尾两点固定保留，中间的点平均分成 n_out - 2 个桶，每个桶选出与上一个选中点、
+    下一个桶的均值点构成的三角形面积最大的点
+    """
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1][:max(n_out, 0)], dtype=np.int64)
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def _bucket_grid(start, end, step):
+    """起点在 [start, end) 内的所有桶（与 BUCKET_ORIGIN 对齐，和查询的 bucket_start 条件一致）"""
+    step = np.timedelta64(int(step.total_seconds()), "s")
+    first = np.datetime64(start, "s")
+    first += (step - (first - BUCKET_ORIGIN) % step) % step
+    return np.arange(first, np.datetime64(end, "s"), step)
+
+
+def _scope(zone_id, borough):
+    """区域 / 行政区 -> (WHERE 条件, 参数, 可用的分辨率)"""
+    if zone_id is None and borough is None:
+        return "pulocationid IS NULL", [], RESOLUTION_NAMES
+    if zone_id is not None:
+        zones = [int(zone_id)]
+    else:
+        zones = [z.locationid for z in get_zone_directory().by_borough(borough)]
+        if not zones:
+            raise ValueError(f"Unknown borough: {borough}")
+    condition = f"pulocationid IN ({', '.join(['%s'] * len(zones))})"
+    return condition, zones, [r for r in RESOLUTION_NAMES if r in TIMESERIES_CONFIG["zone_resolutions"]]
+
+
+@stepwise
+def timeline(start=None, end=None, zone_id=None, borough=None, metric="trip_count", max_points=None):
+    """
+    时间窗口内的行程数 / 收入 / 平均车费时间线，最多 max_points 个点（按 metric 列降采样）
+
+    没有指定窗口时使用数据覆盖的全部时间；区域 / 行政区的时间线只有 zone_resolutions 中的分辨率
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric} (expected one of {', '.join(METRICS)})")
+    max_points = min(int(max_points or TIMESERIES_CONFIG["max_points"]), TIMESERIES_CONFIG["max_points_limit"])
+    if max_points < 2:
+        raise ValueError("max_points must be at least 2")
+    start, end = normalize_window(start, end)
+    scope, scope_params, levels = _scope(zone_id, borough)
+
+    if start is None or end is None:
+        coarse = RESOLUTION_NAMES[-1]
+        bounds = yield TableStep(
+            f"SELECT MIN(bucket_start) as first_bucket, MAX(bucket_start) as last_bucket "
+            f"FROM {SERIES_TABLE} WHERE resolution = %s AND pulocationid IS NULL;", [coarse]
+        )
+        first = np.asarray(bounds.columns["first_bucket"], dtype="datetime64[s]")[0]
+        last = np.asarray(bounds.columns["last_bucket"], dtype="datetime64[s]")[0]
+        if np.isnat(first):
+            return {"resolution": None, "metric": metric, "start": start, "end": end, "source_points": 0, "points": []}
+        # 只给了一端且它在数据范围之外时，另一端取成同一时刻（空序列），不会出现倒置的窗口
+        if start is None:
+            start = first.item() if end is None else min(first.item(), end)
+        if end is None:
+            end = max((last + np.timedelta64(7, "D")).item(), start)
+
+    resolution = choose_resolution(start, end, max_points, levels)
+    window, window_params = window_condition("bucket_start", start, end)
+    table = yield TableStep(f"""
+        SELECT
+            bucket_start,
+            SUM(trip_count)::bigint as trip_count,
+            SUM(paid_trips)::bigint as paid_trips,
+            SUM(fare_sum) as fare_sum,
+            SUM(total_sum) as total_sum
+        FROM {SERIES_TABLE}
+        WHERE resolution = %s AND {scope} AND {window}
+        GROUP BY bucket_start
+        ORDER BY bucket_start;
+    """, [resolution.name, *scope_params, *window_params])
+
+    # 没有行程的桶补 0，降采样时才能看到真实的低谷
+    grid = _bucket_grid(start, end, resolution.step)
+    index = np.searchsorted(grid, np.asarray(table.columns["bucket_start"], dtype="datetime64[s]"))
+    values = {}
+    for name in ("trip_count", "paid_trips", "fare_sum", "total_sum"):
+        filled = np.zeros(len(grid))
+        filled[index] = np.nan_to_num(np.asarray(table.columns[name], dtype=np.float64))
+        values[name] = filled
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_fare = np.where(values["paid_trips"] > 0, values["fare_sum"] / values["paid_trips"], np.nan)
+    series = {"trip_count": values["trip_count"], "revenue": values["total_sum"], "avg_fare": avg_fare}
+
+    x = (grid - BUCKET_ORIGIN).astype(np.float64)
+    keep = lttb(x, np.nan_to_num(series[metric]), max_points)
+    points = Table({
+        "bucket_start": grid[keep],
+        "trip_count": series["trip_count"][keep].astype(np.int64),
+        "revenue": series["revenue"][keep],
+        "avg_fare": series["avg_fare"][keep],
+    })
+    return {
+        "resolution": resolution.name,
+        "bucket_seconds": int(resolution.step.total_seconds()),
+        "metric": metric,
+        "start": start,
+        "end": end,
+        "source_points": len(grid),
+        "points": points,
+    }
+
+
+if __name__ == "__main__":
+    refresh_series()
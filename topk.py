@@ -0,0 +1,243 @@
+"""
+热门路线的 top-K 摘要：每个月只保存行程数最多的 K 条 起点-终点 路线，查询时按时间窗口合并
+
+    route_topk         每月前 K 条路线的行程数和费用 / 距离 / 时长之和
+    route_topk_months  每月的总行程数和误差界 threshold：未保存的路线在该月的行程数不超过它
+                       （该月路线数不超过 K 时为 0）
+
+合并按 SpaceSaving 摘要的规则：某条路线的估计值 = 保存了它的月份的行程数 + 其余月份 threshold 之和，
+是真实值的上界，trip_count_error 是最大的高估量（真实值在 [trip_count - trip_count_error, trip_count]）。
+均值只用保存了该路线的月份计算（这些月份内是精确的）。每月的摘要在导入时按该月数据计算一次
+（loader.py / ingest.py），查询只读几个月 × K 行，不再对整个时间窗口做 GROUP BY。
+
+区域只有 265 个，容量 K ≥ 265 的摘要就是精确的区域汇总，所以区域排行继续读 trip_rollup。
+
+用法:
+    python topk.py   # 从 yellow_taxi_clean 重建全部月份
+"""
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from backends import TableStep, stepwise
+from config import TOPK_CONFIG
+from db import get_connection
+from partitions import TABLE_NAME, is_month_aligned, month_start, next_month, normalize_window, window_condition
+
+TOPK_TABLE = "route_topk"
+TOPK_MONTHS_TABLE = "route_topk_months"
+
+CREATE_TOPK_SQL = """
+CREATE TABLE IF NOT EXISTS route_topk (
+    pickup_month DATE NOT NULL,
+    pulocationid INTEGER NOT NULL,
+    dolocationid INTEGER NOT NULL,
+    trip_count BIGINT NOT NULL,
+    fare_sum NUMERIC,
+    distance_sum NUMERIC,
+    duration_min_sum NUMERIC,
+    PRIMARY KEY (pickup_month, pulocationid, dolocationid)
+);
+CREATE TABLE IF NOT EXISTS route_topk_months (
+    pickup_month DATE PRIMARY KEY,
+    total_trips BIGINT NOT NULL,
+    routes BIGINT NOT NULL,
+    threshold BIGINT NOT NULL
+);
+"""
+
+# 与 get_popular_routes 原查询相同的过滤条件
+ROUTE_FILTERS = """pulocationid IS NOT NULL
+    AND dolocationid IS NOT NULL
+    AND tpep_pickup_datetime IS NOT NULL
+    AND tpep_dropoff_datetime IS NOT NULL"""
+
+ROUTE_MEASURES = """COUNT(*) as trip_count,
+    SUM(fare_amount) as fare_sum,
+    SUM(trip_distance) as distance_sum,
+    SUM(EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime))/60) as duration_min_sum"""
+
+# 每月每条路线的汇总和月内排名（PostgreSQL 和 DuckDB 通用）
+ROUTE_COUNTS_SQL = f"""
+SELECT
+    date_trunc('month', tpep_pickup_datetime)::date as pickup_month,
+    pulocationid,
+    dolocationid,
+    {ROUTE_MEASURES},
+    ROW_NUMBER() OVER (
+        PARTITION BY date_trunc('month', tpep_pickup_datetime)::date
+        ORDER BY COUNT(*) DESC, pulocationid, dolocationid
+    ) as route_rank
+FROM {{source}}
+WHERE {ROUTE_FILTERS}
+    AND {{window}}
+GROUP BY 1, 2, 3
+"""
+
+# 不足一个月的窗口边缘直接从明细表计算，多取一行作为误差界
+EDGE_ROUTES_SQL = f"""
+SELECT
+    pulocationid,
+    dolocationid,
+    {ROUTE_MEASURES}
+FROM {TABLE_NAME}
+WHERE {ROUTE_FILTERS}
+    AND {{window}}
+GROUP BY pulocationid, dolocationid
+ORDER BY trip_count DESC, pulocationid, dolocationid
+LIMIT {{limit}}
+"""
+
+SUMS = ["trip_count", "fare_sum", "distance_sum", "duration_min_sum"]
+
+
+def build_topk(cur, window="TRUE", params=None, source=TABLE_NAME, insert="INSERT INTO {table}"):
+    """
+    在 cur 上计算 window 内各月份的摘要并写入两张表（调用方先删除这些月份的旧数据）
+
+    cur 可以是 psycopg 游标或 DuckDB 连接；DuckDB 用 insert="CREATE OR REPLACE TABLE {table} AS" 直接建表
+    """
+    capacity = int(TOPK_CONFIG["route_capacity"])
+    cur.execute("DROP TABLE IF EXISTS route_counts;")
+    cur.execute(
+        f"CREATE TEMP TABLE route_counts AS {ROUTE_COUNTS_SQL.format(source=source, window=window)};", params
+    )
+    cur.execute(f"""
+        {insert.format(table=TOPK_TABLE)}
+        SELECT pickup_month, pulocationid, dolocationid, trip_count, fare_sum, distance_sum, duration_min_sum
+        FROM route_counts
+        WHERE route_rank <= {capacity};
+    """)
+    cur.execute(f"""
+        {insert.format(table=TOPK_MONTHS_TABLE)}
+        SELECT
+            pickup_month,
+            SUM(trip_count) as total_trips,
+            COUNT(*) as routes,
+            COALESCE(MAX(CASE WHEN route_rank > {capacity} THEN trip_count END), 0) as threshold
+        FROM route_counts
+        GROUP BY pickup_month;
+    """)
+    cur.execute("DROP TABLE route_counts;")
+
+
+def _month_bounds(month):
+    following = next_month(month)
+    return datetime(month.year, month.month, 1), datetime(following.year, following.month, 1)
+
+
+def refresh_topk():
+    """从 yellow_taxi_clean 重建全部月份的摘要（在导入数据后调用）"""
+    start = time.time()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_TOPK_SQL)
+            cur.execute(f"TRUNCATE {TOPK_TABLE}, {TOPK_MONTHS_TABLE};")
+            build_topk(cur)
+            cur.execute(f"SELECT COUNT(*), COALESCE(SUM(routes), 0)::bigint FROM {TOPK_MONTHS_TABLE};")
+            months, routes = cur.fetchone()
+    print(f"✅ Route top-K rebuilt: {months} months, {routes:,} routes summarised in {time.time() - start:.1f}s")
+    return months
+
+
+def replace_topk_months(cur, months):
+    """重新计算给定月份的摘要（月份数据被追加 / 替换后，与 rollup.replace_rollup_months 一起调用）"""
+    cur.execute(CREATE_TOPK_SQL)
+    for month in sorted(months):
+        cur.execute(f"DELETE FROM {TOPK_TABLE} WHERE pickup_month = %s;", (month,))
+        cur.execute(f"DELETE FROM {TOPK_MONTHS_TABLE} WHERE pickup_month = %s;", (month,))
+        window, params = window_condition("tpep_pickup_datetime", *_month_bounds(month))
+        build_topk(cur, window, params)
+
+
+def merge_summaries(summaries, limit):
+    """
+    合并多个摘要，返回估计值最高的 limit 条路线（DataFrame，estimate 为上界，error 为最大高估量）
+
+    summaries: [(DataFrame[pulocationid, dolocationid, *SUMS], threshold)]
+    """
+    total_threshold = sum(t for _, t in summaries)
+    frames = [df.assign(threshold=t) for df, t in summaries if len(df)]
+    if not frames:
+        return pd.DataFrame(columns=["pulocationid", "dolocationid", *SUMS, "error", "estimate"])
+    items = pd.concat(frames, ignore_index=True)
+    merged = items.groupby(["pulocationid", "dolocationid"], as_index=False)[SUMS + ["threshold"]].sum()
+    # 没有保存这条路线的月份，按该月的 threshold 计入上界
+    merged["error"] = total_threshold - merged.pop("threshold")
+    merged["estimate"] = merged["trip_count"] + merged["error"]
+    merged = merged.sort_values(["estimate", "pulocationid", "dolocationid"], ascending=[False, True, True])
+    return merged.head(limit)
+
+
+def _month_keys(values):
+    """PostgreSQL 返回 date、DuckDB 返回 datetime64，统一成 'YYYY-MM-DD'"""
+    return np.asarray(values, dtype="datetime64[D]").astype(str)
+
+
+def _frame(table):
+    return pd.DataFrame({n: np.asarray(c) for n, c in table.columns.items()})
+
+
+@stepwise
+def top_routes(start=None, end=None, limit=10):
+    """
+    时间窗口内行程数最多的路线：整月读 route_topk，首尾不足一个月的部分从明细表计算
+
+    返回 records：pickup_zone, dropoff_zone, trip_count（上界）, trip_count_error, avg_fare, avg_distance, avg_duration_min
+    """
+    start, end = normalize_window(start, end)
+    capacity = int(TOPK_CONFIG["route_capacity"])
+    inner_start = start if is_month_aligned(start) else datetime.combine(next_month(start), datetime.min.time())
+    inner_end = end if is_month_aligned(end) else datetime.combine(month_start(end), datetime.min.time())
+    steps, edges = [], []
+    if inner_start is not None and inner_end is not None and inner_start >= inner_end:
+        # 窗口落在同一个月内
+        edges = [(start, end)]
+    else:
+        condition, params = window_condition("pickup_month", inner_start, inner_end)
+        steps += [
+            TableStep(f"SELECT pickup_month, pulocationid, dolocationid, {', '.join(SUMS)} "
+                      f"FROM {TOPK_TABLE} WHERE {condition};", params),
+            TableStep(f"SELECT pickup_month, threshold FROM {TOPK_MONTHS_TABLE} WHERE {condition};", params),
+        ]
+        if not is_month_aligned(start):
+            edges.append((start, inner_start))
+        if not is_month_aligned(end):
+            edges.append((inner_end, end))
+    for s, e in edges:
+        condition, params = window_condition("tpep_pickup_datetime", s, e)
+        steps.append(TableStep(EDGE_ROUTES_SQL.format(window=condition, limit=capacity + 1), params))
+    results = yield steps
+
+    summaries = []
+    if len(results) > len(edges):
+        routes, months = _frame(results[0]), _frame(results[1])
+        routes["pickup_month"] = _month_keys(routes["pickup_month"])
+        thresholds = dict(zip(_month_keys(months["pickup_month"]), months["threshold"]))
+        for month, group in routes.groupby("pickup_month"):
+            summaries.append((group.drop(columns="pickup_month"), int(thresholds.get(month, 0))))
+    for table in results[len(results) - len(edges):]:
+        edge = _frame(table)
+        threshold = int(edge["trip_count"].iloc[capacity]) if len(edge) > capacity else 0
+        summaries.append((edge.head(capacity), threshold))
+
+    merged = merge_summaries(summaries, limit)
+    records = []
+    for r in merged.itertuples():
+        tracked = r.trip_count
+        records.append({
+            "pickup_zone": int(r.pulocationid),
+            "dropoff_zone": int(r.dolocationid),
+            "trip_count": int(r.estimate),
+            "trip_count_error": int(r.error),
+            "avg_fare": r.fare_sum / tracked,
+            "avg_distance": r.distance_sum / tracked,
+            "avg_duration_min": r.duration_min_sum / tracked,
+        })
+    return records
+
+
+if __name__ == "__main__":
+    refresh_topk()
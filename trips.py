@@ -0,0 +1,186 @@
+"""
+行程数据的紧凑类型：清洗（pipeline.py）、导入（loader.py）和 DuckDB 后端共用的一份 schema
+
+    PULocationID / DOLocationID                                 int16（1..265）
+    VendorID / RatecodeID / payment_type / passenger_count     int8
+    里程和金额                                                  float32
+    上下车时间                                                  timestamp[us]
+
+notebook 里默认的 pandas 类型是 int64 / float64，每行约 136 字节；紧凑类型约 60 字节。
+金额和里程都是两位小数，float32 按分取整后仍是原值（|x| < 167,772 时精确），
+导入 PostgreSQL 时 loader.py 本来就按分取整，DuckDB 视图用 sql_columns 还原成两位小数的 DOUBLE。
+
+cast_batch 把任意来源（TLC 原始文件、旧版 float64 的清洗结果）的批次按列向量化地转换成 TRIP_SCHEMA，
+整数列四舍五入，超出范围的值记为 NULL；to_frame 转成 pandas 时保持紧凑类型（可空整数、float32），
+代码列可以转成带标签的分类类型（字典编码，int8 编码值）。
+
+用法:
+    python trips.py --input yellow_taxi_clean_parquet   # 比较默认类型和紧凑类型每百万行的内存
+"""
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# 清洗后保留的列与类型（顺序与 yellow_taxi_clean 表一致）
+TRIP_SCHEMA = pa.schema([
+    ("VendorID", pa.int8()),
+    ("tpep_pickup_datetime", pa.timestamp("us")),
+    ("tpep_dropoff_datetime", pa.timestamp("us")),
+    ("passenger_count", pa.int8()),
+    ("trip_distance", pa.float32()),
+    ("RatecodeID", pa.int8()),
+    ("PULocationID", pa.int16()),
+    ("DOLocationID", pa.int16()),
+    ("payment_type", pa.int8()),
+    ("fare_amount", pa.float32()),
+    ("extra", pa.float32()),
+    ("mta_tax", pa.float32()),
+    ("tip_amount", pa.float32()),
+    ("tolls_amount", pa.float32()),
+    ("improvement_surcharge", pa.float32()),
+    ("total_amount", pa.float32()),
+    ("congestion_surcharge", pa.float32()),
+])
+
+# TLC 数据字典中的代码（to_frame(labels=True) 时作为分类的标签）
+CODE_LABELS = {
+    "VendorID": {1: "Creative Mobile Technologies", 2: "Curb Mobility", 6: "Myle Technologies", 7: "Helix"},
+    "RatecodeID": {1: "Standard Rate", 2: "JFK", 3: "Newark", 4: "Nassau or Westchester",
+                   5: "Negotiated Fare", 6: "Group Ride", 99: "Unknown"},
+    "payment_type": {0: "Flex Fare", 1: "Credit Card", 2: "Cash", 3: "No Charge", 4: "Dispute",
+                     5: "Unknown", 6: "Voided Trip"},
+}
+
+# arrow 整数列 -> pandas 可空整数（缺失值不会把整列变成 float64）
+PANDAS_DTYPES = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+}
+
+
+def _to_integer(array, type):
+    """数值列 -> 整数：四舍五入，NaN 和超出类型范围的值为 NULL"""
+    info = np.iinfo(type.to_pandas_dtype())
+    if pa.types.is_integer(array.type):
+        values, lo, hi = array, info.min, info.max
+    else:
+        values, lo, hi = pc.round(array.cast(pa.float64())), float(info.min), float(info.max)
+    in_range = pc.and_(pc.greater_equal(values, lo), pc.less_equal(values, hi))
+    return pc.if_else(in_range, values, pa.scalar(None, values.type)).cast(type)
+
+
+def cast_column(array, type):
+    if array.type == type:
+        return array
+    if pa.types.is_integer(type):
+        return _to_integer(array, type)
+    return array.cast(type)
+
+
+def cast_batch(batch, schema=TRIP_SCHEMA):
+    """任意来源的批次 -> schema（列名不区分大小写，缺失的列补 NULL，多余的列丢掉）"""
+    by_lower = {name.lower(): i for i, name in enumerate(batch.schema.names)}
+    columns = []
+    for field in schema:
+        i = by_lower.get(field.name.lower())
+        columns.append(pa.nulls(batch.num_rows, field.type) if i is None else cast_column(batch.column(i), field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def cast_table(table, schema=TRIP_SCHEMA):
+    return pa.Table.from_batches([cast_batch(b, schema) for b in table.to_batches()], schema=schema)
+
+
+def to_frame(table, labels=False):
+    """
+    arrow 表 -> pandas，保持紧凑类型
+
+    labels=True 时 VendorID / RatecodeID / payment_type 转成带标签的分类（数据字典以外的代码为缺失值）
+    """
+    df = table.to_pandas(types_mapper=PANDAS_DTYPES.get)
+    if labels:
+        by_lower = {c.lower(): c for c in df.columns}
+        for name, codes in CODE_LABELS.items():
+            col = by_lower.get(name.lower())
+            if col is not None:
+                dtype = pd.CategoricalDtype(list(codes.values()))
+                df[col] = df[col].map(codes).astype(dtype)
+    return df
+
+
+def sql_columns(names):
+    """
+    DuckDB 视图的列表达式：列名统一成小写，紧凑类型还原成与 PostgreSQL 表相同的类型
+    （整数为 INTEGER，区域 id 相乘不会溢出 int16；float32 取两位小数，与 NUMERIC 的值相同）
+    """
+    types = {f.name.lower(): f.type for f in TRIP_SCHEMA}
+    columns = []
+    for name in names:
+        type, quoted = types.get(name.lower()), '"' + name.replace('"', '""') + '"'
+        if type is not None and pa.types.is_integer(type):
+            columns.append(f"CAST({quoted} AS INTEGER) AS {name.lower()}")
+        elif type is not None and pa.types.is_floating(type):
+            columns.append(f"round(CAST({quoted} AS DOUBLE), 2) AS {name.lower()}")
+        else:
+            columns.append(f"{quoted} AS {name.lower()}")
+    return ", ".join(columns)
+
+
+# ---- 内存对比 ----
+
+# notebook 的默认类型：整数 int64，其余数值 float64
+WIDE_SCHEMA = pa.schema([
+    (f.name, pa.int64() if pa.types.is_integer(f.type) else pa.float64() if pa.types.is_floating(f.type) else f.type)
+    for f in TRIP_SCHEMA
+])
+
+
+def memory_report(path, rows=1_000_000):
+    """读取前 rows 行，分别按默认类型和紧凑类型计算每百万行的 arrow / pandas 内存"""
+    files = sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)) if os.path.isdir(path) else [path]
+    batches, n = [], 0
+    for f in files:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=min(rows, 256_000)):
+            batches.append(batch.slice(0, rows - n))
+            n += batches[-1].num_rows
+            if n >= rows:
+                break
+        if n >= rows:
+            break
+    if not n:
+        print(f"❌ No rows found under {path}")
+        return {}
+    report = {}
+    for label, schema in (("default", WIDE_SCHEMA), ("compact", TRIP_SCHEMA)):
+        table = pa.Table.from_batches([cast_batch(b, schema) for b in batches], schema=schema)
+        frame = table.to_pandas() if label == "default" else to_frame(table, labels=True)
+        report[label] = {
+            "arrow_mb": table.nbytes / n * 1e6 / 1024 / 1024,
+            "pandas_mb": frame.memory_usage(deep=True).sum() / n * 1e6 / 1024 / 1024,
+        }
+    print(f"Memory per million trips ({n:,} rows from {path}):")
+    for label, r in report.items():
+        print(f"  {label:<8} arrow {r['arrow_mb']:7.1f} MB   pandas {r['pandas_mb']:7.1f} MB")
+    print(f"  compact / default: arrow {report['compact']['arrow_mb'] / report['default']['arrow_mb']:.2f}, "
+          f"pandas {report['compact']['pandas_mb'] / report['default']['pandas_mb']:.2f}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare default and compact in-memory trip representations")
+    parser.add_argument("--input", default="yellow_taxi_clean_parquet", help="按月分区目录或单个 parquet 文件")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    memory_report(args.input, args.rows)
+
+
+if __name__ == "__main__":
+    main()
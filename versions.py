@@ -0,0 +1,120 @@
+import threading
+import time
+
+import psycopg
+
+from backends import get_backend
+from config import PG_CONFIG, QUERY_BACKEND
+from db import get_connection
+
+# 数据集版本号：每次导入数据后递增，缓存以此判断结果是否过期
+#   taxi  - yellow_taxi_clean 及其派生表
+#   zones - taxi_zone_lookup
+#   311   - MongoDB 中的 311 投诉
+CREATE_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS dataset_version (
+    dataset TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+"""
+
+# 读取版本号的最小间隔（秒），避免每个请求都访问数据库
+VERSION_CHECK_INTERVAL = 2.0
+# 读取失败（PostgreSQL 不可用）后等这么久再重试，期间使用缓存的版本号
+VERSION_RETRY_INTERVAL = 30.0
+# 非 postgres 后端（duckdb）不建连接池，用一次性连接读取版本号的连接超时（秒）
+VERSION_CONNECT_TIMEOUT = 2
+
+_versions = {}
+_next_check = 0.0
+# 正在读取版本号：同一时间只有一个线程访问数据库，其他线程直接返回缓存
+_refreshing = False
+_lock = threading.Lock()
+# asgi_app.py 用异步连接池定期读取版本号（refresh_versions_async）时为真：get_versions 只返回缓存，不访问数据库
+_async_refresh = False
+
+
+def bump_version(dataset):
+    """数据集导入完成后调用，版本号加一"""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_VERSION_SQL)
+            cur.execute("""
+                INSERT INTO dataset_version (dataset, version) VALUES (%s, 1)
+                ON CONFLICT (dataset) DO UPDATE
+                SET version = dataset_version.version + 1, updated_at = now()
+                RETURNING version;
+            """, (dataset,))
+            version = cur.fetchone()[0]
+    with _lock:
+        _versions[dataset] = version
+    print(f"✅ Dataset '{dataset}' is now at version {version}")
+    return version
+
+
+def _read_versions():
+    """从 dataset_version 表读取版本号；表不存在时返回 None"""
+    if QUERY_BACKEND == "postgres":
+        connection = get_connection()
+    else:
+        connection = psycopg.connect(**PG_CONFIG, connect_timeout=VERSION_CONNECT_TIMEOUT)
+    with connection as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('dataset_version') IS NOT NULL;")
+            if not cur.fetchone()[0]:
+                return None
+            cur.execute("SELECT dataset, version FROM dataset_version;")
+            return dict(cur.fetchall())
+
+
+def get_versions():
+    """
+    所有数据集的当前版本号（带短时间缓存）
+
+    访问数据库时不持有锁：同一时间只有一个线程去读，其他线程直接返回缓存；读取失败后 VERSION_RETRY_INTERVAL 秒内不再重试
+    """
+    global _versions, _next_check, _refreshing
+    with _lock:
+        if _async_refresh or _refreshing or time.time() < _next_check:
+            return _versions
+        _refreshing = True
+    versions, retry = None, VERSION_CHECK_INTERVAL
+    try:
+        versions = _read_versions()
+    except Exception as e:
+        print(f"Error reading dataset versions (retrying in {VERSION_RETRY_INTERVAL:.0f}s): {e}")
+        retry = VERSION_RETRY_INTERVAL
+    with _lock:
+        if versions is not None:
+            _versions = versions
+        _next_check = time.time() + retry
+        _refreshing = False
+    return _versions
+
+
+async def refresh_versions_async(fetch):
+    """
+    get_versions 的异步版本：fetch 是 aio.fetch（PostgreSQL 后端的异步连接池）
+
+    asgi_app.py 启动时和后台任务里每 VERSION_CHECK_INTERVAL 秒调用一次，进程里不再为读版本号建同步连接池
+    """
+    global _versions, _next_check, _async_refresh
+    _, rows = await fetch("SELECT to_regclass('dataset_version') IS NOT NULL;")
+    if rows[0][0]:
+        _, rows = await fetch("SELECT dataset, version FROM dataset_version;")
+        with _lock:
+            _versions = dict(rows)
+    with _lock:
+        _next_check = time.time() + VERSION_CHECK_INTERVAL
+        _async_refresh = True
+    return _versions
+
+
+def get_version(dataset):
+    if dataset == "taxi":
+        # 嵌入式后端直接以 parquet 文件的修改时间作为版本号
+        version = get_backend().data_version()
+        if version is not None:
+            return version
+    return get_versions().get(dataset, 0)
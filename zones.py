@@ -0,0 +1,126 @@
+import csv
+import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+import numpy as np
+
+from columnar import Table
+from db import get_connection
+
+ZONE_CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "taxi_zone_lookup.csv")
+
+Zone = namedtuple("Zone", ["locationid", "borough", "zone", "service_zone"])
+
+
+class ZoneDirectory:
+    """只读的出租车区域目录，按 id / 行政区 / 服务区建立索引"""
+
+    def __init__(self, zones):
+        self._zones = tuple(sorted(zones, key=lambda z: z.locationid))
+        self._by_id = MappingProxyType({z.locationid: z for z in self._zones})
+        self._by_borough = MappingProxyType(self._group(lambda z: z.borough))
+        self._by_service_zone = MappingProxyType(self._group(lambda z: z.service_zone))
+        # get_all_zones 按名称排序的结果只需计算一次
+        self._records = tuple(
+            MappingProxyType({"locationid": z.locationid, "zone": z.zone, "borough": z.borough})
+            for z in sorted(self._zones, key=lambda z: (z.zone is None, z.zone or ""))
+        )
+
+    def _group(self, key):
+        groups = {}
+        for z in self._zones:
+            groups.setdefault(key(z), []).append(z)
+        return {k: tuple(v) for k, v in groups.items()}
+
+    @classmethod
+    def from_csv(cls, path=ZONE_CSV_PATH):
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        return cls(
+            Zone(int(r["LocationID"]), r["Borough"], r["Zone"], r["service_zone"]) for r in rows
+        )
+
+    @classmethod
+    def from_db(cls):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                try:
+                    cur.execute("SELECT locationid, borough, zone, service_zone FROM taxi_zone_lookup;")
+                except Exception:
+                    # 表由 pandas 创建时列名是大小写混合的
+                    conn.rollback()
+                    cur.execute('SELECT "LocationID", "Borough", "Zone", "service_zone" FROM taxi_zone_lookup;')
+                rows = cur.fetchall()
+        return cls(Zone(*r) for r in rows)
+
+    def __len__(self):
+        return len(self._zones)
+
+    def __iter__(self):
+        return iter(self._zones)
+
+    def get(self, locationid):
+        return self._by_id.get(locationid)
+
+    def by_borough(self, borough):
+        return self._by_borough.get(borough, ())
+
+    def by_service_zone(self, service_zone):
+        return self._by_service_zone.get(service_zone, ())
+
+    @property
+    def boroughs(self):
+        return tuple(sorted(self._by_borough))
+
+    def records(self):
+        """下拉框使用的区域列表（按区域名称排序）"""
+        return [dict(r) for r in self._records]
+
+    def name(self, locationid):
+        z = self.get(locationid)
+        return z.zone if z is not None else f"Zone {locationid}"
+
+    def borough(self, locationid):
+        z = self.get(locationid)
+        return z.borough if z is not None else "Unknown"
+
+    def label(self, records, id_key, name_key, borough_key):
+        """给查询结果加上区域名称和行政区，原地修改并返回"""
+        if isinstance(records, Table):
+            return self._label_table(records, id_key, name_key, borough_key)
+        for r in records:
+            zone_id = r.get(id_key)
+            zone_id = int(zone_id) if zone_id is not None else None
+            r[name_key] = self.name(zone_id)
+            r[borough_key] = self.borough(zone_id)
+        return records
+
+    def _label_table(self, table, id_key, name_key, borough_key):
+        """按列加名称：每个不同的区域只查一次"""
+        ids = np.asarray(table.columns[id_key])
+        if len(ids) == 0:
+            return table.add_column(name_key, []).add_column(borough_key, [])
+        unique, inverse = np.unique(ids, return_inverse=True)
+        unique = [int(z) if z == z else None for z in unique.tolist()]
+        names = np.array([self.name(z) for z in unique], dtype=object)
+        boroughs = np.array([self.borough(z) for z in unique], dtype=object)
+        return table.add_column(name_key, names[inverse]).add_column(borough_key, boroughs[inverse])
+
+
+_directory = None
+_lock = threading.Lock()
+
+
+def get_zone_directory():
+    """进程内只构建一次：优先读取随仓库附带的 CSV，否则读取数据库表"""
+    global _directory
+    if _directory is None:
+        with _lock:
+            if _directory is None:
+                if os.path.exists(ZONE_CSV_PATH):
+                    _directory = ZoneDirectory.from_csv()
+                else:
+                    _directory = ZoneDirectory.from_db()
+    return _directory